@@ -8,10 +8,32 @@ import pandas as pd
 import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
 import json
+import io
 import os
 import calendar
-from datetime import datetime, date, timedelta
+import hashlib
+import multiprocessing
+import re
+import sqlite3
+import sys
+import threading
+import zlib
+import getpass
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, date, time, timedelta
+from functools import lru_cache
+from queue import Empty
+from time import perf_counter
+from types import MappingProxyType
+
+import pyarrow as pa
+
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)       # loaders hand out shallow copies of shared snapshots
 
 st.set_page_config(
     page_title="HR & Payroll System",
@@ -123,11 +145,54 @@ st.markdown("""
 # ══════════════════════════════════════════════════════════════════════════════
 
 BASE_DIR       = os.path.dirname(os.path.abspath(__file__))
-DATA_DIR       = os.path.join(BASE_DIR, "data")
+ROOT_DATA_DIR  = os.path.join(BASE_DIR, "data")
+COMPANIES_PATH = os.path.join(ROOT_DATA_DIR, "companies.json")
+DEFAULT_COMPANY= "default"
+
+def list_companies():
+    # {company_id: display name}; the original single-company data folder is the "default" company
+    if os.path.exists(COMPANIES_PATH):
+        with open(COMPANIES_PATH) as f:
+            return json.load(f)
+    return {DEFAULT_COMPANY: "Default Company"}
+
+def save_companies(companies):
+    with open(COMPANIES_PATH, "w") as f:
+        json.dump(companies, f, indent=2)
+
+def company_dir(company_id):
+    return ROOT_DATA_DIR if company_id == DEFAULT_COMPANY else os.path.join(ROOT_DATA_DIR, "companies", company_id)
+
+def add_company(name):
+    companies = list_companies()
+    base = re.sub(r"[^a-z0-9]+", "-", name.strip().lower()).strip("-") or "company"
+    cid, n = base, 2
+    while cid in companies:
+        cid, n = f"{base}-{n}", n + 1
+    os.makedirs(company_dir(cid), exist_ok=True)
+    with open(os.path.join(company_dir(cid), "config.json"), "w") as f:
+        json.dump({**DEFAULT_CONFIG, "company": {"name": name.strip(), "address": ""}}, f, indent=2)
+    companies[cid] = name.strip()
+    save_companies(companies)
+    return cid
+
+os.makedirs(ROOT_DATA_DIR, exist_ok=True)
+COMPANIES = list_companies()
+if "_switch_company" in st.session_state:
+    st.session_state["company"] = st.session_state.pop("_switch_company")
+if st.session_state.get("company") not in COMPANIES:
+    st.session_state["company"] = next(iter(COMPANIES))
+COMPANY_ID     = st.session_state["company"]
+DATA_DIR       = company_dir(COMPANY_ID)
 CONFIG_PATH    = os.path.join(DATA_DIR, "config.json")
 EMPLOYEES_PATH = os.path.join(DATA_DIR, "employees.csv")
 ATTENDANCE_PATH= os.path.join(DATA_DIR, "attendance.csv")
 LEAVES_PATH    = os.path.join(DATA_DIR, "leaves.csv")
+PAYROLL_DB_PATH= os.path.join(DATA_DIR, "payroll.db")
+ANALYTICS_DB_PATH = os.path.join(DATA_DIR, "analytics.db")
+HISTORY_DB_PATH= os.path.join(DATA_DIR, "history.db")
+SNAPSHOT_DIR   = os.path.join(DATA_DIR, "snapshots")
+ARCHIVE_DIR    = os.path.join(DATA_DIR, "archive")
 
 os.makedirs(DATA_DIR, exist_ok=True)
 
@@ -157,7 +222,8 @@ DEFAULT_CONFIG = {
         "week_off": "Sunday",
         "working_days": ["Monday","Tuesday","Wednesday","Thursday","Friday","Saturday"],
         "sandwich_rule": True,
-        "min_days_per_week": 3
+        "min_days_per_week": 3,
+        "workers": 0
     },
     "salary_components": {
         "components": [
@@ -174,24 +240,34 @@ DEFAULT_CONFIG = {
         "pf_base": "Basic", "cap_at_15000": False, "eps_percentage": 8.33, "edli_enabled": True
     },
     "esic": {"enabled": False, "employee_percentage": 0.75, "employer_percentage": 3.25, "wage_ceiling": 21000},
-    "tds": {"enabled": False},
+    "tds": {
+        "enabled": False, "default_regime": "new", "cess_percentage": 4,
+        "regimes": {
+            "new": {"standard_deduction": 75000, "rebate_limit": 1200000, "rebate_max": 60000,
+                    "slabs": [[400000, 0], [800000, 5], [1200000, 10], [1600000, 15], [2000000, 20], [2400000, 25], [None, 30]]},
+            "old": {"standard_deduction": 50000, "rebate_limit": 500000, "rebate_max": 12500, "deduction_80c": 150000,
+                    "slabs": [[250000, 0], [500000, 5], [1000000, 20], [None, 30]]}
+        }
+    },
     "professional_tax": {"enabled": False},
+    "holidays": [],
     "leave": {
-        "pl": {"annual": 12, "carry_forward": True,  "max_carry_forward": 30, "encashable": True},
-        "cl": {"annual": 6,  "carry_forward": False, "max_carry_forward": 0,  "encashable": False},
-        "sl": {"annual": 6,  "carry_forward": False, "encashable": False}
+        "pl": {"annual": 12, "carry_forward": True,  "max_carry_forward": 30, "encashable": True,  "paid": True},
+        "cl": {"annual": 6,  "carry_forward": False, "max_carry_forward": 0,  "encashable": False, "paid": True},
+        "sl": {"annual": 6,  "carry_forward": False, "encashable": False, "paid": True}
     },
-    "overtime": {"enabled": True, "rate_multiplier": 1.5, "calculation_base": "Basic"}
+    "overtime": {"enabled": True, "rate_multiplier": 1.5, "calculation_base": "Basic"},
+    "archive": {"auto_close": False, "hot_months": 2}
 }
 
 EMPLOYEE_COLUMNS = [
-    "ecode","name","department","designation","doj","dob","gender","mobile","email","address",
+    "ecode","name","department","designation","location","doj","dob","gender","mobile","email","address",
     "father_name","mother_name","spouse_name",
     "nominee_name","nominee_relation","nominee_dob",
     "bank_name","account_no","ifsc","uan","pf_no","esic_no",
     "shift","is_open_shift",
     "gross_salary","basic","hra","conveyance","special_allowance","medical_allowance","food_allowance",
-    "pf_applicable","esic_applicable","status","exit_date"
+    "pf_applicable","esic_applicable","tax_regime","status","exit_date"
 ]
 ATTENDANCE_COLUMNS = [
     "ecode","name","date","day","shift","in_time","out_time",
@@ -199,6 +275,110 @@ ATTENDANCE_COLUMNS = [
 ]
 LEAVE_COLUMNS = ["ecode","name","leave_type","from_date","to_date","days","reason","status","applied_on"]
 
+# Column types applied once at load: a list means categorical (fixed categories first),
+# everything not listed stays a plain string column
+WEEKDAYS            = list(calendar.day_name)
+ATTENDANCE_STATUSES = ["Present","Absent","Absent (Sandwich)","Half Day","Week Off","Holiday","On Leave",
+                       "Missing Punch","Missing IN Punch","Missing OUT Punch"]
+SALARY_FIELDS       = ["gross_salary","basic","hra","conveyance","special_allowance","medical_allowance","food_allowance"]
+
+EMPLOYEE_SCHEMA = {
+    "department": [], "designation": [], "location": [], "gender": ["Male","Female","Other"], "shift": [],
+    "is_open_shift": ["Yes","No"], "pf_applicable": ["Yes","No"], "esic_applicable": ["Yes","No"], "tax_regime": ["New","Old"],
+    "status": ["Active","Inactive"],
+    "doj": "date", "dob": "date", "nominee_dob": "date", "exit_date": "date",
+    **{c: "float64" for c in SALARY_FIELDS},
+}
+ATTENDANCE_SCHEMA = {
+    "date": "date", "day": WEEKDAYS, "shift": [], "status": ATTENDANCE_STATUSES,
+    "working_hours": "float32", "overtime_hours": "float32",
+    "early_going_minutes": "int16", "late_entry_minutes": "int16",
+}
+LEAVE_SCHEMA = {
+    "leave_type": ["PL","CL","SL"], "status": ["Pending","Approved","Rejected"],
+    "from_date": "date", "to_date": "date", "applied_on": "date", "days": "float32",
+}
+SCHEMA_ISSUES = {}
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  TENANT CACHE  (one per process, shared by every session and company)
+# ══════════════════════════════════════════════════════════════════════════════
+
+TENANT_CACHE_MB  = 512    # whole process
+TENANT_BUDGET_MB = 64     # per company unless config["cache_mb"] says otherwise
+
+def _nbytes(value):
+    if isinstance(value, tuple):
+        return sum(_nbytes(v) for v in value)
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    return int(getattr(value, "nbytes", 0)) or sys.getsizeof(value)
+
+class TenantCache:
+    # Versioned LRU entries per company. A company over its budget evicts its own oldest entries;
+    # when the process total is exceeded the least recently active companies give way first.
+    def __init__(self, total_bytes):
+        self.total   = total_bytes
+        self.lock    = threading.Lock()
+        self.tenants = OrderedDict()                    # company -> OrderedDict(name -> (version, value, nbytes))
+        self.budgets = {}
+        self.stats   = defaultdict(lambda: {"hits": 0, "misses": 0, "evictions": 0})
+
+    def set_budget(self, tenant, nbytes):
+        with self.lock:
+            self.budgets[tenant] = nbytes
+            self._evict(tenant)
+
+    def get(self, tenant, name, version, build):
+        with self.lock:
+            entries = self.tenants.setdefault(tenant, OrderedDict())
+            self.tenants.move_to_end(tenant)
+            hit = entries.get(name)
+            if hit is not None and hit[0] == version:
+                entries.move_to_end(name)
+                self.stats[tenant]["hits"] += 1
+                return hit[1]
+            self.stats[tenant]["misses"] += 1
+        value = build()        # outside the lock so other companies are not blocked on a slow parse
+        self.put(tenant, name, version, value)
+        return value
+
+    def put(self, tenant, name, version, value):
+        size = _nbytes(value)
+        with self.lock:
+            entries = self.tenants.setdefault(tenant, OrderedDict())
+            entries.pop(name, None)
+            if size <= self.budgets.get(tenant, TENANT_BUDGET_MB << 20):
+                entries[name] = (version, value, size)
+            self._evict(tenant)
+
+    def _used(self, tenant):
+        return sum(e[2] for e in self.tenants.get(tenant, {}).values())
+
+    def _drop_oldest(self, tenant):
+        self.tenants[tenant].popitem(last=False)
+        self.stats[tenant]["evictions"] += 1
+
+    def _evict(self, tenant):
+        while self.tenants.get(tenant) and self._used(tenant) > self.budgets.get(tenant, TENANT_BUDGET_MB << 20):
+            self._drop_oldest(tenant)
+        while sum(self._used(t) for t in self.tenants) > self.total:
+            self._drop_oldest(next(t for t, e in self.tenants.items() if e))
+
+    def usage(self):
+        with self.lock:
+            return pd.DataFrame([{"company": t, "entries": len(e), "used_mb": round(self._used(t) / 2**20, 1),
+                                  "budget_mb": round(self.budgets.get(t, TENANT_BUDGET_MB << 20) / 2**20, 1), **self.stats[t]}
+                                 for t, e in self.tenants.items()])
+
+@st.cache_resource(show_spinner=False)
+def tenant_cache():
+    return TenantCache(TENANT_CACHE_MB << 20)
+
+def file_version(*paths):
+    return ":".join(str(os.stat(p).st_mtime_ns) if os.path.exists(p) else "0" for p in paths)
+
 
 # ══════════════════════════════════════════════════════════════════════════════
 #  HELPER FUNCTIONS
@@ -215,41 +395,180 @@ def save_config(config):
     with open(CONFIG_PATH, "w") as f:
         json.dump(config, f, indent=2)
 
-def load_employees():
-    if os.path.exists(EMPLOYEES_PATH):
-        df = pd.read_csv(EMPLOYEES_PATH, dtype=str)
-        for col in EMPLOYEE_COLUMNS:
-            if col not in df.columns:
-                df[col] = ""
+def _has_type(s, kind):
+    # Lets frames that are already typed (e.g. edited in memory) pass through apply_schema cheaply
+    if kind is None:
+        return not s.hasnans and pd.api.types.infer_dtype(s, skipna=False) == "string"
+    if isinstance(kind, list):
+        return isinstance(s.dtype, pd.CategoricalDtype)
+    if kind == "date":
+        return pd.api.types.is_datetime64_dtype(s)
+    return s.dtype == np.dtype(kind)
+
+def apply_schema(df, columns, schema, table=None):
+    # Converts raw string columns to their declared types and records values that failed to parse
+    # (under `table`; pass None for frames that are not a loaded table)
+    issues = {}
+    for col in columns:
+        if col not in df.columns:
+            df[col] = ""
+    for col in df.columns:
+        kind = schema.get(col)
+        raw  = df[col]
+        if _has_type(raw, kind):
+            continue
+        if kind is None:
+            df[col] = raw.fillna("").astype(str)
+            continue
+        if isinstance(kind, list):
+            vals    = raw.fillna("").astype(str).str.strip()
+            df[col] = vals.astype(pd.CategoricalDtype(list(dict.fromkeys(kind + sorted(vals.unique())))))
+            continue
+        conv = pd.to_datetime(raw, errors="coerce", format="ISO8601") if kind == "date" else pd.to_numeric(raw, errors="coerce")
+        bad  = int((conv.isna() & raw.notna() & (raw.astype(str).str.strip() != "")).sum())
+        if bad:
+            issues[col] = bad
+        if kind == "int16":
+            conv = conv.fillna(0).round().clip(-32768, 32767).astype("int16")
+        elif kind != "date":
+            conv = conv.fillna(0).astype(kind)
+        df[col] = conv
+    if table is None:
         return df
-    return pd.DataFrame(columns=EMPLOYEE_COLUMNS)
+    if issues:
+        SCHEMA_ISSUES[table] = issues
+    else:
+        SCHEMA_ISSUES.pop(table, None)
+    return df
 
-def save_employees(df):
-    df.to_csv(EMPLOYEES_PATH, index=False)
+def to_storage(df, schema):
+    # Dates are written back as YYYY-MM-DD whatever mix of strings / timestamps the frame holds
+    dates = [c for c, k in schema.items() if k == "date" and c in df.columns]
+    return df.assign(**{c: pd.to_datetime(df[c], errors="coerce", format="ISO8601").dt.strftime("%Y-%m-%d") for c in dates})
+
+# ── Table snapshots ───────────────────────────────────────────────────────────
+# Each typed table version is published once as an uncompressed Arrow IPC file and memory-mapped by
+# every session and worker process, so pages come from the OS page cache rather than per-session copies.
+# "<table>.current" names the live file; it is swapped with os.replace, so readers see old or new, never half.
+
+SNAPSHOT_KEEP = 2            # older files stay on disk for readers that still map them
+
+def _snapshot_pointer(table):
+    return os.path.join(SNAPSHOT_DIR, f"{table}.current")
+
+def _atomic_write(path, write):
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    write(tmp)
+    os.replace(tmp, path)
+
+def publish_snapshot(table, df, version, issues):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    name = f"{table}-{hashlib.sha1(version.encode()).hexdigest()[:16]}.arrow"
+    data = pa.Table.from_pandas(df, preserve_index=False)
+    data = data.replace_schema_metadata({**(data.schema.metadata or {}), b"hr_issues": json.dumps(issues).encode()})
+    def write(tmp):
+        with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, data.schema) as writer:
+            writer.write_table(data)
+    _atomic_write(os.path.join(SNAPSHOT_DIR, name), write)
+    def point(tmp):
+        with open(tmp, "w") as f:
+            json.dump({"version": version, "file": name}, f)
+    _atomic_write(_snapshot_pointer(table), point)
+    old = sorted((f for f in os.listdir(SNAPSHOT_DIR) if f.startswith(f"{table}-") and f.endswith(".arrow") and f != name),
+                 key=lambda f: os.path.getmtime(os.path.join(SNAPSHOT_DIR, f)))
+    for f in old[:max(0, len(old) - SNAPSHOT_KEEP + 1)]:
+        os.remove(os.path.join(SNAPSHOT_DIR, f))
+
+def open_snapshot(table, version):
+    # Zero-copy view of the published file for `version`, or None when it is missing or stale
+    try:
+        with open(_snapshot_pointer(table)) as f:
+            ptr = json.load(f)
+        if ptr["version"] != version:
+            return None
+        data = pa.ipc.open_file(pa.memory_map(os.path.join(SNAPSHOT_DIR, ptr["file"]), "r")).read_all()
+    except (OSError, ValueError, KeyError, pa.ArrowInvalid):
+        return None
+    issues = json.loads((data.schema.metadata or {}).get(b"hr_issues", b"{}"))
+    return data.to_pandas(split_blocks=True), issues
+
+ATTENDANCE_ORDER = ["date","ecode"]
+
+def _cached_table(path, columns, schema, table, order=None):
+    # Typed tables are shared across sessions of the same company until the file changes.
+    # The returned frame is the shared one — slice or copy it, never mutate it.
+    def parse():
+        version = file_version(path)
+        snap    = open_snapshot(table, version)
+        if snap is not None:
+            return snap
+        raw = pd.read_csv(path, dtype=str) if os.path.exists(path) else pd.DataFrame(columns=columns)
+        df  = apply_schema(raw, columns, schema, table)
+        if order:
+            df = df.sort_values(order, kind="stable", ignore_index=True)
+        issues = dict(SCHEMA_ISSUES.get(table, {}))
+        publish_snapshot(table, df, version, issues)
+        return open_snapshot(table, version) or (df, issues)
+    df, issues = tenant_cache().get(COMPANY_ID, table, file_version(path), parse)
+    if issues:
+        SCHEMA_ISSUES[table] = issues
+    else:
+        SCHEMA_ISSUES.pop(table, None)
+    return df
 
-def load_attendance():
-    if os.path.exists(ATTENDANCE_PATH):
-        df = pd.read_csv(ATTENDANCE_PATH, dtype=str)
-        for col in ATTENDANCE_COLUMNS:
-            if col not in df.columns:
-                df[col] = ""
-        return df
-    return pd.DataFrame(columns=ATTENDANCE_COLUMNS)
+def _load_table(path, columns, schema, table, order=None):
+    # Copy-on-write: the caller's frame shares buffers with the snapshot until it modifies a column
+    return _cached_table(path, columns, schema, table, order).copy(deep=False)
+
+def _store_table(df, path, columns, schema, table, order=None):
+    # Writes the CSV atomically, then publishes its typed snapshot so other sessions switch without reparsing
+    df = apply_schema(df.copy(deep=False), columns, schema, table)
+    if order:
+        df = df.sort_values(order, kind="stable", ignore_index=True)
+    _atomic_write(path, lambda tmp: to_storage(df, schema).to_csv(tmp, index=False))
+    version, issues = file_version(path), dict(SCHEMA_ISSUES.get(table, {}))
+    publish_snapshot(table, df, version, issues)
+    tenant_cache().put(COMPANY_ID, table, version, open_snapshot(table, version) or (df, issues))
+    return df
+
+def load_employees():
+    return _load_table(EMPLOYEES_PATH, EMPLOYEE_COLUMNS, EMPLOYEE_SCHEMA, "employees")
+
+def save_employees(df, salary_effective=None):
+    # Salary changes are also kept as effective-dated history (see record_salary_revisions)
+    before = load_employees()
+    journal_changes("employees", before, df)
+    df = _store_table(df, EMPLOYEES_PATH, EMPLOYEE_COLUMNS, EMPLOYEE_SCHEMA, "employees")
+    record_salary_revisions(before, df, salary_effective)
+    return df
 
-def save_attendance(df):
-    df.to_csv(ATTENDANCE_PATH, index=False)
+def load_attendance():
+    # Always ordered by (date, ecode) — see attendance_range() for date slicing
+    return _load_table(ATTENDANCE_PATH, ATTENDANCE_COLUMNS, ATTENDANCE_SCHEMA, "attendance", ATTENDANCE_ORDER)
+
+def save_attendance(df, touched=None):
+    # `touched` holds the rows written by this edit; derived stores refresh only their months
+    last = closed_through()
+    if last is not None and (pd.to_datetime(df["date"], errors="coerce", format="ISO8601") <= pd.Timestamp(last)).any():
+        raise ValueError(f"Attendance up to {last:%d %b %Y} is closed and archived")
+    journal_changes("attendance", load_attendance(), df, touched)
+    df     = _store_table(df, ATTENDANCE_PATH, ATTENDANCE_COLUMNS, ATTENDANCE_SCHEMA, "attendance", ATTENDANCE_ORDER)
+    months = None if touched is None else pd.to_datetime(touched["date"], errors="coerce", format="ISO8601").dt.strftime("%Y-%m").dropna().unique()
+    refresh_day_index(df)
+    refresh_attendance_cube(df, months)
+    refresh_exception_index(df, touched)
+    return df
 
 def load_leaves():
-    if os.path.exists(LEAVES_PATH):
-        df = pd.read_csv(LEAVES_PATH, dtype=str)
-        for col in LEAVE_COLUMNS:
-            if col not in df.columns:
-                df[col] = ""
-        return df
-    return pd.DataFrame(columns=LEAVE_COLUMNS)
+    return _load_table(LEAVES_PATH, LEAVE_COLUMNS, LEAVE_SCHEMA, "leaves")
 
 def save_leaves(df):
-    df.to_csv(LEAVES_PATH, index=False)
+    # Approving or rejecting a leave re-reconciles just the attendance days it covers
+    before = load_leaves()
+    journal_changes("leaves", before, df)
+    df = _store_table(df, LEAVES_PATH, LEAVE_COLUMNS, LEAVE_SCHEMA, "leaves")
+    reconcile_leave_changes(before, df)
+    return df
 
 # Bootstrap empty files
 for _path, _cols in [(EMPLOYEES_PATH, EMPLOYEE_COLUMNS),
@@ -259,10 +578,8 @@ for _path, _cols in [(EMPLOYEES_PATH, EMPLOYEE_COLUMNS),
         pd.DataFrame(columns=_cols).to_csv(_path, index=False)
 
 
-def parse_time(t_str):
-    if pd.isna(t_str) or str(t_str).strip() == "":
-        return None
-    t_str = str(t_str).strip()
+@lru_cache(maxsize=4096)
+def _parse_time_str(t_str):
     for fmt in ["%H:%M", "%H:%M:%S", "%I:%M %p", "%I:%M%p"]:
         try:
             return datetime.strptime(t_str, fmt).time()
@@ -270,10 +587,265 @@ def parse_time(t_str):
             pass
     return None
 
+def parse_time(t_str):
+    if pd.isna(t_str) or str(t_str).strip() == "":
+        return None
+    return _parse_time_str(str(t_str).strip())
+
 def time_to_minutes(t):
     return None if t is None else t.hour * 60 + t.minute
 
-def calculate_working_hours(in_time_str, out_time_str, shift_name, config):
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  SALARY FORMULA  (salary_components compiled into a dependency-ordered graph)
+# ══════════════════════════════════════════════════════════════════════════════
+
+# Built-in components keep the register columns (earned_<key>) and employee master columns they always had;
+# any other component is keyed by its slugged name and read from a master column of that name if there is one
+COMPONENT_KEYS    = {"Basic": "basic", "HRA": "hra", "Conveyance Allowance": "conveyance", "Special Allowance": "special",
+                     "Medical Allowance": "medical", "Food Allowance": "food"}
+COMPONENT_COLUMNS = {"basic": "basic", "hra": "hra", "conveyance": "conveyance", "special": "special_allowance",
+                     "medical": "medical_allowance", "food": "food_allowance"}
+GROSS_KEY         = "gross"      # `percentage_of: Gross` refers to the employee's gross_salary
+
+@dataclass(frozen=True)
+class Component:
+    name:    str
+    key:     str
+    column:  str      # employee master column holding the monthly amount
+    kind:    str      # fixed | percentage | calculated
+    pct:     float    # percentage components: value% of `of`
+    of:      str
+    amount:  float    # fixed components: default monthly amount when the master has no such column
+    taxable: bool
+
+def component_key(name):
+    name = str(name or "").strip()
+    return COMPONENT_KEYS.get(name) or re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")
+
+def compile_formula(components):
+    # Enabled components in evaluation order. The one "calculated" component is the residual of gross_salary
+    # after every other component, so it depends on all of them. Raises ValueError on a broken definition.
+    comps, refs = {}, {}
+    for c in components:
+        if not c.get("enabled", True):
+            continue
+        key, kind = component_key(c.get("name")), c.get("type", "fixed")
+        if not key:
+            raise ValueError("Every salary component needs a name")
+        if key in comps or key == GROSS_KEY:
+            raise ValueError(f"Duplicate salary component: {c['name']}")
+        if kind not in ("fixed", "percentage", "calculated"):
+            raise ValueError(f"{c['name']}: unknown component type '{kind}'")
+        comps[key] = Component(name=str(c["name"]).strip(), key=key, column=COMPONENT_COLUMNS.get(key, key), kind=kind,
+                               pct=sf(c.get("value")) if kind == "percentage" else 0.0,
+                               of=component_key(c.get("percentage_of", "Basic")) if kind == "percentage" else "",
+                               amount=sf(c.get("value")) if kind == "fixed" else 0.0, taxable=bool(c.get("taxable", True)))
+        refs[key] = str(c.get("percentage_of", "Basic")).strip()
+    residual = [c.name for c in comps.values() if c.kind == "calculated"]
+    if len(residual) > 1:
+        raise ValueError(f"Only one calculated component is allowed: {', '.join(residual)}")
+    deps = {}
+    for k, c in comps.items():
+        if c.kind == "percentage" and c.of != GROSS_KEY and c.of not in comps:
+            raise ValueError(f"{c.name} is a percentage of '{refs[k]}', which is not an enabled component")
+        deps[k] = set(comps) - {k} if c.kind == "calculated" else {c.of} - {GROSS_KEY} if c.kind == "percentage" else set()
+    order = []
+    while len(order) < len(comps):
+        ready = [k for k in comps if k not in order and deps[k] <= set(order)]
+        if not ready:
+            stuck = [comps[k].name for k in comps if k not in order]
+            raise ValueError(f"Salary components depend on each other in a cycle: {' → '.join(stuck)}")
+        order.append(ready[0])
+    return tuple(comps[k] for k in order)
+
+def evaluate_formula(formula, emp):
+    # Monthly amount of every component for every employee of `emp`, one vectorized column per component
+    def col(name, default=0.0):
+        if name not in emp.columns:
+            return np.full(len(emp), default, dtype=float)
+        return pd.to_numeric(emp[name], errors="coerce").fillna(default).to_numpy(dtype=float)
+    gross, out = col("gross_salary"), {}
+    for c in formula:
+        if c.kind == "percentage":
+            out[c.key] = (gross if c.of == GROSS_KEY else out[c.of]) * c.pct / 100
+        elif c.kind == "calculated":
+            rest = np.sum(list(out.values()), axis=0) if out else 0.0
+            out[c.key] = np.where(gross > 0, np.maximum(gross - rest, 0.0), col(c.column))
+        else:
+            out[c.key] = col(c.column, c.amount)
+    return pd.DataFrame(out, index=emp.index)
+
+def formula_columns(formula):
+    return list(dict.fromkeys(c.column for c in formula if c.kind != "percentage"))
+
+
+# ── Income tax regimes (config["tds"]["regimes"]) ─────────────────────────────
+@dataclass(frozen=True)
+class TaxRegime:
+    standard_deduction: float
+    slabs:              tuple     # (upper limit of annual taxable income or inf, rate %), ascending
+    rebate_limit:       float     # section 87A: no tax up to this taxable income ...
+    rebate_max:         float     # ... by a rebate of at most this much
+    deduction_80c:      float     # cap on employee PF counted as a deduction (0 where the regime allows none)
+
+def compile_tax_regimes(regimes):
+    out = {}
+    for name, r in regimes.items():
+        slabs = sorted((np.inf if up in (None, "") else sf(up), sf(rate)) for up, rate in r.get("slabs", []))
+        if not slabs or slabs[-1][0] != np.inf:
+            slabs.append((np.inf, slabs[-1][1] if slabs else 0.0))
+        out[str(name).lower()] = TaxRegime(sf(r.get("standard_deduction")), tuple(slabs), sf(r.get("rebate_limit")),
+                                           sf(r.get("rebate_max")), sf(r.get("deduction_80c")))
+    return out
+
+def income_tax(taxable, regime, cess_pct=0.0):
+    # Annual tax (with cess) on an array of annual taxable incomes, after the standard deduction
+    income, tax, lo = np.maximum(np.asarray(taxable, dtype=float) - regime.standard_deduction, 0.0), 0.0, 0.0
+    for hi, rate in regime.slabs:
+        tax = tax + np.clip(income - lo, 0.0, hi - lo) * rate / 100
+        lo  = hi
+    tax = np.where(income <= regime.rebate_limit, np.maximum(tax - regime.rebate_max, 0.0), tax)
+    return tax * (1 + cess_pct / 100)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  COMPILED RULES  (built once per config.json content hash)
+# ══════════════════════════════════════════════════════════════════════════════
+
+YES_VALUES = frozenset(["yes","true","1","y"])
+
+@dataclass(frozen=True)
+class RuleSet:
+    version:           str
+    shifts:            MappingProxyType   # shift name -> (start minute, end minute)
+    default_shift:     str
+    grace:             int
+    ot_threshold:      int
+    week_off:          str
+    weekday_working:   tuple              # Monday..Sunday -> bool
+    holidays:          tuple              # (YYYY-MM-DD, name, location or "All")
+    sandwich_rule:     bool
+    min_days_per_week: int
+    pf_enabled:        bool
+    pf_employee_pct:   float
+    pf_employer_pct:   float
+    eps_pct:           float
+    pf_on_basic:       bool
+    pf_cap_15000:      bool
+    esic_enabled:      bool
+    esic_employee_pct: float
+    esic_employer_pct: float
+    esic_ceiling:      float
+    ot_enabled:        bool
+    ot_multiplier:     float
+    ot_on_basic:       bool
+    paid_leave_types:  frozenset          # leave types (PL / CL / SL ...) that count as paid days
+    formula:           tuple              # salary Components in evaluation order
+    tds_enabled:       bool
+    tds_regime:        str                # default regime for employees without a tax_regime
+    tds_regimes:       MappingProxyType   # regime -> TaxRegime
+    tds_cess_pct:      float
+
+    @property
+    def payroll_version(self):
+        # Only the settings that change a payroll result; a company rename does not dirty every row
+        keys = (self.weekday_working, self.holidays, self.pf_enabled, self.pf_employee_pct, self.pf_employer_pct,
+                self.eps_pct, self.pf_on_basic, self.pf_cap_15000, self.esic_enabled, self.esic_employee_pct,
+                self.esic_employer_pct, self.esic_ceiling, self.ot_enabled, self.ot_multiplier, self.ot_on_basic,
+                tuple(sorted(self.paid_leave_types)), self.formula,
+                self.tds_enabled, self.tds_regime, tuple(sorted(self.tds_regimes.items())), self.tds_cess_pct)
+        return hashlib.sha1(repr(keys).encode()).hexdigest()[:12]
+
+def _build_rules(config, version):
+    shifts = {}
+    for s in config["shifts"]["fixed"]:
+        start, end = time_to_minutes(parse_time(s.get("start"))), time_to_minutes(parse_time(s.get("end")))
+        if start is not None and end is not None:
+            shifts[s["name"]] = (start, end)
+    att, pf, esic, ot = config["attendance"], config["pf"], config["esic"], config["overtime"]
+    tds = config.get("tds", {})
+    week_off = att.get("week_off", "Sunday")
+    return RuleSet(
+        version=version, shifts=MappingProxyType(shifts),
+        default_shift=config["shifts"]["fixed"][0]["name"] if config["shifts"]["fixed"] else "Open Shift",
+        grace=si(config["shifts"]["grace_period_minutes"]), ot_threshold=si(config["shifts"]["overtime_threshold_minutes"]),
+        week_off=week_off, weekday_working=tuple(d != week_off for d in WEEKDAYS),
+        holidays=tuple(sorted((d.strftime("%Y-%m-%d"), str(h.get("name","")), str(h.get("location") or "All"))
+                              for h in config.get("holidays", [])
+                              for d in [pd.to_datetime(h.get("date"), errors="coerce")] if pd.notna(d))),
+        sandwich_rule=bool(att.get("sandwich_rule")), min_days_per_week=si(att.get("min_days_per_week"), 3),
+        pf_enabled=bool(pf["enabled"]), pf_employee_pct=sf(pf["employee_percentage"]), pf_employer_pct=sf(pf["employer_percentage"]),
+        eps_pct=sf(pf["eps_percentage"]), pf_on_basic=pf["pf_base"] == "Basic", pf_cap_15000=bool(pf["cap_at_15000"]),
+        esic_enabled=bool(esic["enabled"]), esic_employee_pct=sf(esic["employee_percentage"]),
+        esic_employer_pct=sf(esic["employer_percentage"]), esic_ceiling=sf(esic["wage_ceiling"]),
+        ot_enabled=bool(ot["enabled"]), ot_multiplier=sf(ot["rate_multiplier"], 1.5), ot_on_basic=ot["calculation_base"] == "Basic",
+        paid_leave_types=frozenset(lt.upper() for lt, c in config.get("leave", {}).items() if c.get("paid", True)),
+        formula=compile_formula(config.get("salary_components", {}).get("components", [])),
+        tds_enabled=bool(tds.get("enabled")), tds_regime=str(tds.get("default_regime", "new")).lower(),
+        tds_regimes=MappingProxyType(compile_tax_regimes(tds.get("regimes") or DEFAULT_CONFIG["tds"]["regimes"])),
+        tds_cess_pct=sf(tds.get("cess_percentage", DEFAULT_CONFIG["tds"]["cess_percentage"])),
+    )
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def _compiled_rules(version, config_json):
+    return _build_rules(json.loads(config_json), version)
+
+def compile_rules(config):
+    raw = json.dumps(config, sort_keys=True, default=str)
+    return _compiled_rules(hashlib.sha1(raw.encode()).hexdigest()[:12], raw)
+
+def load_rules():
+    # Keyed on file content, so any save_config() yields a fresh RuleSet on the next call
+    return compile_rules(load_config())
+
+def _as_rules(rules):
+    return compile_rules(rules) if isinstance(rules, dict) else rules
+
+
+# ── Working-day calendars ─────────────────────────────────────────────────────
+@st.cache_resource(max_entries=64, show_spinner=False)
+def _calendar_table(version, year, location, _rules):
+    days  = pd.date_range(date(year, 1, 1), date(year, 12, 31), freq="D")
+    names = defaultdict(list)
+    for d, name, loc in _rules.holidays:
+        if loc in ("All", location) and d.startswith(str(year)):
+            names[d].append(name)
+    week_off = ~np.array(_rules.weekday_working)[days.weekday]
+    holiday  = days.strftime("%Y-%m-%d").isin(list(names))
+    return pd.DataFrame({
+        "day":          pd.Categorical(np.array(WEEKDAYS)[days.weekday], categories=WEEKDAYS),
+        "week_off":     week_off,
+        "holiday":      holiday,
+        "holiday_name": [", ".join(names.get(d, [])) for d in days.strftime("%Y-%m-%d")],
+        "working":      ~week_off & ~holiday,
+    }, index=days.rename("date"))
+
+def calendar_table(rules, year, location=""):
+    # One row per day of the year; shared (read-only) by payroll, sandwich rule and analytics
+    return _calendar_table(rules.version, int(year), str(location or ""), rules)
+
+def calendar_flags(rules, dates, location=""):
+    # Vectorized lookup of week_off / holiday / working flags for an arbitrary date column
+    dates = pd.to_datetime(pd.Series(dates)).dt.normalize()
+    years = sorted(dates.dt.year.dropna().unique().astype(int))
+    if not years:
+        return pd.DataFrame({"week_off": False, "holiday": False, "working": False}, index=dates.index)
+    cal = pd.concat([calendar_table(rules, y, location) for y in years])
+    out = cal.reindex(dates.to_numpy())[["week_off","holiday","working"]].fillna(False).astype(bool)
+    out.index = dates.index
+    return out
+
+def month_calendar(rules, year, month, location=""):
+    cal = calendar_table(rules, year, location)
+    return cal[cal.index.month == int(month)]
+
+def working_days_in_month(rules, year, month, location=""):
+    return int(month_calendar(rules, year, month, location)["working"].sum())
+
+
+def calculate_working_hours(in_time_str, out_time_str, shift_name, rules):
+    rules  = _as_rules(rules)
     result = {"working_hours": 0.0, "overtime_hours": 0.0,
               "late_entry_minutes": 0, "early_going_minutes": 0, "status": "Present"}
     in_t  = parse_time(in_time_str)
@@ -291,114 +863,901 @@ def calculate_working_hours(in_time_str, out_time_str, shift_name, config):
         out_mins += 24 * 60
     actual_work_mins = out_mins - in_mins
 
-    grace       = config["shifts"]["grace_period_minutes"]
-    ot_threshold= config["shifts"]["overtime_threshold_minutes"]
-    shift_config= next((s for s in config["shifts"]["fixed"] if s["name"] == shift_name), None)
-
-    if shift_config is None or shift_name == "Open Shift":
+    shift_times = rules.shifts.get(shift_name)
+    if shift_times is None or shift_name == "Open Shift":
         result["working_hours"] = round(actual_work_mins / 60, 2)
         return result
 
-    shift_start = time_to_minutes(parse_time(shift_config["start"]))
-    shift_end   = time_to_minutes(parse_time(shift_config["end"]))
+    shift_start, shift_end = shift_times
 
-    if in_mins > shift_start + grace:
+    if in_mins > shift_start + rules.grace:
         result["late_entry_minutes"] = in_mins - shift_start
     if out_mins < shift_end:
         result["early_going_minutes"] = shift_end - out_mins
-    if out_mins > shift_end + ot_threshold:
+    if out_mins > shift_end + rules.ot_threshold:
         result["overtime_hours"] = round((out_mins - shift_end) / 60, 2)
 
     result["working_hours"] = round(actual_work_mins / 60, 2)
     return result
 
-def apply_sandwich_rule(df_emp, config):
-    if not config["attendance"]["sandwich_rule"]:
+def apply_sandwich_rule(df_emp, rules, location=""):
+    rules = _as_rules(rules)
+    if not rules.sandwich_rule:
         return df_emp
     df = df_emp.copy()
     df["date"] = pd.to_datetime(df["date"])
     df = df.sort_values("date").reset_index(drop=True)
-    week_off = config["attendance"]["week_off"]
-    min_days = config["attendance"]["min_days_per_week"]
-
-    for i in range(1, len(df) - 1):
-        if df.loc[i, "day"] == week_off:
-            if df.loc[i-1, "status"] == "Absent" and df.loc[i+1, "status"] == "Absent":
-                df.loc[i, "status"]  = "Absent (Sandwich)"
-                df.loc[i, "remarks"] = "Sandwich Rule Applied"
-
-    df["week"] = df["date"].dt.isocalendar().week
-    for _, wdf in df.groupby("week"):
-        wdays = wdf[wdf["day"] != week_off]
-        if (wdays["status"] == "Present").sum() < min_days:
-            for idx in wdays[wdays["status"] == "Present"].index:
-                df.loc[idx, "remarks"] = str(df.loc[idx, "remarks"]) + " | Low Week Attendance"
+    min_days = rules.min_days_per_week
+    off      = ~calendar_flags(rules, df["date"], location)["working"]
+
+    # A week off / holiday between two absences is itself counted absent
+    absent   = df["status"] == "Absent"
+    sandwich = off & absent.shift(1, fill_value=False) & absent.shift(-1, fill_value=False)
+    df["status"]  = df["status"].astype(object).where(~sandwich, "Absent (Sandwich)")
+    df["remarks"] = df["remarks"].astype(object).where(~sandwich, "Sandwich Rule Applied")
+
+    iso      = df["date"].dt.isocalendar()
+    present  = (df["status"] == "Present") & ~off
+    low_week = present & (present.groupby([iso["year"], iso["week"]]).transform("sum") < min_days)
+    df.loc[low_week, "remarks"] = df.loc[low_week, "remarks"].astype(str) + " | Low Week Attendance"
     return df
 
-def calculate_payroll(emp_row, present_days, total_working_days, overtime_hours, config):
-    cfg_pf, cfg_esic, cfg_ot = config["pf"], config["esic"], config["overtime"]
-
-    basic    = float(emp_row.get("basic",            0) or 0)
-    hra      = float(emp_row.get("hra",              0) or 0)
-    conv     = float(emp_row.get("conveyance",       0) or 0)
-    special  = float(emp_row.get("special_allowance",0) or 0)
-    medical  = float(emp_row.get("medical_allowance",0) or 0)
-    food     = float(emp_row.get("food_allowance",   0) or 0)
-    gross    = basic + hra + conv + special + medical + food
-
-    ratio         = present_days / total_working_days if total_working_days > 0 else 0
-    earned_gross  = gross * ratio
-    earned_basic  = basic   * ratio
-    earned_hra    = hra     * ratio
-    earned_conv   = conv    * ratio
-    earned_special= special * ratio
-    earned_medical= medical * ratio
-    earned_food   = food    * ratio
-
-    ot_pay = 0.0
-    if cfg_ot["enabled"] and overtime_hours > 0:
-        base_for_ot = earned_basic if cfg_ot["calculation_base"] == "Basic" else earned_gross
-        hourly_rate = base_for_ot / (26 * 8)
-        ot_pay      = hourly_rate * overtime_hours * cfg_ot["rate_multiplier"]
-
-    pf_employee = pf_employer = eps = 0.0
-    if cfg_pf["enabled"] and str(emp_row.get("pf_applicable","Yes")).lower() in ["yes","true","1","y"]:
-        pf_base = earned_basic if cfg_pf["pf_base"] == "Basic" else earned_gross
-        if cfg_pf["cap_at_15000"]:
-            pf_base = min(pf_base, 15000 * ratio)
-        pf_employee = round(pf_base * cfg_pf["employee_percentage"] / 100, 2)
-        pf_employer = round(pf_base * cfg_pf["employer_percentage"] / 100, 2)
-        eps         = round(pf_base * cfg_pf["eps_percentage"]       / 100, 2)
-
-    esic_employee = esic_employer = 0.0
-    if cfg_esic["enabled"] and str(emp_row.get("esic_applicable","No")).lower() in ["yes","true","1","y"]:
-        if gross <= cfg_esic["wage_ceiling"]:
-            esic_employee = round(earned_gross * cfg_esic["employee_percentage"] / 100, 2)
-            esic_employer = round(earned_gross * cfg_esic["employer_percentage"] / 100, 2)
+def payroll_frame(emp, present_days, total_working_days, overtime_hours, rules, paid_leave_days=0):
+    # One register row per employee of `emp`, evaluated column-wise; the day / hour arguments are scalars
+    # or sequences aligned with `emp`
+    rules = _as_rules(rules)
+    n     = len(emp)
+    def arr(v):
+        return np.broadcast_to(np.asarray(pd.to_numeric(v, errors="coerce"), dtype=float), (n,))
+    present, wd, ot, paid = (np.nan_to_num(arr(v)) for v in (present_days, total_working_days, overtime_hours, paid_leave_days))
+    def flag(col, default):
+        if col not in emp.columns:
+            return np.full(n, default in YES_VALUES)
+        return emp[col].astype(str).str.lower().isin(YES_VALUES).to_numpy()
+
+    amounts = evaluate_formula(rules.formula, emp)
+    gross   = amounts.sum(axis=1).to_numpy(dtype=float)
+    ratio   = np.where(wd > 0, (present + paid) / np.where(wd > 0, wd, 1), 0.0)
+    earned  = amounts.mul(ratio, axis=0)
+    earned_gross = gross * ratio
+    earned_basic = earned["basic"].to_numpy() if "basic" in earned.columns else np.zeros(n)
+
+    ot_pay = np.zeros(n)
+    if rules.ot_enabled:
+        base_for_ot = earned_basic if rules.ot_on_basic else earned_gross
+        ot_pay      = np.where(ot > 0, base_for_ot / (26 * 8) * ot * rules.ot_multiplier, 0.0)
+
+    pf_employee = pf_employer = eps = np.zeros(n)
+    if rules.pf_enabled:
+        pf_base = earned_basic if rules.pf_on_basic else earned_gross
+        if rules.pf_cap_15000:
+            pf_base = np.minimum(pf_base, 15000 * ratio)
+        on = flag("pf_applicable", "yes")
+        pf_employee = np.where(on, np.round(pf_base * rules.pf_employee_pct / 100, 2), 0.0)
+        pf_employer = np.where(on, np.round(pf_base * rules.pf_employer_pct / 100, 2), 0.0)
+        eps         = np.where(on, np.round(pf_base * rules.eps_pct         / 100, 2), 0.0)
+
+    esic_employee = esic_employer = np.zeros(n)
+    if rules.esic_enabled:
+        on = flag("esic_applicable", "no") & (gross <= rules.esic_ceiling)
+        esic_employee = np.where(on, np.round(earned_gross * rules.esic_employee_pct / 100, 2), 0.0)
+        esic_employer = np.where(on, np.round(earned_gross * rules.esic_employer_pct / 100, 2), 0.0)
 
     total_deductions = pf_employee + esic_employee
-    net_pay          = round(earned_gross + ot_pay - total_deductions, 2)
-
-    return {
-        "ecode": emp_row.get("ecode",""), "name": emp_row.get("name",""),
-        "present_days": present_days, "gross_salary": round(gross, 2),
-        "earned_basic": round(earned_basic,2), "earned_hra": round(earned_hra,2),
-        "earned_conveyance": round(earned_conv,2), "earned_special": round(earned_special,2),
-        "earned_medical": round(earned_medical,2), "earned_food": round(earned_food,2),
-        "earned_gross": round(earned_gross,2), "overtime_hours": round(overtime_hours,2),
-        "overtime_pay": round(ot_pay,2), "pf_employee": pf_employee, "pf_employer": pf_employer,
+    text = lambda c: emp[c].astype(object).where(emp[c].notna(), "").astype(str).to_numpy() if c in emp.columns else np.full(n, "")
+    return pd.DataFrame({
+        "ecode": text("ecode"), "name": text("name"), "department": text("department"),
+        "present_days": present.astype(int), "paid_leave_days": paid.astype(int), "working_days": wd.astype(int),
+        "gross_salary": gross.round(2),
+        **{f"earned_{k}": earned[k].to_numpy().round(2) for k in earned.columns},
+        "earned_gross": earned_gross.round(2), "overtime_hours": ot.round(2),
+        "overtime_pay": ot_pay.round(2), "pf_employee": pf_employee, "pf_employer": pf_employer,
         "eps": eps, "esic_employee": esic_employee, "esic_employer": esic_employer,
-        "total_deductions": round(total_deductions,2), "net_pay": net_pay
+        "total_deductions": total_deductions.round(2), "net_pay": (earned_gross + ot_pay - total_deductions).round(2),
+    })
+
+def calculate_payroll(emp_row, present_days, total_working_days, overtime_hours, rules, paid_leave_days=0):
+    # Single-employee form of payroll_frame
+    return payroll_frame(pd.DataFrame([dict(emp_row)]), present_days, total_working_days, overtime_hours,
+                         rules, paid_leave_days).iloc[0].to_dict()
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  INCREMENTAL PAYROLL
+# ══════════════════════════════════════════════════════════════════════════════
+
+PAYROLL_INPUT_ATTENDANCE = ["date","status","overtime_hours"]
+PAYROLL_INPUT_EMPLOYEE   = ["name","location","pf_applicable","esic_applicable", *SALARY_FIELDS]
+
+def payroll_fingerprints(active, month_att, rules, paid_leave=None):
+    # One hash per employee over their month's attendance, paid leave, salary fields and payroll-relevant config
+    row_h = pd.util.hash_pandas_object(month_att[PAYROLL_INPUT_ATTENDANCE], index=False)
+    att_h = pd.Series(row_h.to_numpy(), index=month_att["ecode"].to_numpy()).groupby(level=0).sum().astype(str)
+    cols  = list(dict.fromkeys([*PAYROLL_INPUT_EMPLOYEE, *(c for c in formula_columns(rules.formula) if c in active.columns)]))
+    emp_h = pd.Series(pd.util.hash_pandas_object(active[cols], index=False).to_numpy(), index=active.index).astype(str)
+    fp    = active["ecode"].map(att_h).fillna("0") + ":" + emp_h + ":" + rules.payroll_version
+    if paid_leave is not None and len(paid_leave):
+        # Only employees with paid leave carry the count, so leave elsewhere leaves everyone else's hash alone
+        days = active["ecode"].map(paid_leave).fillna(0).astype(int)
+        fp   = fp.where(days == 0, fp + ":" + days.astype(str))
+    return fp
+
+def run_payroll(active, month_att, rules, year, month, previous=None, force=False, leaves_df=None):
+    # Recomputes only employees whose inputs changed since `previous` and merges them into it, then posts
+    # arrears for earlier periods, taking back any already paid for this one (its rerun pays the revision).
+    # Salaries are those in force for the period, not today's master values.
+    active     = salary_as_of(active, month_bounds(year, month)[1])
+    paid_leave = paid_leave_days(active, month_att, rules, year, month, leave_intervals(leaves_df))
+    fp = payroll_fingerprints(active, month_att, rules, paid_leave)
+    if previous is not None and not force and "input_hash" in previous.columns:
+        stored = active["ecode"].map(previous.drop_duplicates("ecode", keep="last").set_index("ecode")["input_hash"])
+        dirty  = (stored != fp).to_numpy()
+    else:
+        dirty  = np.ones(len(active), dtype=bool)
+
+    todo      = active[dirty]
+    present   = month_att[month_att["status"] == "Present"].groupby("ecode").size()
+    ot_hours  = month_att.groupby("ecode")["overtime_hours"].sum()
+    wd_by_loc = {loc: working_days_in_month(rules, year, month, loc) for loc in todo["location"].astype(str).unique()}
+    codes     = todo["ecode"]
+    fresh = payroll_frame(todo, codes.map(present).fillna(0), todo["location"].astype(str).map(wd_by_loc),
+                          codes.map(ot_hours).fillna(0.0), rules, codes.map(paid_leave).fillna(0)) if len(todo) else pd.DataFrame()
+    if not fresh.empty:
+        fresh["input_hash"] = fp[dirty].to_numpy()
+
+    kept = previous[previous["ecode"].isin(active["ecode"][~dirty])] if previous is not None and dirty.sum() < len(active) else None
+    register = pd.concat([kept, fresh], ignore_index=True) if kept is not None else fresh
+    if not register.empty:
+        register = register.drop_duplicates("ecode", keep="last").set_index("ecode").reindex(active["ecode"]).reset_index()
+
+    changes = fresh[["ecode","name","net_pay"]].copy() if not fresh.empty else pd.DataFrame(columns=["ecode","name","net_pay"])
+    if previous is not None and not previous.empty and not changes.empty:
+        old = previous.drop_duplicates("ecode", keep="last").set_index("ecode")["net_pay"]
+        changes["previous_net_pay"] = changes["ecode"].map(old)
+        changes["change"] = np.where(changes["previous_net_pay"].isna(), "New", "Recalculated")
+    removed = sorted(set(previous["ecode"]) - set(active["ecode"])) if previous is not None and not previous.empty else []
+
+    arrears  = compute_arrears(active, rules, year, month)
+    recovered= recovered_arrears(active, year, month)
+    if not recovered.empty:
+        arrears = pd.concat([arrears, recovered], ignore_index=True) if not arrears.empty else recovered
+    register = post_arrears(register, arrears)
+    if not register.empty and "arrears_net_pay" in register.columns:
+        before = register["ecode"].map(previous.drop_duplicates("ecode", keep="last").set_index("ecode")["arrears_net_pay"]) \
+                 if previous is not None and "arrears_net_pay" in previous.columns else pd.Series(0.0, index=register.index)
+        moved  = register[(register["arrears_net_pay"] - before.fillna(0)).abs() >= 0.01]
+        moved  = moved[~moved["ecode"].isin(changes["ecode"])]
+        if not moved.empty:
+            changes = pd.concat([changes, moved[["ecode","name","net_pay"]].assign(change="Arrears")], ignore_index=True)
+
+    # TDS depends on the whole financial year so far, so it is projected afresh for every row on each run
+    register = post_tds(register, compute_tds(register, active, rules, year, month) if rules.tds_enabled and not register.empty else None)
+    if not register.empty and "tds" in register.columns and previous is not None and not previous.empty:
+        before = register["ecode"].map(previous.drop_duplicates("ecode", keep="last").set_index("ecode")["tds"]) \
+                 if "tds" in previous.columns else pd.Series(0.0, index=register.index)
+        moved  = register[(register["tds"] - before.fillna(0)).abs() >= 0.01]
+        moved  = moved[~moved["ecode"].isin(changes["ecode"])]
+        if not moved.empty:
+            changes = pd.concat([changes, moved[["ecode","name","net_pay"]].assign(change="TDS")], ignore_index=True)
+    if not register.empty and not changes.empty:
+        changes["net_pay"] = changes["ecode"].map(register.set_index("ecode")["net_pay"])
+    return register, changes, removed, arrears
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  PAYROLL REGISTER STORE  (SQLite: every run kept, keyed by period / run_id / ecode)
+# ══════════════════════════════════════════════════════════════════════════════
+
+_PAYROLL_DDL = """
+CREATE TABLE IF NOT EXISTS payroll_runs (
+    period TEXT NOT NULL, run_id INTEGER NOT NULL, created_at TEXT, employees INTEGER, total_net REAL,
+    PRIMARY KEY (period, run_id));
+CREATE TABLE IF NOT EXISTS payroll_register (
+    period TEXT NOT NULL, run_id INTEGER NOT NULL, ecode TEXT NOT NULL, name TEXT, department TEXT,
+    PRIMARY KEY (period, run_id, ecode));
+CREATE INDEX IF NOT EXISTS ix_register_ecode ON payroll_register (ecode, period);
+CREATE VIEW IF NOT EXISTS current_register AS
+    SELECT r.* FROM payroll_register r
+    JOIN (SELECT period, MAX(run_id) AS run_id FROM payroll_runs GROUP BY period) l
+      ON r.period = l.period AND r.run_id = l.run_id;
+CREATE TABLE IF NOT EXISTS salary_history (
+    ecode TEXT NOT NULL, effective_from TEXT NOT NULL, recorded_at TEXT NOT NULL,
+    gross_salary REAL, basic REAL, hra REAL, conveyance REAL, special_allowance REAL, medical_allowance REAL, food_allowance REAL);
+CREATE INDEX IF NOT EXISTS ix_salary_history ON salary_history (ecode, effective_from);
+CREATE TABLE IF NOT EXISTS salary_arrears (
+    ecode TEXT NOT NULL, period TEXT NOT NULL, posted_period TEXT NOT NULL,
+    earned_gross REAL, overtime_pay REAL, pf_employee REAL, pf_employer REAL, eps REAL,
+    esic_employee REAL, esic_employer REAL, net_pay REAL,
+    PRIMARY KEY (ecode, period, posted_period));
+DROP TABLE IF EXISTS main.arrears_due;   -- stray copy of the compute_arrears temp table left by older builds
+CREATE TABLE IF NOT EXISTS closed_periods (
+    period TEXT PRIMARY KEY, closed_at TEXT NOT NULL, closed_by TEXT, attendance_rows INTEGER, archived_runs INTEGER);
+"""
+
+def period_key(year, month):
+    return f"{int(year):04d}-{int(month):02d}"
+
+def period_label(period):
+    y, m = period.split("-")
+    return f"{MONTHS[int(m)-1]} {y}"
+
+@contextmanager
+def sqlite_db(path, ddl, on_create=None):
+    fresh = not os.path.exists(path)
+    con   = sqlite3.connect(path)
+    try:
+        con.executescript(ddl)
+        if fresh and on_create:
+            on_create(con)
+        yield con
+        con.commit()
+    finally:
+        con.close()
+
+def payroll_db():
+    return sqlite_db(PAYROLL_DB_PATH, _PAYROLL_DDL, lambda con: _import_legacy_payroll_files(con))
+
+def _ensure_register_columns(con, df):
+    have = {r[1] for r in con.execute("PRAGMA table_info(payroll_register)")}
+    for col in df.columns:
+        if col not in have:
+            kind = "REAL" if pd.api.types.is_numeric_dtype(df[col]) else "TEXT"
+            con.execute(f'ALTER TABLE payroll_register ADD COLUMN "{col}" {kind}')
+
+def _write_run(con, period, df):
+    run_id = con.execute("SELECT COALESCE(MAX(run_id), 0) + 1 FROM payroll_runs WHERE period = ?", (period,)).fetchone()[0]
+    rows   = df.assign(period=period, run_id=run_id)
+    _ensure_register_columns(con, rows)
+    rows.to_sql("payroll_register", con, if_exists="append", index=False, chunksize=5000)
+    total  = float(pd.to_numeric(df["net_pay"], errors="coerce").sum()) if "net_pay" in df.columns else 0.0
+    con.execute("INSERT INTO payroll_runs VALUES (?, ?, ?, ?, ?)", (period, run_id, datetime.now().isoformat(timespec="seconds"), len(df), total))
+    return run_id
+
+def _import_legacy_payroll_files(con):
+    # One-off migration of the old loose payroll_{Month}_{Year}.csv files
+    for f in sorted(os.listdir(DATA_DIR)):
+        m = re.fullmatch(r"payroll_([A-Za-z]+)_(\d{4})\.csv", f)
+        if m and m.group(1) in MONTHS:
+            _write_run(con, period_key(m.group(2), MONTHS.index(m.group(1)) + 1), pd.read_csv(os.path.join(DATA_DIR, f), dtype={"ecode": str}))
+
+def save_payroll_run(year, month, df, arrears=None):
+    # `arrears` replaces the ledger of arrears posted into this period, in the same transaction as the run
+    period = period_key(year, month)
+    if is_period_closed(year, month):
+        raise ValueError(f"{period_label(period)} is closed")
+    with payroll_db() as con:
+        run_id = _write_run(con, period, df)
+        if arrears is not None:
+            con.execute("DELETE FROM salary_arrears WHERE posted_period = ?", (period,))
+            arrears[arrears["ecode"].isin(df["ecode"])][["ecode","period",*ARREAR_FIELDS]].assign(posted_period=period) \
+                .to_sql("salary_arrears", con, if_exists="append", index=False)
+        return run_id
+
+def load_payroll_register(year, month, run_id=None):
+    # Latest run for the period unless a specific run is asked for; None when the period was never run
+    period = period_key(year, month)
+    with payroll_db() as con:
+        if run_id is None:
+            run_id = con.execute("SELECT MAX(run_id) FROM payroll_runs WHERE period = ?", (period,)).fetchone()[0]
+        if run_id is None:
+            return None
+        df = pd.read_sql_query("SELECT * FROM payroll_register WHERE period = ? AND run_id = ?", con, params=(period, int(run_id)))
+    if df.empty and is_period_closed(year, month):      # a superseded run of a closed period lives in the archive
+        return archived_register(year, month, run_id)
+    return df.drop(columns=["period","run_id"]).dropna(axis=1, how="all")
+
+def latest_run_id(year, month):
+    with payroll_db() as con:
+        return con.execute("SELECT MAX(run_id) FROM payroll_runs WHERE period = ?", (period_key(year, month),)).fetchone()[0]
+
+# Registers computed or opened in this session, shared by the Run Payroll and Payslip tabs. The session's
+# TenantCache is bounded by size; an evicted register is simply read back from payroll.db on its next use,
+# and an entry is only a hit while its run is still the period's latest (another session may have rerun it).
+REGISTER_CACHE_MB = 32
+
+def register_cache():
+    cache = st.session_state.get("_registers")
+    if cache is None:
+        cache = st.session_state["_registers"] = TenantCache(REGISTER_CACHE_MB << 20)
+    if COMPANY_ID not in cache.budgets:
+        cache.set_budget(COMPANY_ID, REGISTER_CACHE_MB << 20)
+    return cache
+
+def cached_register(year, month):
+    run_id = latest_run_id(year, month)
+    if run_id is None:
+        return None
+    return register_cache().get(COMPANY_ID, period_key(year, month), run_id, lambda: load_payroll_register(year, month, run_id))
+
+def remember_register(year, month, run_id, df):
+    register_cache().put(COMPANY_ID, period_key(year, month), run_id, df)
+
+def payroll_runs():
+    with payroll_db() as con:
+        return pd.read_sql_query("SELECT * FROM payroll_runs ORDER BY period DESC, run_id DESC", con)
+
+def payroll_employee_history(ecode):
+    with payroll_db() as con:
+        return pd.read_sql_query("SELECT * FROM current_register WHERE ecode = ? ORDER BY period", con, params=(ecode,))
+
+def payroll_department_cost(start_period=None, end_period=None):
+    # Department-wise cost per period straight from SQL, without loading any register in full
+    with payroll_db() as con:
+        return pd.read_sql_query("""
+            SELECT period, COALESCE(NULLIF(department, ''), 'Unassigned') AS dept, COUNT(*) AS employees,
+                   SUM(earned_gross) AS earned_gross, SUM(overtime_pay) AS overtime_pay,
+                   SUM(pf_employer + esic_employer) AS employer_contrib,
+                   SUM(earned_gross + overtime_pay + pf_employer + esic_employer) AS total_cost,
+                   SUM(net_pay) AS net_pay
+            FROM current_register
+            WHERE period >= COALESCE(?, '0000-00') AND period <= COALESCE(?, '9999-99')
+            GROUP BY period, dept ORDER BY period, dept""", con, params=(start_period, end_period)).rename(columns={"dept": "department"})
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  SALARY HISTORY & ARREARS  (effective-dated revisions, past periods recomputed from stored day counts)
+# ══════════════════════════════════════════════════════════════════════════════
+
+SALARY_BASELINE         = "1900-01-01"      # effective date of the salary an employee had before any revision
+ARREARS_LOOKBACK_MONTHS = 12
+ARREAR_FIELDS           = ["earned_gross","overtime_pay","pf_employee","pf_employer","eps","esic_employee","esic_employer","net_pay"]
+
+def record_salary_revisions(before, after, effective_from=None):
+    # Revisions apply from the first of the month holding `effective_from` (default: this month).
+    # A new employee's salary, and the pre-revision salary of someone revised for the first time, are
+    # recorded as the baseline so earlier periods keep resolving to what was actually paid.
+    eff = pd.Timestamp(effective_from or date.today()).strftime("%Y-%m-01")
+    cur = after.drop_duplicates("ecode", keep="last").set_index("ecode")[SALARY_FIELDS].astype(float)
+    old = before.drop_duplicates("ecode", keep="last").set_index("ecode")[SALARY_FIELDS].astype(float).reindex(cur.index)
+    new = old.isna().all(axis=1)
+    revised = cur.index[~new & (cur.round(2) != old.round(2)).any(axis=1)]
+    if not new.any() and revised.empty:
+        return 0
+    now = datetime.now().isoformat(timespec="seconds")
+    with payroll_db() as con:
+        known = {r[0] for r in con.execute("SELECT DISTINCT ecode FROM salary_history")}
+        base  = [old.loc[[e for e in revised if e not in known]], cur[new & ~cur.index.isin(list(known))]]
+        rows  = pd.concat([pd.concat(base).assign(effective_from=SALARY_BASELINE),
+                           cur.loc[revised].assign(effective_from=eff)]).rename_axis("ecode").reset_index()
+        rows.assign(recorded_at=now)[["ecode","effective_from","recorded_at",*SALARY_FIELDS]] \
+            .to_sql("salary_history", con, if_exists="append", index=False)
+    return len(revised)
+
+def salary_history(ecode):
+    with payroll_db() as con:
+        return pd.read_sql_query("SELECT * FROM salary_history WHERE ecode = ? ORDER BY effective_from, recorded_at", con, params=(ecode,))
+
+def salary_as_of(emp, day, history=None):
+    # `emp` with its salary fields as in force on `day`; employees without history keep the master values.
+    # Pass `history` (every salary_history row, ordered) when resolving several days in a row.
+    day = pd.Timestamp(day).strftime("%Y-%m-%d")
+    if history is None:
+        with payroll_db() as con:
+            hist = pd.read_sql_query("SELECT * FROM salary_history WHERE effective_from <= ? ORDER BY effective_from, recorded_at",
+                                     con, params=(day,))
+    else:
+        hist = history[history["effective_from"] <= day]
+    if hist.empty:
+        return emp
+    hist = hist.drop_duplicates("ecode", keep="last").set_index("ecode")
+    hit  = emp["ecode"].isin(hist.index).to_numpy()
+    out  = emp.copy()
+    out.loc[hit, SALARY_FIELDS] = hist.loc[emp["ecode"][hit], SALARY_FIELDS].to_numpy()
+    return out
+
+def compute_arrears(emp, rules, year, month):
+    # Past periods whose latest run predates a salary revision effective for them are recomputed with the
+    # revised salary against the day counts stored on that run; the difference to what the run paid,
+    # less arrears already posted elsewhere, is due in (year, month).
+    current = period_key(year, month)
+    first   = str(pd.Period(current, freq="M") - ARREARS_LOOKBACK_MONTHS)
+    with payroll_db() as con:
+        revs = pd.read_sql_query("SELECT ecode, substr(effective_from, 1, 7) AS eff, recorded_at FROM salary_history "
+                                 "WHERE effective_from > ? AND effective_from < ?", con, params=(SALARY_BASELINE, f"{current}-01"))
+        runs = pd.read_sql_query("SELECT period, MAX(created_at) AS created_at FROM payroll_runs WHERE period >= ? AND period < ? "
+                                 "GROUP BY period", con, params=(first, current))
+        if revs.empty or runs.empty:
+            return pd.DataFrame(columns=["ecode","period",*ARREAR_FIELDS])
+        # A period with arrears on the ledger stays due after a rerun: the rerun nets them off (recovered_arrears),
+        # so dropping them here would leave the revision unpaid
+        ledger = pd.read_sql_query("SELECT DISTINCT ecode, period FROM salary_arrears WHERE period >= ? AND period < ? "
+                                   "AND posted_period != ?", con, params=(first, current, current))
+        if (revs.empty or runs.empty) and ledger.empty:
+            return pd.DataFrame(columns=["ecode","period",*ARREAR_FIELDS])
+        due = revs.merge(runs, how="cross")
+        due = due[(due["eff"] <= due["period"]) & (due["recorded_at"] > due["created_at"])]
+        due = pd.concat([due[["ecode","period"]], ledger]).drop_duplicates()
+        due = due[due["ecode"].isin(emp["ecode"])]
+        if due.empty:
+            return pd.DataFrame(columns=["ecode","period",*ARREAR_FIELDS])
+        # Plain INSERTs: to_sql only looks in sqlite_master, misses the temp table and would create a real one
+        con.execute("CREATE TEMP TABLE arrears_due (ecode TEXT, period TEXT)")
+        con.executemany("INSERT INTO arrears_due VALUES (?,?)", due.itertuples(index=False, name=None))
+        stored = pd.read_sql_query("SELECT r.* FROM current_register r JOIN arrears_due d ON r.ecode = d.ecode AND r.period = d.period", con)
+        history = pd.read_sql_query("SELECT h.* FROM salary_history h JOIN (SELECT DISTINCT ecode FROM arrears_due) d USING (ecode) "
+                                    "ORDER BY effective_from, recorded_at", con)
+        posted = pd.read_sql_query(f"SELECT ecode, period, {', '.join(f'SUM({f}) AS {f}' for f in ARREAR_FIELDS)} FROM salary_arrears "
+                                   "WHERE posted_period != ? GROUP BY ecode, period", con, params=(current,))
+    if stored.empty:
+        return pd.DataFrame(columns=["ecode","period",*ARREAR_FIELDS])
+    if "arrears_net_pay" in stored.columns:           # net_pay on a register includes arrears posted into it
+        stored["net_pay"] = stored["net_pay"] - stored["arrears_net_pay"].fillna(0)
+    if "tds" in stored.columns:                       # ... and is after TDS, which payroll_frame does not deduct
+        stored["net_pay"] = stored["net_pay"] + stored["tds"].fillna(0)
+    for c in ["paid_leave_days","overtime_hours","present_days","working_days"]:
+        stored[c] = pd.to_numeric(stored[c], errors="coerce").fillna(0) if c in stored.columns else 0
+    inputs = list(dict.fromkeys(["ecode","name","department","pf_applicable","esic_applicable", *SALARY_FIELDS,
+                                 *(c for c in formula_columns(rules.formula) if c in emp.columns)]))
+    out    = []
+    for period, part in stored.groupby("period"):
+        y, m = (int(x) for x in period.split("-"))
+        then = salary_as_of(emp[emp["ecode"].isin(part["ecode"])][inputs], month_bounds(y, m)[1], history).drop_duplicates("ecode")
+        days = part.drop(columns=inputs[1:], errors="ignore").merge(then, on="ecode")
+        if days.empty:
+            continue
+        redo = payroll_frame(days[inputs], days["present_days"], days["working_days"], days["overtime_hours"],
+                             rules, days["paid_leave_days"])
+        diff = redo[ARREAR_FIELDS] - days[ARREAR_FIELDS].astype(float).to_numpy()
+        out.append(diff.assign(ecode=days["ecode"].to_numpy(), period=period))
+    if not out:
+        return pd.DataFrame(columns=["ecode","period",*ARREAR_FIELDS])
+    arrears = pd.concat(out, ignore_index=True)
+    if not posted.empty:
+        prior = arrears[["ecode","period"]].merge(posted, how="left", on=["ecode","period"])[ARREAR_FIELDS].fillna(0)
+        arrears[ARREAR_FIELDS] = arrears[ARREAR_FIELDS].to_numpy() - prior.to_numpy()
+    arrears[ARREAR_FIELDS] = arrears[ARREAR_FIELDS].round(2)
+    return arrears[arrears[ARREAR_FIELDS].abs().max(axis=1) >= 0.01][["ecode","period",*ARREAR_FIELDS]].reset_index(drop=True)
+
+def recovered_arrears(emp, year, month):
+    # Arrears for (year, month) already paid in a later period. A rerun of the period pays the revised
+    # salary itself, so what was paid is taken back as negative arrears posted into the period.
+    period = period_key(year, month)
+    with payroll_db() as con:
+        paid = pd.read_sql_query(f"SELECT ecode, {', '.join(f'SUM({f}) AS {f}' for f in ARREAR_FIELDS)} FROM salary_arrears "
+                                 "WHERE period = ? AND posted_period != ? GROUP BY ecode", con, params=(period, period))
+    paid = paid[paid["ecode"].isin(emp["ecode"])]
+    paid[ARREAR_FIELDS] = -paid[ARREAR_FIELDS].astype(float)
+    return paid.assign(period=period)[["ecode","period",*ARREAR_FIELDS]].reset_index(drop=True)
+
+def post_arrears(register, arrears):
+    # Sets the arrears_* columns of a register and folds the arrears net into net_pay (idempotent across reruns)
+    cols = [f"arrears_{f}" for f in ARREAR_FIELDS]
+    if register.empty or (arrears.empty and not set(cols) & set(register.columns)):
+        return register
+    reg  = register.copy()
+    base = reg["net_pay"] - (reg["arrears_net_pay"].fillna(0) if "arrears_net_pay" in reg.columns else 0)
+    per  = arrears.groupby("ecode")[ARREAR_FIELDS].sum()
+    for f, c in zip(ARREAR_FIELDS, cols):
+        reg[c] = reg["ecode"].map(per[f]).fillna(0.0).round(2)
+    reg["net_pay"] = (base + reg["arrears_net_pay"]).round(2)
+    return reg
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  TDS  (income tax withheld monthly against a projection of the financial year)
+# ══════════════════════════════════════════════════════════════════════════════
+
+FY_START_MONTH = 4
+TDS_FIELDS     = ["taxable","tds","pf_employee"]
+
+def financial_year_periods(year, month):
+    # Periods of the financial year holding (year, month) that come before it, and how many come after it
+    done  = (int(month) - FY_START_MONTH) % 12
+    start = pd.Period(period_key(int(year) - (int(month) < FY_START_MONTH), FY_START_MONTH), freq="M")
+    return [str(start + i) for i in range(done)], 11 - done
+
+def taxable_columns(rules):
+    # Register columns that are taxable salary: taxable components, overtime and arrears paid with the period
+    return [f"earned_{c.key}" for c in rules.formula if c.taxable] + ["overtime_pay","arrears_earned_gross"]
+
+def tds_year_to_date(periods, rules):
+    # Per ecode over the latest runs of `periods`: taxable salary paid, TDS deducted and employee PF
+    if not periods:
+        return pd.DataFrame(columns=TDS_FIELDS, dtype=float)
+    with payroll_db() as con:
+        have = {r[1] for r in con.execute("PRAGMA table_info(payroll_register)")}
+        taxable = " + ".join(f'COALESCE("{c}", 0)' for c in taxable_columns(rules) if c in have) or "0"
+        tds, pf = ("COALESCE(tds, 0)" if "tds" in have else "0"), ("COALESCE(pf_employee, 0)" if "pf_employee" in have else "0")
+        return pd.read_sql_query(f"SELECT ecode, SUM({taxable}) AS taxable, SUM({tds}) AS tds, SUM({pf}) AS pf_employee "
+                                 f"FROM current_register WHERE period IN ({', '.join('?' * len(periods))}) GROUP BY ecode",
+                                 con, params=periods).set_index("ecode")
+
+def compute_tds(register, active, rules, year, month):
+    # This month's TDS per register row: tax on the projected annual taxable salary (paid so far this year, this
+    # month, and the full monthly taxable salary for every month left) less TDS already deducted, spread evenly
+    # over this and the remaining months. Each regime is taxed as one vectorized batch.
+    past, left = financial_year_periods(year, month)
+    num  = lambda df, cols: df.reindex(columns=cols).apply(pd.to_numeric, errors="coerce").fillna(0.0)
+    ytd  = num(tds_year_to_date(past, rules).reindex(register["ecode"]), TDS_FIELDS).to_numpy()
+    now  = num(register, taxable_columns(rules)).sum(axis=1).to_numpy()
+    pf   = num(register, ["pf_employee"])["pf_employee"].to_numpy()
+    emp  = active.drop_duplicates("ecode", keep="last").set_index("ecode").reindex(register["ecode"])
+    full = evaluate_formula(rules.formula, emp)[[c.key for c in rules.formula if c.taxable]].sum(axis=1).to_numpy()
+
+    annual    = ytd[:, 0] + now + full * left
+    annual_pf = ytd[:, 2] + pf * (left + 1)
+    default   = rules.tds_regime if rules.tds_regime in rules.tds_regimes else next(iter(rules.tds_regimes), "")
+    regime    = emp["tax_regime"].astype(str).str.lower() if "tax_regime" in emp.columns else pd.Series("", index=emp.index)
+    regime    = regime.where(regime.isin(list(rules.tds_regimes)), default).to_numpy()
+    tax = np.zeros(len(register))
+    for name, r in rules.tds_regimes.items():
+        hit = regime == name
+        if hit.any():
+            tax[hit] = income_tax(annual[hit] - np.minimum(annual_pf[hit], r.deduction_80c), r, rules.tds_cess_pct)
+    return pd.Series(np.round(np.maximum(tax - ytd[:, 1], 0.0) / (left + 1)), index=register.index)
+
+def post_tds(register, tds):
+    # Sets the tds column of a register and folds it into total_deductions and net_pay (idempotent across
+    # reruns); `tds` None takes TDS back out of a register that had it
+    if register.empty or (tds is None and "tds" not in register.columns):
+        return register
+    reg = register.copy()
+    old = reg["tds"].fillna(0.0) if "tds" in reg.columns else 0.0
+    reg["tds"] = 0.0 if tds is None else tds.round(2)
+    reg["total_deductions"] = (reg["total_deductions"] - old + reg["tds"]).round(2)
+    reg["net_pay"]          = (reg["net_pay"] + old - reg["tds"]).round(2)
+    return reg
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  ATTENDANCE CUBE  (month × department × shift × employee, refreshed on write)
+# ══════════════════════════════════════════════════════════════════════════════
+
+CUBE_KEYS     = ["month","department","shift","ecode"]
+CUBE_MEASURES = ["days","present","absent","sandwich","missing","half_day","on_leave",
+                 "late_days","late_minutes","early_minutes","ot_hours","work_hours"]
+_CUBE_DDL = """
+CREATE TABLE IF NOT EXISTS att_cube (
+    month TEXT NOT NULL, department TEXT NOT NULL, shift TEXT NOT NULL, ecode TEXT NOT NULL, name TEXT,
+    days INTEGER, present INTEGER, absent INTEGER, sandwich INTEGER, missing INTEGER, half_day INTEGER, on_leave INTEGER,
+    late_days INTEGER, late_minutes INTEGER, early_minutes INTEGER, ot_hours REAL, work_hours REAL,
+    PRIMARY KEY (month, department, shift, ecode));
+CREATE INDEX IF NOT EXISTS ix_cube_ecode ON att_cube (ecode, month);
+CREATE TABLE IF NOT EXISTS cube_meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+def analytics_db():
+    return sqlite_db(ANALYTICS_DB_PATH, _CUBE_DDL + _EXCEPTION_DDL + _DAY_INDEX_DDL)
+
+def _cube_source_stamp():
+    # Cube is valid for exactly this attendance + employee file version
+    return file_version(ATTENDANCE_PATH, EMPLOYEES_PATH)
+
+def _cube_rows(att, emp_df):
+    status = att["status"].astype(str)
+    rows = pd.DataFrame({
+        "month":         att["date"].dt.year * 100 + att["date"].dt.month,
+        "department":    att["ecode"].map(dict(zip(emp_df["ecode"], emp_df["department"].astype(str)))).fillna(""),
+        "shift":         att["shift"].astype(str),
+        "ecode":         att["ecode"],
+        "name":          att["name"],
+        "days":          1,
+        "present":       status.eq("Present"),
+        "absent":        status.eq("Absent"),
+        "sandwich":      status.eq("Absent (Sandwich)"),
+        "missing":       status.str.startswith("Missing"),
+        "half_day":      status.eq("Half Day"),
+        "on_leave":      status.eq("On Leave"),
+        "late_days":     att["late_entry_minutes"] > 0,
+        "late_minutes":  att["late_entry_minutes"].astype("int64"),
+        "early_minutes": att["early_going_minutes"].astype("int64"),
+        "ot_hours":      att["overtime_hours"].astype("float64"),
+        "work_hours":    att["working_hours"].astype("float64"),
+    })
+    cube = rows.groupby(CUBE_KEYS, sort=False).agg(name=("name","last"), **{m: (m, "sum") for m in CUBE_MEASURES}).reset_index()
+    cube["month"] = cube["month"].astype(int).map(lambda ym: f"{ym // 100:04d}-{ym % 100:02d}")
+    return cube
+
+def refresh_attendance_cube(att_df, months=None, emp_df=None):
+    # Rebuilds only the given months ("YYYY-MM"); everything when months is None or the cube is stale
+    with analytics_db() as con:
+        stamp = con.execute("SELECT value FROM cube_meta WHERE key = 'source'").fetchone()
+        if months is not None and stamp is None:
+            months = None
+        emp_df = load_employees() if emp_df is None else emp_df
+        if months is None:
+            # Closed months are never rebuilt from the hot table; a brand-new cube reads them from the archive once
+            last = closed_through()
+            con.execute("DELETE FROM att_cube WHERE month > ?", (last.strftime("%Y-%m") if last and stamp else "0000-00",))
+            cold = cold_attendance() if stamp is None and last else None
+            part = att_df if cold is None else pd.concat([cold, att_df], ignore_index=True)
+        else:
+            months = sorted(set(months))
+            con.executemany("DELETE FROM att_cube WHERE month = ?", [(m,) for m in months])
+            part = att_df[(att_df["date"].dt.year * 100 + att_df["date"].dt.month).isin([int(m.replace("-", "")) for m in months])]
+        if not part.empty:
+            _cube_rows(part, emp_df).to_sql("att_cube", con, if_exists="append", index=False, chunksize=5000)
+        con.execute("INSERT OR REPLACE INTO cube_meta VALUES ('source', ?)", (_cube_source_stamp(),))
+
+def _ensure_cube_fresh():
+    with analytics_db() as con:
+        stamp = con.execute("SELECT value FROM cube_meta WHERE key = 'source'").fetchone()
+    if stamp is None or stamp[0] != _cube_source_stamp():
+        refresh_attendance_cube(load_attendance())
+
+def attendance_cube(start_month=None, end_month=None):
+    _ensure_cube_fresh()
+    with analytics_db() as con:
+        return pd.read_sql_query("SELECT * FROM att_cube WHERE month BETWEEN COALESCE(?, '0000-00') AND COALESCE(?, '9999-99')",
+                                 con, params=(start_month, end_month))
+
+def cube_trend(dimension, start_month, end_month, where=None):
+    # Monthly totals per department or shift, aggregated inside SQLite
+    assert dimension in ("department","shift","ecode")
+    _ensure_cube_fresh()
+    cond, params = "", [start_month, end_month]
+    if where:
+        cond = f" AND {where[0]} = ?"; params.append(where[1])
+    sums = ", ".join(f"SUM({m}) AS {m}" for m in CUBE_MEASURES)
+    with analytics_db() as con:
+        return pd.read_sql_query(f"SELECT month, {dimension}, MAX(name) AS name, {sums} FROM att_cube "
+                                 f"WHERE month BETWEEN ? AND ?{cond} GROUP BY month, {dimension} ORDER BY month", con, params=params)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  EXCEPTION INDEX  (kind × date × ecode for open attendance exceptions, kept on write)
+# ══════════════════════════════════════════════════════════════════════════════
+
+EXCEPTION_KINDS = {"missing_in": "Missing IN Punch", "missing_out": "Missing OUT Punch", "late": "Late Entry",
+                   "early": "Early Going", "sandwich": "Sandwich Absence", "low_week": "Low Week Attendance"}
+MISSING_KINDS   = ["missing_in","missing_out"]
+
+_EXCEPTION_DDL = """
+CREATE TABLE IF NOT EXISTS att_exceptions (
+    date TEXT NOT NULL, kind TEXT NOT NULL, ecode TEXT NOT NULL, name TEXT, shift TEXT,
+    in_time TEXT, out_time TEXT, status TEXT, detail REAL,
+    PRIMARY KEY (date, kind, ecode));
+CREATE INDEX IF NOT EXISTS ix_exceptions_ecode ON att_exceptions (ecode, date);
+"""
+
+def _exception_rows(att):
+    status = att["status"].astype(str)
+    worked = status.isin(["Present","Half Day"])
+    flags  = {
+        "missing_in":  (status.isin(["Missing IN Punch","Missing Punch"]),  None),
+        "missing_out": (status.isin(["Missing OUT Punch","Missing Punch"]), None),
+        "late":        (worked & (att["late_entry_minutes"] > 0),  att["late_entry_minutes"]),
+        "early":       (worked & (att["early_going_minutes"] > 0), att["early_going_minutes"]),
+        "sandwich":    (status.eq("Absent (Sandwich)"), None),
+        "low_week":    (att["remarks"].astype(str).str.contains("Low Week Attendance", regex=False), None),
     }
+    base = pd.DataFrame({"date": att["date"].dt.strftime("%Y-%m-%d"), "ecode": att["ecode"].astype(str), "name": att["name"].astype(str),
+                         "shift": att["shift"].astype(str), "in_time": att["in_time"].astype(str), "out_time": att["out_time"].astype(str),
+                         "status": status})
+    parts = [base[mask].assign(kind=kind, detail=(detail[mask].astype(float) if detail is not None else 0.0))
+             for kind, (mask, detail) in flags.items() if mask.any()]
+    return pd.concat(parts, ignore_index=True).dropna(subset=["date"]) if parts else None
+
+def refresh_exception_index(att_df, touched=None):
+    # Re-derives only the (ecode, date) keys in `touched`; a fixed punch drops out of the index here
+    with analytics_db() as con:
+        stamp = con.execute("SELECT value FROM cube_meta WHERE key = 'exceptions'").fetchone()
+        if touched is None or stamp is None:
+            con.execute("DELETE FROM att_exceptions")
+            part = att_df
+        else:
+            dates = pd.to_datetime(touched["date"], errors="coerce", format="ISO8601")
+            keys  = pd.MultiIndex.from_arrays([touched["ecode"].astype(str), dates])
+            con.executemany("DELETE FROM att_exceptions WHERE date = ? AND ecode = ?",
+                            list(zip(dates.dt.strftime("%Y-%m-%d").fillna(""), touched["ecode"].astype(str))))
+            part = att_df[pd.MultiIndex.from_arrays([att_df["ecode"].astype(str), att_df["date"]]).isin(keys)]
+        rows = _exception_rows(part) if not part.empty else None
+        if rows is not None:
+            rows.to_sql("att_exceptions", con, if_exists="append", index=False, chunksize=5000)
+        con.execute("INSERT OR REPLACE INTO cube_meta VALUES ('exceptions', ?)", (file_version(ATTENDANCE_PATH),))
+
+def _ensure_exceptions_fresh():
+    with analytics_db() as con:
+        stamp = con.execute("SELECT value FROM cube_meta WHERE key = 'exceptions'").fetchone()
+    if stamp is None or stamp[0] != file_version(ATTENDANCE_PATH):
+        refresh_exception_index(load_attendance())
+
+def attendance_exceptions(kinds=None, start=None, end=None):
+    # Open exceptions in [start, end] (dates or "YYYY-MM-DD"), newest first
+    _ensure_exceptions_fresh()
+    kinds  = list(kinds or EXCEPTION_KINDS)
+    params = [str(start or "0000-00-00"), str(end or "9999-99-99"), *kinds]
+    with analytics_db() as con:
+        df = pd.read_sql_query(f"SELECT * FROM att_exceptions WHERE date BETWEEN ? AND ? AND kind IN ({','.join('?' * len(kinds))}) "
+                               "ORDER BY date DESC, ecode", con, params=params)
+    df["date"] = pd.to_datetime(df["date"])
+    return df
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  ATTENDANCE DAY INDEX  (date → row offsets into the (date, ecode)-sorted attendance file)
+# ══════════════════════════════════════════════════════════════════════════════
+
+_DAY_INDEX_DDL = """
+CREATE TABLE IF NOT EXISTS att_day_index (date TEXT PRIMARY KEY, start INTEGER NOT NULL, stop INTEGER NOT NULL);
+"""
+
+def _day_offsets(att):
+    # Sorted unique days plus len(days) + 1 boundaries; rows without a date sort last and are never addressed
+    dates = att["date"].dropna().to_numpy(dtype="datetime64[ns]")
+    days, starts = np.unique(dates, return_index=True)
+    return days, np.append(starts, len(dates)).astype("int64")
+
+def refresh_day_index(att_df):
+    days, bounds = _day_offsets(att_df)
+    with analytics_db() as con:
+        con.execute("DELETE FROM att_day_index")
+        con.executemany("INSERT INTO att_day_index VALUES (?, ?, ?)",
+                        zip(pd.DatetimeIndex(days).strftime("%Y-%m-%d"), bounds[:-1].tolist(), bounds[1:].tolist()))
+        con.execute("INSERT OR REPLACE INTO cube_meta VALUES ('day_index', ?)", (file_version(ATTENDANCE_PATH),))
+    return days, bounds
+
+def attendance_day_index():
+    # Served from the tenant cache; read back from analytics.db, rebuilt only if the file moved on
+    version = file_version(ATTENDANCE_PATH)
+    def build():
+        with analytics_db() as con:
+            stamp = con.execute("SELECT value FROM cube_meta WHERE key = 'day_index'").fetchone()
+            rows  = con.execute("SELECT date, start, stop FROM att_day_index ORDER BY date").fetchall() if stamp and stamp[0] == version else None
+        if rows is None:
+            return refresh_day_index(_cached_table(ATTENDANCE_PATH, ATTENDANCE_COLUMNS, ATTENDANCE_SCHEMA, "attendance", ATTENDANCE_ORDER))
+        if not rows:
+            return np.array([], dtype="datetime64[ns]"), np.zeros(1, dtype="int64")
+        days = pd.to_datetime([r[0] for r in rows]).to_numpy(dtype="datetime64[ns]")
+        return days, np.array([r[1] for r in rows] + [rows[-1][2]], dtype="int64")
+    return tenant_cache().get(COMPANY_ID, "att_day_index", version, build)
+
+def month_bounds(year, month):
+    return date(int(year), int(month), 1), date(int(year), int(month), calendar.monthrange(int(year), int(month))[1])
+
+def attendance_range(start=None, end=None):
+    # Rows with start <= date <= end (either side open), by binary search over the day index — no column scans.
+    # Hot rows keep the full table's row labels; when the range reaches into closed periods their rows are read
+    # from the cold archive and the result is renumbered.
+    att          = _cached_table(ATTENDANCE_PATH, ATTENDANCE_COLUMNS, ATTENDANCE_SCHEMA, "attendance", ATTENDANCE_ORDER)
+    days, bounds = attendance_day_index()
+    lo = 0 if start is None else int(np.searchsorted(days, np.datetime64(pd.Timestamp(start), "ns"), "left"))
+    hi = len(days) if end is None else int(np.searchsorted(days, np.datetime64(pd.Timestamp(end), "ns"), "right"))
+    hot  = att.iloc[bounds[lo]:bounds[max(lo, hi)]].copy()
+    cold = cold_attendance(start, end)
+    if cold is None:
+        return hot
+    return apply_schema(pd.concat([cold, hot], ignore_index=True), ATTENDANCE_COLUMNS, ATTENDANCE_SCHEMA)
+
+def attendance_month(year, month):
+    return attendance_range(*month_bounds(year, month))
+
+def has_attendance():
+    return len(attendance_day_index()[0]) > 0 or any(closed_periods()["attendance_rows"] > 0)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  COLD ARCHIVE  (closed periods as immutable zstd-compressed Arrow partitions)
+# ══════════════════════════════════════════════════════════════════════════════
+
+# attendance.csv and payroll.db keep only open periods. Closing a period moves its attendance rows to
+# archive/attendance/YYYY-MM.arrow and its superseded payroll runs to archive/payroll/YYYY-MM.arrow; the
+# latest run stays in payroll.db, so YTD, arrears and cost reports keep answering from SQL. Closed
+# periods reject further attendance edits and payroll runs.
+HOT_MONTHS = 2      # this month and the previous one can never be closed
+
+def _cold_path(kind, period):
+    return os.path.join(ARCHIVE_DIR, kind, f"{period}.arrow")
+
+def _write_cold(kind, period, df):
+    os.makedirs(os.path.dirname(_cold_path(kind, period)), exist_ok=True)
+    data = pa.Table.from_pandas(df, preserve_index=False)
+    def write(tmp):
+        with pa.OSFile(tmp, "wb") as sink, \
+             pa.ipc.new_file(sink, data.schema, options=pa.ipc.IpcWriteOptions(compression="zstd")) as writer:
+            writer.write_table(data)
+        os.chmod(tmp, 0o444)
+    _atomic_write(_cold_path(kind, period), write)
+
+def read_cold(kind, period):
+    # A partition never changes once its period is closed, so the tenant cache holds it under a fixed version
+    path = _cold_path(kind, period)
+    if not os.path.exists(path):
+        return None
+    return tenant_cache().get(COMPANY_ID, f"cold:{kind}:{period}", "closed",
+                              lambda: pa.ipc.open_file(pa.memory_map(path, "r")).read_all().to_pandas())
+
+def closed_periods():
+    with payroll_db() as con:
+        return pd.read_sql_query("SELECT * FROM closed_periods ORDER BY period", con)
+
+def closed_through():
+    # Last day of the latest closed period, or None while nothing is closed
+    with payroll_db() as con:
+        last = con.execute("SELECT MAX(period) FROM closed_periods").fetchone()[0]
+    return None if last is None else month_bounds(*last.split("-"))[1]
+
+def is_period_closed(year, month):
+    last = closed_through()
+    return last is not None and month_bounds(year, month)[1] <= last
+
+def cold_attendance(start=None, end=None):
+    # Archived attendance rows with start <= date <= end, or None when the range holds no closed period
+    closed = closed_periods()
+    closed = closed[closed["attendance_rows"] > 0]
+    if start is not None:
+        closed = closed[closed["period"] >= pd.Timestamp(start).strftime("%Y-%m")]
+    if end is not None:
+        closed = closed[closed["period"] <= pd.Timestamp(end).strftime("%Y-%m")]
+    parts = [p for p in (read_cold("attendance", period) for period in closed["period"]) if p is not None]
+    if not parts:
+        return None
+    out = pd.concat(parts, ignore_index=True)
+    if start is not None:
+        out = out[out["date"] >= pd.Timestamp(start)]
+    if end is not None:
+        out = out[out["date"] <= pd.Timestamp(end)]
+    return out
+
+def closable_through(hot_months=HOT_MONTHS, today=None):
+    # Latest period that may be closed; the working set is the current month and the (hot_months - 1) before it
+    return str(pd.Period(today or date.today(), freq="M") - max(si(hot_months, HOT_MONTHS), HOT_MONTHS))
+
+def close_period(year, month, hot_months=HOT_MONTHS):
+    # Closes every open period up to and including (year, month), oldest first. Returns the periods closed.
+    upto = period_key(year, month)
+    if upto > closable_through(hot_months):
+        raise ValueError(f"{period_label(upto)} is still in the working set — periods up to "
+                         f"{period_label(closable_through(hot_months))} can be closed")
+    last = closed_through()
+    att  = load_attendance()
+    ym   = att["date"].dt.strftime("%Y-%m")
+    with payroll_db() as con:
+        runs = {r[0] for r in con.execute("SELECT DISTINCT period FROM payroll_runs WHERE period <= ?", (upto,))}
+    todo = sorted({p for p in set(ym.dropna()) | runs if p <= upto and (last is None or p > last.strftime("%Y-%m"))})
+    if not todo:
+        return []
+    now, user = datetime.now().isoformat(timespec="seconds"), current_user()
+    for period in todo:
+        # The partition is written before the period is marked closed, so an interrupted close is simply redone
+        part = att[(ym == period).to_numpy()].reset_index(drop=True)
+        if len(part):
+            _write_cold("attendance", period, part)
+        with payroll_db() as con:
+            old = pd.read_sql_query("SELECT * FROM payroll_register WHERE period = ? AND run_id < "
+                                    "(SELECT MAX(run_id) FROM payroll_runs WHERE period = ?)", con, params=(period, period))
+            if len(old):
+                _write_cold("payroll", period, old)
+                con.execute("DELETE FROM payroll_register WHERE period = ? AND run_id < "
+                            "(SELECT MAX(run_id) FROM payroll_runs WHERE period = ?)", (period, period))
+            con.execute("INSERT INTO closed_periods VALUES (?, ?, ?, ?, ?)",
+                        (period, now, user, len(part), int(old["run_id"].nunique()) if len(old) else 0))
+    # Moving rows to the archive is not an edit, so it is not journaled; the cube keeps the closed months
+    # and their exceptions, which can no longer be fixed, leave the index
+    hot = _store_table(att[~(att["date"] <= pd.Timestamp(month_bounds(*todo[-1].split("-"))[1])).to_numpy()], ATTENDANCE_PATH, ATTENDANCE_COLUMNS, ATTENDANCE_SCHEMA, "attendance", ATTENDANCE_ORDER)
+    refresh_day_index(hot)
+    refresh_attendance_cube(hot, [])
+    with analytics_db() as con:
+        con.execute("DELETE FROM att_exceptions WHERE date <= ?", (month_bounds(*todo[-1].split("-"))[1].isoformat(),))
+    refresh_exception_index(hot, hot.iloc[:0])
+    vac = sqlite3.connect(PAYROLL_DB_PATH)
+    try:
+        vac.execute("VACUUM")
+    finally:
+        vac.close()
+    return todo
+
+def close_due_periods(config):
+    # The scheduled close: everything older than the configured working set
+    hot_months = config.get("archive", {}).get("hot_months", HOT_MONTHS)
+    upto = pd.Period(closable_through(hot_months), freq="M")
+    return close_period(upto.year, upto.month, hot_months)
+
+def archived_register(year, month, run_id):
+    cold = read_cold("payroll", period_key(year, month))
+    if cold is None:
+        return None
+    df = cold[cold["run_id"] == int(run_id)]
+    return None if df.empty else df.drop(columns=["period","run_id"]).dropna(axis=1, how="all").reset_index(drop=True)
+
 
 def get_leave_balance(ecode, year, config):
     leaves_df = load_leaves()
     cfg       = config["leave"]
     emp_leaves= leaves_df[
         (leaves_df["ecode"] == ecode) & (leaves_df["status"] == "Approved") &
-        (pd.to_datetime(leaves_df["from_date"], errors="coerce").dt.year == year)
+        (leaves_df["from_date"].dt.year == year)
     ]
-    def taken(lt): return emp_leaves[emp_leaves["leave_type"] == lt]["days"].astype(float).sum()
+    def taken(lt): return float(emp_leaves.loc[emp_leaves["leave_type"] == lt, "days"].sum())
     pl_t, cl_t, sl_t = taken("PL"), taken("CL"), taken("SL")
     return {
         "pl_entitled": cfg["pl"]["annual"], "pl_taken": pl_t, "pl_balance": max(0, cfg["pl"]["annual"] - pl_t),
@@ -407,6 +1766,827 @@ def get_leave_balance(ecode, year, config):
     }
 
 
+# ══════════════════════════════════════════════════════════════════════════════
+#  LEAVE RECONCILIATION  (approved leave ranges → "On Leave" attendance days and paid payroll days)
+# ══════════════════════════════════════════════════════════════════════════════
+
+LEAVE_OVERRIDES = ["Absent","Absent (Sandwich)","Missing Punch"]     # statuses an approved leave replaces
+_LEAVE_REMARK   = r"^(\w+) leave \(was (.*)\)$"                       # "PL leave (was Absent)"
+
+def leave_intervals(leaves_df=None):
+    # Approved ranges sorted by start. `cover_to` is the running max end per employee, so a day is on leave
+    # exactly when it is on or before cover_to of the last range starting on or before it.
+    ldf = load_leaves() if leaves_df is None else leaves_df
+    iv  = ldf.loc[ldf["status"].eq("Approved") & ldf["from_date"].notna() & ldf["to_date"].notna(),
+                  ["ecode","leave_type","from_date","to_date"]]
+    iv  = iv.astype({"ecode": str, "leave_type": str, "from_date": "datetime64[ns]", "to_date": "datetime64[ns]"})
+    iv  = iv.sort_values("from_date", kind="stable", ignore_index=True)
+    iv["cover_to"] = iv.groupby("ecode")["to_date"].cummax()
+    return iv
+
+def leave_on(keys, intervals):
+    # Leave type for each (ecode, date) row of `keys`, "" where no approved leave covers the day
+    out = np.full(len(keys), "", dtype=object)
+    if len(keys) and len(intervals):
+        probe = pd.DataFrame({"ecode": keys["ecode"].astype(str).to_numpy(), "date": keys["date"].to_numpy(dtype="datetime64[ns]"),
+                              "_row": np.arange(len(keys))}).dropna(subset=["date"]).sort_values("date", kind="stable")
+        hit   = pd.merge_asof(probe, intervals, left_on="date", right_on="from_date", by="ecode", direction="backward")
+        hit   = hit[hit["date"] <= hit["cover_to"]]
+        out[hit["_row"].to_numpy()] = hit["leave_type"].to_numpy()
+    return pd.Series(out, index=keys.index)
+
+def reconcile_leaves(att, intervals=None):
+    # Covered absences become "On Leave"; a day whose leave was since rejected gets its earlier status back.
+    # Returns the reconciled frame and a mask of the rows that changed.
+    intervals = leave_intervals() if intervals is None else intervals
+    lt      = leave_on(att, intervals)
+    status  = att["status"].astype(str)
+    remarks = att["remarks"].fillna("").astype(str)
+    was     = remarks.str.extract(_LEAVE_REMARK)
+    ours    = status.eq("On Leave") & was[0].notna()
+    mark    = lt.ne("") & status.isin(LEAVE_OVERRIDES)
+    retag   = ours & lt.ne("") & lt.ne(was[0])
+    undo    = ours & lt.eq("")
+    changed = mark | retag | undo
+    if not changed.any():
+        return att, changed
+    prior = status.where(mark, was[1])
+    out   = att.copy()
+    out["status"]  = status.where(~undo, was[1]).where(~mark, "On Leave")
+    out["remarks"] = remarks.where(~(mark | retag), lt + " leave (was " + prior + ")") \
+                            .where(~undo, np.where(was[1].eq("Absent (Sandwich)"), "Sandwich Rule Applied", ""))
+    return out, changed
+
+def reconcile_leave_changes(before, after):
+    # Only employees and dates whose approved ranges differ between the two leave tables are revisited
+    cols = ["ecode","leave_type","from_date","to_date"]
+    new  = leave_intervals(after)
+    diff = pd.concat([leave_intervals(before)[cols], new[cols]]).drop_duplicates(keep=False)
+    if diff.empty or not has_attendance():
+        return 0
+    last  = closed_through()
+    start = diff["from_date"].min() if last is None else max(diff["from_date"].min(), pd.Timestamp(last) + pd.Timedelta(days=1))
+    if start > diff["to_date"].max():
+        return 0
+    part = attendance_range(start, diff["to_date"].max())      # closed periods are not reconciled
+    part = part[part["ecode"].astype(str).isin(set(diff["ecode"]))]
+    fixed, changed = reconcile_leaves(part, new)
+    if not changed.any():
+        return 0
+    att  = load_attendance()
+    rows = fixed.index[changed.to_numpy()]          # day-index slices keep the full table's row labels
+    att.loc[rows, ["status","remarks"]] = fixed.loc[rows, ["status","remarks"]]
+    save_attendance(att, touched=fixed.loc[rows])
+    return len(rows)
+
+def paid_leave_days(active, month_att, rules, year, month, intervals=None):
+    # Per ecode: working days of the month under approved paid leave on which the employee did not also work
+    intervals = leave_intervals() if intervals is None else intervals
+    start, end = (pd.Timestamp(d) for d in month_bounds(year, month))
+    iv = intervals[intervals["leave_type"].isin(rules.paid_leave_types) & (intervals["from_date"] <= end) &
+                   (intervals["to_date"] >= start) & intervals["ecode"].isin(active["ecode"].astype(str))]
+    if iv.empty:
+        return pd.Series(dtype="int64")
+    lo   = iv["from_date"].clip(lower=start).to_numpy()
+    n    = ((iv["to_date"].clip(upper=end) - iv["from_date"].clip(lower=start)).dt.days + 1).to_numpy()
+    step = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    days = pd.DataFrame({"ecode": np.repeat(iv["ecode"].to_numpy(), n),
+                         "date":  np.repeat(lo, n) + step.astype("timedelta64[D]")}).drop_duplicates(ignore_index=True)
+    locs    = days["ecode"].map(dict(zip(active["ecode"].astype(str), active["location"].astype(str)))).fillna("")
+    working = pd.concat([calendar_flags(rules, days.loc[idx, "date"], loc)["working"] for loc, idx in days.groupby(locs).groups.items()])
+    worked  = month_att.loc[month_att["status"].isin(["Present","Half Day"]), ["ecode","date"]].astype({"ecode": str, "date": "datetime64[ns]"})
+    days    = days[working.reindex(days.index).to_numpy()]
+    days    = days[~pd.MultiIndex.from_frame(days).isin(pd.MultiIndex.from_frame(worked))]
+    return days.groupby("ecode").size()
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  CHANGE JOURNAL  (append-only row deltas + periodic bucketed snapshots)
+# ══════════════════════════════════════════════════════════════════════════════
+
+JOURNAL_TABLES = {   # table -> (columns, schema, key columns)
+    "employees":  (EMPLOYEE_COLUMNS,   EMPLOYEE_SCHEMA,   ["ecode"]),
+    "attendance": (ATTENDANCE_COLUMNS, ATTENDANCE_SCHEMA, ["ecode","date"]),
+    "leaves":     (LEAVE_COLUMNS,      LEAVE_SCHEMA,      ["ecode","leave_type","from_date","to_date"]),
+}
+SNAPSHOT_EVERY   = 5000   # journal entries per table between full snapshots
+SNAPSHOT_BUCKETS = 64     # a single-record lookup decompresses one bucket, not the whole table
+
+_HISTORY_DDL = """
+CREATE TABLE IF NOT EXISTS journal (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT, tbl TEXT NOT NULL, row_key TEXT NOT NULL, op TEXT NOT NULL,
+    ts TEXT NOT NULL, user TEXT, delta TEXT);
+CREATE INDEX IF NOT EXISTS ix_journal_key ON journal (tbl, row_key, seq);
+CREATE TABLE IF NOT EXISTS snapshots (
+    snap_id INTEGER PRIMARY KEY AUTOINCREMENT, tbl TEXT NOT NULL, seq INTEGER NOT NULL, ts TEXT NOT NULL,
+    n_rows INTEGER, cols TEXT);
+CREATE TABLE IF NOT EXISTS snapshot_parts (
+    snap_id INTEGER NOT NULL, bucket INTEGER NOT NULL, data BLOB, PRIMARY KEY (snap_id, bucket));
+"""
+
+def history_db():
+    return sqlite_db(HISTORY_DB_PATH, _HISTORY_DDL)
+
+def current_user():
+    try:
+        if st.user.get("is_logged_in"):
+            return st.user.get("email") or st.user.get("name")
+    except Exception:
+        pass
+    return os.environ.get("HRMS_USER") or getpass.getuser()
+
+def _storage_strings(df, schema):
+    s = to_storage(df, schema).astype(object)
+    return s.where(s.notna(), "").astype(str)
+
+def _row_keys(df, table, unique=True):
+    # "EMP001|2024-01-15"; with unique=True repeated keys get a "#n" suffix
+    _, schema, keys = JOURNAL_TABLES[table]
+    s   = _storage_strings(df[keys], schema)
+    key = s[keys[0]].str.cat([s[k] for k in keys[1:]], sep="|") if len(keys) > 1 else s[keys[0]]
+    if not unique:
+        return key
+    dup = key.groupby(key).cumcount()
+    return key.where(dup == 0, key + "#" + dup.astype(str))
+
+def _journal_frame(df, table):
+    # Canonical string form of every column, indexed by row key
+    columns, schema, _ = JOURNAL_TABLES[table]
+    df = apply_schema(df.copy(deep=False), columns, schema)
+    return _storage_strings(df, schema).set_axis(_row_keys(df, table).tolist())
+
+def _bucket(key):
+    return zlib.crc32(key.encode()) % SNAPSHOT_BUCKETS
+
+def _write_snapshot(con, table, frame, seq, ts):
+    snap_id = con.execute("INSERT INTO snapshots (tbl, seq, ts, n_rows, cols) VALUES (?, ?, ?, ?, ?)",
+                          (table, seq, ts, len(frame), json.dumps(list(frame.columns)))).lastrowid
+    parts = defaultdict(list)
+    for key, row in zip(frame.index, frame.itertuples(index=False, name=None)):
+        parts[_bucket(key)].append([key, *row])
+    con.executemany("INSERT INTO snapshot_parts VALUES (?, ?, ?)",
+                    [(snap_id, b, zlib.compress(json.dumps(rows).encode())) for b, rows in parts.items()])
+
+def journal_changes(table, old_df, new_df, touched=None):
+    # Records inserts / deletes / changed fields between two versions of a table. With `touched`
+    # (rows written by this edit) only those keys are compared.
+    _, schema, keys = JOURNAL_TABLES[table]
+    old, new = old_df, new_df
+    if touched is not None:
+        want = set(_row_keys(apply_schema(touched.copy(deep=False), keys, schema), table, unique=False))
+        old  = old[_row_keys(old, table, unique=False).isin(want).to_numpy()]
+        new  = new[_row_keys(apply_schema(new.copy(deep=False), keys, schema), table, unique=False).isin(want).to_numpy()]
+    old, new = _journal_frame(old, table), _journal_frame(new, table)
+    cols = list(dict.fromkeys([*new.columns, *old.columns]))
+    old, new = old.reindex(columns=cols, fill_value=""), new.reindex(columns=cols, fill_value="")
+    both  = new.index.intersection(old.index)
+    added = new.index.difference(old.index)
+    a, b  = old.loc[both].to_numpy(), new.loc[both].to_numpy()
+    diff  = a != b
+    ts, user = datetime.now().isoformat(timespec="seconds"), current_user()
+    entries  = [(table, k, "insert", ts, user, json.dumps(dict(zip(cols, r))))
+                for k, r in zip(added, new.loc[added].itertuples(index=False, name=None))]
+    entries += [(table, k, "delete", ts, user, None) for k in old.index.difference(new.index)]
+    entries += [(table, both[i], "update", ts, user, json.dumps({cols[j]: b[i, j] for j in np.flatnonzero(diff[i])}))
+                for i in np.flatnonzero(diff.any(axis=1))]
+    if not entries:
+        return 0
+    with history_db() as con:
+        last = con.execute("SELECT MAX(seq) FROM snapshots WHERE tbl = ?", (table,)).fetchone()[0]
+        if last is None:
+            # History starts here: the table as it was before the first journaled edit
+            base = con.execute("SELECT COALESCE(MAX(seq), 0) FROM journal").fetchone()[0]
+            _write_snapshot(con, table, _journal_frame(old_df, table), base, ts)
+            last = base
+        con.executemany("INSERT INTO journal (tbl, row_key, op, ts, user, delta) VALUES (?, ?, ?, ?, ?, ?)", entries)
+        seq, pending = con.execute("SELECT MAX(seq), COUNT(*) FROM journal WHERE tbl = ? AND seq > ?", (table, last)).fetchone()
+        if pending >= SNAPSHOT_EVERY:
+            _write_snapshot(con, table, _journal_frame(new_df, table), seq, ts)
+    return len(entries)
+
+def _replay(rows, entries):
+    for key, op, delta in entries:
+        if op == "delete":
+            rows.pop(key, None)
+        elif op == "insert":
+            rows[key] = json.loads(delta)
+        else:
+            rows.setdefault(key, {}).update(json.loads(delta))
+    return rows
+
+def _snapshot_before(con, table, when):
+    return con.execute("SELECT snap_id, seq, cols FROM snapshots WHERE tbl = ? AND ts <= ? ORDER BY seq DESC LIMIT 1",
+                       (table, when)).fetchone()
+
+def record_as_of(table, key, when):
+    # Nearest snapshot bucket for the key, then only that key's deltas (indexed on tbl, row_key, seq)
+    with history_db() as con:
+        snap = _snapshot_before(con, table, when)
+        if snap is None:
+            return archived_record(table, key, when)
+        snap_id, seq, cols = snap
+        blob = con.execute("SELECT data FROM snapshot_parts WHERE snap_id = ? AND bucket = ?", (snap_id, _bucket(key))).fetchone()
+        rows = {r[0]: dict(zip(json.loads(cols), r[1:])) for r in json.loads(zlib.decompress(blob[0])) if r[0] == key} if blob else {}
+        entries = con.execute("SELECT row_key, op, delta FROM journal WHERE tbl = ? AND row_key = ? AND seq > ? AND ts <= ? ORDER BY seq",
+                              (table, key, seq, when)).fetchall()
+    rec = _replay(rows, entries).get(key)
+    return archived_record(table, key, when) if rec is None else rec
+
+def archived_record(table, key, when):
+    # Snapshots taken after a close no longer hold the archived rows; those rows are final, so read the archive
+    if table != "attendance" or "|" not in key:
+        return None
+    ecode, day = key.split("|", 1)
+    closed = closed_periods().set_index("period")
+    if day[:7] not in closed.index or closed.at[day[:7], "closed_at"] > when:
+        return None
+    cold = read_cold("attendance", day[:7])
+    if cold is None:
+        return None
+    hit = cold[(cold["ecode"].astype(str) == ecode) & (cold["date"] == pd.to_datetime(day, errors="coerce"))]
+    return None if hit.empty else _journal_frame(hit.head(1), table).iloc[0].to_dict()
+
+def table_as_of(table, when):
+    with history_db() as con:
+        snap = _snapshot_before(con, table, when)
+        if snap is None:
+            return None
+        snap_id, seq, cols = snap
+        cols = json.loads(cols)
+        rows = {r[0]: dict(zip(cols, r[1:])) for (blob,) in con.execute("SELECT data FROM snapshot_parts WHERE snap_id = ?", (snap_id,))
+                for r in json.loads(zlib.decompress(blob))}
+        entries = con.execute("SELECT row_key, op, delta FROM journal WHERE tbl = ? AND seq > ? AND ts <= ? ORDER BY seq",
+                              (table, seq, when)).fetchall()
+    return pd.DataFrame.from_dict(_replay(rows, entries), orient="index").rename_axis("key").reset_index()
+
+def record_history(table, key):
+    with history_db() as con:
+        return pd.read_sql_query("SELECT seq, ts, user, op, delta FROM journal WHERE tbl = ? AND row_key = ? ORDER BY seq DESC",
+                                 con, params=(table, key))
+
+def recent_changes(table=None, limit=200):
+    with history_db() as con:
+        return pd.read_sql_query("SELECT seq, ts, user, tbl, row_key, op, delta FROM journal WHERE ? IS NULL OR tbl = ? "
+                                 "ORDER BY seq DESC LIMIT ?", con, params=(table, table, limit))
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  EMPLOYEE SEARCH
+# ══════════════════════════════════════════════════════════════════════════════
+
+SEARCH_FIELDS  = ["name","ecode","department","mobile"]
+EXACT_FIELDS   = ["ecode","mobile"]
+MAX_FUZZY_ROWS = 5000      # best-ranked typo matches returned; exact and prefix hits are never cut
+_NO_ROWS       = np.array([], dtype=np.int32)
+
+def _grams(text, pad=True, n=3):
+    t = f" {text} " if pad else text
+    return {t[i:i+n] for i in range(len(t) - n + 1)}
+
+def _distinct(a):
+    # Sorted distinct values; a sort and a neighbour compare beats np.unique's hashing on these int arrays
+    a = np.sort(a)
+    return a[np.r_[True, a[1:] != a[:-1]]] if len(a) else a
+
+def _member(sorted_rows, rows):
+    # Mask of rows found in sorted_rows
+    if not len(sorted_rows):
+        return np.zeros(len(rows), dtype=bool)
+    return sorted_rows[np.minimum(np.searchsorted(sorted_rows, rows), len(sorted_rows) - 1)] == rows
+
+def _postings(keys, rows, size):
+    # Sorted distinct keys, CSR offsets and the (sorted, de-duplicated) rows holding each key
+    codes, uniq = pd.factorize(keys, sort=True)
+    codes, rows = np.divmod(_distinct(codes.astype(np.int64) * max(size, 1) + rows), max(size, 1))
+    uniq = np.asarray(uniq, dtype=str)
+    # One spare character so a "prefix\uffff" bound fits without numpy widening (copying) the whole table
+    return uniq.astype(f"<U{uniq.itemsize // 4 + 1}"), np.searchsorted(codes, np.arange(len(uniq) + 1)), rows.astype(np.int32)
+
+def _spans(starts, counts):
+    # Positions covered by the slices [start, start + count), concatenated
+    return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+def _gram_postings(tok, size):
+    # {gram: sorted rows} for one field; grams are cut once per distinct token, then fanned out to its rows
+    tokens, tstart, trows = _postings(tok.to_numpy(dtype=str), tok.index.to_numpy(), size)
+    padded = " " + pd.Series(tokens, dtype=str) + " "
+    cut    = pd.concat([pd.Series(dtype=str), *(padded.str[i:i+3] for i in range(tokens.itemsize // 4 - 1))])
+    cut    = cut[cut.str.len() == 3]
+    tcode  = cut.index.to_numpy()
+    counts = tstart[tcode + 1] - tstart[tcode]
+    keys, start, rows = _postings(np.repeat(cut.to_numpy(dtype=str), counts), trows[_spans(tstart[tcode], counts)], size)
+    return dict(zip(keys.tolist(), np.split(rows, start[1:-1]))) if len(keys) else {}
+
+class EmployeeSearchIndex:
+    # Trigram postings per field (substring + typo tolerant) and a sorted token table (prefix) over the employee
+    # master. Every posting list is a slice of an int32 array: ~40 MB for 100k employees, inside the company's
+    # cache budget.
+    def __init__(self, df):
+        self.size = len(df)
+        cols  = {f: df[f].fillna("").astype(str).str.lower().str.strip().reset_index(drop=True) for f in SEARCH_FIELDS if f in df.columns}
+        toks  = {f: c.str.split().explode().dropna() for f, c in cols.items()}
+        toks  = {f: t[t != ""] for f, t in toks.items()}
+        tok   = pd.concat([pd.Series(dtype=str), *toks.values()])
+        exact = pd.concat([pd.Series(dtype=str), *(cols[f] for f in EXACT_FIELDS if f in cols)])
+        exact = exact[exact != ""]
+        self.tokens, self.token_start, self.token_rows = _postings(tok.to_numpy(dtype=str), tok.index.to_numpy(), self.size)
+        self.exact, self.exact_start, self.exact_rows  = _postings(exact.to_numpy(dtype=str), exact.index.to_numpy(), self.size)
+        self.grams = {f: _gram_postings(t, self.size) for f, t in toks.items()}
+
+    @property
+    def nbytes(self):
+        arrays = [self.tokens, self.token_start, self.token_rows, self.exact, self.exact_start, self.exact_rows]
+        return sum(a.nbytes for a in arrays) + sum(a.nbytes + 100 for g in self.grams.values() for a in g.values())
+
+    def _prefix_rows(self, word):
+        lo, hi = np.searchsorted(self.tokens, np.array([word, word + "\uffff"], dtype=self.tokens.dtype))
+        rows   = self.token_rows[self.token_start[lo]:self.token_start[hi]]
+        return rows if hi - lo < 2 else _distinct(rows)
+
+    def _exact_rows(self, q):
+        i = int(np.searchsorted(self.exact, np.array(q, dtype=self.exact.dtype)))
+        return self.exact_rows[self.exact_start[i]:self.exact_start[i+1]] if i < len(self.exact) and self.exact[i] == q else _NO_ROWS
+
+    def search(self, query, min_similarity=0.5, limit=MAX_FUZZY_ROWS):
+        # Returns (row positions ranked exact code/mobile > prefix on every word > trigram similarity, number of
+        # fuzzy matches left out past `limit`). A fuzzy hit must share at least min_similarity of each query
+        # word's grams (codes and numbers: all of them) with a single field of the row, so "rahl sharma" finds
+        # the Rahul Sharmas and not every Sharma, and a code's digits can't be made up from the mobile number.
+        q = " ".join(str(query).lower().split())
+        if not q or not self.size:
+            return np.arange(self.size), 0
+        score = np.zeros(self.size, dtype=np.int64)
+        match = np.ones(self.size, dtype=bool)
+        for w in [w for w in q.split() if len(w) >= 3] or q.split():
+            g    = _grams(w, pad=len(w) < 3)
+            need = len(g) if any(ch.isdigit() for ch in w) else max(1, int(np.ceil(len(g) * min_similarity)))
+            best = np.zeros(self.size, dtype=np.int64)
+            for grams in self.grams.values():
+                posts = [grams[x] for x in g if x in grams]
+                if len(posts) >= need:
+                    hits = np.bincount(np.concatenate(posts), minlength=self.size)
+                    np.maximum(best, np.where(hits >= need, hits, 0), out=best)
+            match &= best > 0
+            score += best
+        fuzzy  = np.flatnonzero(match)
+        prefix = None
+        for w in q.split():
+            rows   = self._prefix_rows(w)
+            prefix = rows if prefix is None else prefix[_member(rows, prefix)]
+        exact  = self._exact_rows(q)
+        prefix = prefix[~_member(exact, prefix)]
+        fuzzy  = fuzzy[~_member(prefix, fuzzy) & ~_member(exact, fuzzy)]
+        fuzzy  = fuzzy[np.argsort(-score[fuzzy], kind="stable")]
+        return np.concatenate([exact, prefix, fuzzy[:limit]]).astype(np.int64), max(0, len(fuzzy) - limit)
+
+def employee_search_index():
+    # Built once per company and reused across reruns; rebuilt only when employees.csv changes on disk
+    return tenant_cache().get(COMPANY_ID, "search_index", file_version(EMPLOYEES_PATH), lambda: EmployeeSearchIndex(load_employees()))
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  TABLE PAGING
+# ══════════════════════════════════════════════════════════════════════════════
+
+PAGE_SIZES = [25, 50, 100, 250]
+
+def page_slice(df, sort_col, descending, page, page_size):
+    # Sort only the key column, then gather just the rows of the requested page
+    start = (page - 1) * page_size
+    if df.empty or sort_col not in df.columns:
+        return df.iloc[start:start + page_size]
+    col   = df[sort_col].reset_index(drop=True)
+    if isinstance(col.dtype, pd.CategoricalDtype):     # by label, not by the declared category order
+        col = col.cat.reorder_categories(sorted(col.cat.categories, key=str))
+    order = col.sort_values(ascending=not descending, kind="stable", na_position="last").index
+    return df.iloc[order[start:start + page_size]]
+
+def paged_table(df, columns, key, default_sort=None, ranked=False):
+    # Renders sort / page controls and sends only the visible page to the browser
+    total = len(df)
+    sorts = (["Relevance"] if ranked else []) + columns
+    c1,c2,c3,c4 = st.columns([2,1,1,1])
+    sort_col = c1.selectbox("Sort by", sorts, index=0 if ranked else sorts.index(default_sort) if default_sort in sorts else 0, key=f"{key}_sort")
+    desc     = c2.selectbox("Order", ["Ascending","Descending"], key=f"{key}_ord") == "Descending"
+    size     = c3.selectbox("Rows per page", PAGE_SIZES, index=1, key=f"{key}_size")
+    pages    = max(1, -(-total // size))
+    if st.session_state.get(f"{key}_page", pages + 1) > pages:      # first render, or the filter left fewer pages
+        st.session_state[f"{key}_page"] = 1
+    page     = c4.number_input(f"Page (of {pages})", min_value=1, max_value=pages, step=1, key=f"{key}_page")
+    view     = page_slice(df, sort_col, desc, int(page), size)[columns]
+    view     = view.assign(**{c: view[c].dt.strftime("%Y-%m-%d") for c in view.select_dtypes("datetime").columns})
+    first    = (int(page) - 1) * size
+    st.caption(f"Showing {first + 1 if total else 0}–{first + len(view)} of {total}")
+    st.dataframe(view, use_container_width=True, hide_index=True)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  CHARTS  (aggregated / binned on the server, figure JSON cached per data version)
+# ══════════════════════════════════════════════════════════════════════════════
+
+CHART_WEBGL_ROWS = 5_000     # scatters above this are drawn with a WebGL trace
+CHART_BIN_ROWS   = 50_000    # ... and above this are binned into a 2-D histogram
+CHART_BINS       = 60
+
+def _bar_figure(df, x, y, top=None, **kw):
+    # Top-N bars pick their rows here, so only N rows reach the figure
+    return px.bar(df.nlargest(top, y) if top else df, x=x, y=y, **kw)
+
+def _scatter_figure(df, x, y, title=None, hover_data=None, **kw):
+    n = len(df)
+    if n <= CHART_WEBGL_ROWS:
+        return px.scatter(df, x=x, y=y, title=title, hover_data=hover_data, **kw)
+    if n <= CHART_BIN_ROWS:
+        return px.scatter(df[[x, y]], x=x, y=y, title=f"{title} ({n:,} points)", render_mode="webgl", **kw)
+    xv = pd.to_numeric(df[x], errors="coerce").to_numpy(float)
+    yv = pd.to_numeric(df[y], errors="coerce").to_numpy(float)
+    ok = ~(np.isnan(xv) | np.isnan(yv))
+    xv, yv = xv[ok], yv[ok]
+    z, xe, ye = np.histogram2d(xv, yv, bins=(max(1, min(CHART_BINS, len(np.unique(xv)))), CHART_BINS))
+    fig = go.Figure(go.Heatmap(z=np.where(z.T > 0, z.T, np.nan), x=(xe[:-1] + xe[1:]) / 2, y=(ye[:-1] + ye[1:]) / 2,
+                               colorscale="Blues", colorbar=dict(title="Rows"),
+                               hovertemplate=f"{x}: %{{x:.1f}}<br>{y}: %{{y:,.0f}}<br>rows: %{{z}}<extra></extra>"))
+    fig.update_layout(title=f"{title} ({n:,} rows, binned)", xaxis_title=x, yaxis_title=y)
+    return fig
+
+_CHART_BUILDERS = {"bar": _bar_figure, "scatter": _scatter_figure, "line": px.line, "pie": px.pie}
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _chart_json(kind, version, options, _df):
+    opts = json.loads(options)
+    height, layout = opts.pop("height"), opts.pop("layout")
+    fig = _CHART_BUILDERS[kind](_df, **opts)
+    fig.update_layout(height=height, paper_bgcolor="white", plot_bgcolor="white", **layout)
+    return fig.to_json()
+
+def chart(kind, df, version, height=300, layout=None, **kw):
+    # version must change whenever the data behind df does (file mtime, run id, period, ...)
+    options = json.dumps(dict(kw, height=height, layout=layout or {}), sort_keys=True, default=str)
+    st.plotly_chart(pio.from_json(_chart_json(kind, repr((COMPANY_ID, version)), options, df)), use_container_width=True)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  EXPORTS  (built only when requested; CSV in chunks, XLSX in write-only mode)
+# ══════════════════════════════════════════════════════════════════════════════
+
+EXPORT_CHUNK_ROWS = 50_000
+EXPORT_FORMATS    = {"CSV":   ("csv",  "text/csv"),
+                     "Excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")}
+
+def _export_chunks(df):
+    for start in range(0, max(len(df), 1), EXPORT_CHUNK_ROWS):
+        yield df.iloc[start:start + EXPORT_CHUNK_ROWS]
+
+def write_csv(df, out):
+    for i, part in enumerate(_export_chunks(df)):
+        out.write(part.to_csv(index=False, header=(i == 0)).encode("utf-8"))
+
+def write_xlsx(df, out, sheet="Data"):
+    # Write-only workbooks stream rows to the zip instead of keeping a cell object per value
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet[:31])
+    ws.append([str(c) for c in df.columns])
+    for part in _export_chunks(df):
+        part = part.astype(object).where(part.notna(), None)
+        for row in part.itertuples(index=False, name=None):
+            ws.append(row)
+    wb.save(out)
+
+EXPORT_WRITERS = {"csv": write_csv, "xlsx": write_xlsx}
+
+def prepared_download(label, write, file_name, mime, key, sig, cols=None):
+    # write(out) runs only when `label` is clicked; the bytes are kept while `sig` stays the same
+    ready = st.session_state.setdefault("_exports", {})
+    c_btn, c_dl = cols or st.columns([1,2])
+    sig = (COMPANY_ID, sig)
+    if c_btn.button(label, key=f"{key}_prep"):
+        with st.spinner(f"Preparing {file_name}..."):
+            out = io.BytesIO()
+            write(out)
+        ready[key] = (sig, out.getvalue())
+    got = ready.get(key)
+    if got and got[0] == sig:
+        c_dl.download_button(f"📥 Download {file_name}", got[1], file_name, mime, key=f"{key}_dl")
+
+def export_buttons(label, data, name, key, version=None):
+    # data may be a DataFrame or a zero-argument callable returning one
+    c1,c2,c3 = st.columns([1,1,2])
+    fmt = c1.selectbox("Format", list(EXPORT_FORMATS), key=f"{key}_fmt", label_visibility="collapsed")
+    ext, mime = EXPORT_FORMATS[fmt]
+    sig = (fmt, version) if callable(data) else (fmt, version, len(data), tuple(data.columns))
+    prepared_download(label, lambda out: EXPORT_WRITERS[ext](data() if callable(data) else data, out),
+                      f"{name}.{ext}", mime, key, sig, cols=(c2, c3))
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  IMPORTS  (uploads read in row batches; XLSX through openpyxl read-only mode)
+# ══════════════════════════════════════════════════════════════════════════════
+
+IMPORT_BATCH_ROWS = 20_000
+PUNCH_COLUMNS     = ["ecode","date","in_time","out_time"]
+HEADER_ALIASES    = {"e_code": "ecode", "emp_code": "ecode", "employee_code": "ecode", "emp_id": "ecode", "employee_id": "ecode",
+                     "employee_name": "name", "punch_date": "date", "attendance_date": "date",
+                     "in": "in_time", "punch_in": "in_time", "check_in": "in_time",
+                     "out": "out_time", "punch_out": "out_time", "check_out": "out_time",
+                     "date_of_joining": "doj", "gross": "gross_salary", "basic_salary": "basic"}
+
+def _header_key(h):
+    key = re.sub(r"[^a-z0-9]+", "_", str(h if h is not None else "").strip().lower()).strip("_")
+    return HEADER_ALIASES.get(key, key)
+
+def map_columns(header, columns):
+    # Target column for each header cell (None when it is not one of `columns`); first match wins
+    seen, out = set(), []
+    for h in header:
+        k = _header_key(h)
+        out.append(k if k in columns and k not in seen else None)
+        seen.add(k)
+    return out
+
+def _cell_str(v):
+    if type(v) is str:
+        return v.strip()
+    if v is None:
+        return ""
+    if isinstance(v, datetime):
+        return v.strftime("%Y-%m-%d") if v.time() == time(0) else v.strftime("%Y-%m-%d %H:%M")
+    if isinstance(v, (date, time)):
+        return v.strftime("%Y-%m-%d") if isinstance(v, date) else v.strftime("%H:%M")
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v).strip()
+
+def _xlsx_batches(uploaded, columns, batch_rows):
+    from openpyxl import load_workbook
+    wb = load_workbook(uploaded, read_only=True, data_only=True)
+    try:
+        ws     = wb.active
+        target = map_columns(next(ws.iter_rows(max_row=1, values_only=True), ()), columns)
+        keep   = [(i, c) for i, c in enumerate(target) if c]
+        batch  = []
+        for row in ws.iter_rows(min_row=2, max_col=max((i for i, _ in keep), default=0) + 1, values_only=True):
+            rec = [_cell_str(row[i]) if i < len(row) else "" for i, _ in keep]
+            if any(rec):
+                batch.append(rec)
+            if len(batch) >= batch_rows:
+                yield pd.DataFrame(batch, columns=[c for _, c in keep]); batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=[c for _, c in keep])
+    finally:
+        wb.close()
+
+def read_upload_batches(uploaded, columns, batch_rows=IMPORT_BATCH_ROWS):
+    # Yields string DataFrames restricted to `columns`; missing columns come back as ""
+    uploaded.seek(0)
+    if uploaded.name.lower().endswith(".csv"):
+        # pandas closes the handle it reads from, so give it its own view of the upload buffer
+        reader = pd.read_csv(io.BytesIO(uploaded.getbuffer()), dtype=str, keep_default_na=False, chunksize=batch_rows)
+        batches = (b.set_axis(map_columns(b.columns, columns), axis=1).loc[:, lambda d: d.columns.notna()] for b in reader)
+    else:
+        batches = _xlsx_batches(uploaded, columns, batch_rows)
+    for b in batches:
+        yield b.reindex(columns=columns, fill_value="").apply(lambda s: s.str.strip())
+
+def preview_upload(uploaded, columns, rows=10):
+    return next(read_upload_batches(uploaded, columns, rows), pd.DataFrame(columns=columns))
+
+# ── Employee bulk upsert ──────────────────────────────────────────────────────
+IMPORT_REQUIRED = ["ecode","name","department","designation","doj","gross_salary","basic","shift"]
+NO_VALUES       = frozenset(["no","false","0","n"])
+
+def _import_errors(mask, imp, column, problem):
+    bad = imp[mask.to_numpy()]
+    return pd.DataFrame({"row": bad.index + 2, "ecode": bad["ecode"].to_numpy(), "column": column,
+                         "value": bad[column].to_numpy(), "problem": problem})
+
+def plan_employee_import(imp, master):
+    # Normalise, validate and diff an employee upload against the master in whole-column passes.
+    # Blank cells leave the existing value alone. Returns the rows to upsert (typed, blanks as NaN),
+    # a per-row error report (rows with errors are skipped), a field-level diff of updates and counts.
+    imp = imp.reindex(columns=EMPLOYEE_COLUMNS, fill_value="").fillna("").astype(str).apply(lambda c: c.str.strip())
+    imp = imp[(imp != "").any(axis=1).to_numpy()]
+    imp["ecode"] = imp["ecode"].str.upper()
+    known = imp["ecode"].isin(master["ecode"].astype(str))
+    errs  = [_import_errors(imp["ecode"].eq(""), imp, "ecode", "E-Code is required"),
+             _import_errors(imp["ecode"].ne("") & imp.duplicated("ecode", keep="last"), imp, "ecode",
+                            "Duplicate e-code in file; the last occurrence is used")]
+    errs += [_import_errors(~known & imp[c].eq(""), imp, c, "Required for a new employee") for c in IMPORT_REQUIRED[1:]]
+
+    typed = imp.replace("", np.nan)
+    for c in SALARY_FIELDS:
+        num = pd.to_numeric(typed[c], errors="coerce")
+        errs += [_import_errors(typed[c].notna() & num.isna(), imp, c, "Not a number"),
+                 _import_errors(num < 0, imp, c, "Cannot be negative")]
+        typed[c] = num
+    for c in [c for c, k in EMPLOYEE_SCHEMA.items() if k == "date"]:
+        d = pd.to_datetime(typed[c], errors="coerce", format="ISO8601")
+        errs.append(_import_errors(typed[c].notna() & d.isna(), imp, c, "Not a date (YYYY-MM-DD)"))
+        typed[c] = d
+    for c, allowed in [(c, k) for c, k in EMPLOYEE_SCHEMA.items() if isinstance(k, list) and k]:
+        canon = {a.lower(): a for a in allowed}
+        if set(allowed) == {"Yes","No"}:
+            canon.update({**{v: "Yes" for v in YES_VALUES}, **{v: "No" for v in NO_VALUES}})
+        low = typed[c].str.lower()
+        typed[c] = low.map(canon)
+        errs.append(_import_errors(low.notna() & typed[c].isna(), imp, c, f"Expected one of: {', '.join(allowed)}"))
+
+    errors = pd.concat(errs, ignore_index=True).sort_values(["row","column"], kind="stable", ignore_index=True)
+    ok     = typed[~(imp.index + 2).isin(errors["row"])]
+
+    cur   = master.drop_duplicates("ecode", keep="last").set_index("ecode")
+    upd   = ok[ok["ecode"].isin(cur.index)].set_index("ecode")
+    cols  = [c for c in EMPLOYEE_COLUMNS if c != "ecode"]
+    new_s = to_storage(upd[cols], EMPLOYEE_SCHEMA).astype(str).to_numpy()
+    old_s = to_storage(cur.loc[upd.index, cols], EMPLOYEE_SCHEMA).astype(str).to_numpy()
+    hit   = new_s != old_s
+    num   = [cols.index(c) for c in SALARY_FIELDS]         # "35000" on the file vs 35000.0 stored is not a change
+    new_f = upd[SALARY_FIELDS].astype(float).to_numpy()
+    old_f = cur.loc[upd.index, SALARY_FIELDS].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+    hit[:, num] = ~np.isclose(new_f, old_f, equal_nan=True)
+    hit  &= upd[cols].notna().to_numpy()
+    r, c  = np.nonzero(hit)
+    diff  = pd.DataFrame({"ecode": upd.index[r], "column": np.array(cols)[c], "old": old_s[r, c], "new": new_s[r, c]})
+    counts = {"new": int((~ok["ecode"].isin(cur.index)).sum()), "updated": int(hit.any(axis=1).sum()),
+              "unchanged": int((~hit.any(axis=1)).sum()), "rejected": int(errors["row"].nunique())}
+    return ok, errors, diff, counts
+
+def apply_employee_import(ok, master):
+    # Upsert: non-blank imported fields win over the master; new e-codes are appended in file order
+    cur = master.drop_duplicates("ecode", keep="last").set_index("ecode").astype(object)
+    upd = ok.set_index("ecode").astype(object)
+    out = upd.combine_first(cur).reindex(cur.index.append(upd.index.difference(cur.index, sort=False)))
+    return out.rename_axis("ecode").reset_index()[EMPLOYEE_COLUMNS]
+
+def process_punch_batch(batch, emp_df, rules):
+    # Raw punches → attendance rows for known employees (sandwich rule is applied after all batches)
+    emp  = emp_df.drop_duplicates("ecode").set_index("ecode")
+    b    = batch.assign(ecode=batch["ecode"].str.upper())
+    b    = b[b["ecode"].isin(emp.index)]
+    shift = b["ecode"].map(emp["shift"].astype(object).where(emp["shift"].notna(), rules.default_shift))
+    calc = pd.DataFrame([calculate_working_hours(i, o, s, rules) for i, o, s in zip(b["in_time"], b["out_time"], shift)],
+                        index=b.index, columns=["working_hours","overtime_hours","early_going_minutes","late_entry_minutes","status"])
+    out = pd.DataFrame({"ecode": b["ecode"], "name": b["ecode"].map(emp["name"]), "date": pd.to_datetime(b["date"], format="%Y-%m-%d", errors="coerce"),
+                        "shift": shift, "in_time": b["in_time"], "out_time": b["out_time"]}).join(calc)
+    out["day"] = out["date"].dt.day_name().fillna("")
+    out["remarks"] = ""
+    return out[ATTENDANCE_COLUMNS]
+
+PARALLEL_MIN_ROWS = 20_000   # smaller uploads are not worth forking for
+
+def attendance_workers(config):
+    # config["attendance"]["workers"]: 0 = one per CPU core, 1 = always serial
+    n = si(config.get("attendance", {}).get("workers", 0))
+    return n if n > 0 else (os.cpu_count() or 1)
+
+def _process_punch_shard(raw, emp_df, rules):
+    # Everything per employee: punch normalisation, working hours, then the sandwich rule per ecode
+    att = process_punch_batch(raw, emp_df, rules)
+    if rules.sandwich_rule and not att.empty:
+        locs = dict(zip(emp_df["ecode"], emp_df["location"].astype(str)))
+        att  = pd.concat([apply_sandwich_rule(grp, rules, locs.get(ec, "")) for ec, grp in att.groupby("ecode")], ignore_index=True)
+    return att
+
+def _shard_worker(queue, shard_no, raw, emp_df, rules):
+    try:
+        queue.put((shard_no, _process_punch_shard(raw, emp_df, rules), None))
+    except Exception as e:
+        queue.put((shard_no, None, repr(e)))
+
+SHARD_POLL_SECONDS = 1.0
+
+def process_punches(raw, emp_df, rules, workers=1):
+    # Shards by ecode so each employee's rows stay together; results are merged in ecode order and
+    # are identical to the serial path. Forked workers inherit the frames and functions instead of
+    # pickling them; if forking is unavailable the upload runs serially, and any shard whose worker
+    # failed or died (OOM, signal) is redone serially here.
+    n = min(workers, raw["ecode"].nunique()) if len(raw) >= PARALLEL_MIN_ROWS else 1
+    parts = None
+    if n > 1 and "fork" in multiprocessing.get_all_start_methods():
+        keys   = raw["ecode"].str.upper().to_numpy(dtype=object)
+        shard  = pd.util.hash_array(keys) % np.uint64(n)
+        ctx    = multiprocessing.get_context("fork")
+        queue  = ctx.Queue()
+        procs  = [ctx.Process(target=_shard_worker, args=(queue, i, raw[shard == i], emp_df, rules), daemon=True) for i in range(n)]
+        for p in procs:
+            p.start()
+        got, idle = {}, 0
+        while len(got) < n and idle < 2:
+            # Results are read before join() so a worker never blocks on a full pipe; once every worker
+            # has exited, one more empty poll drains what they flushed before giving up on the rest
+            try:
+                shard_no, df, err = queue.get(timeout=SHARD_POLL_SECONDS)
+                got[shard_no], idle = (df if err is None else None), 0
+            except Empty:
+                idle = idle + 1 if not any(p.is_alive() for p in procs) else 0
+        for p in procs:
+            p.join(timeout=SHARD_POLL_SECONDS)
+            if p.is_alive():
+                p.terminate()
+        parts = [got.get(i) if got.get(i) is not None else _process_punch_shard(raw[shard == i], emp_df, rules) for i in range(n)]
+    if parts is None:
+        parts, n = [_process_punch_shard(raw, emp_df, rules)], 1
+    att = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=ATTENDANCE_COLUMNS)
+    return att.sort_values("ecode", kind="stable").reset_index(drop=True), n
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+#  STATUTORY & BANK FILES  (PF ECR, ESIC contribution, bank bulk transfer)
+# ══════════════════════════════════════════════════════════════════════════════
+
+STATUTORY_EMPLOYEE_FIELDS = ["uan","esic_no","account_no","ifsc","exit_date"]
+STATUTORY_CHECKS = {   # file -> [(field, full-match pattern, problem)]
+    "PF ECR": [("uan",        r"\d{12}",               "UAN must be 12 digits")],
+    "ESIC":   [("esic_no",    r"\d{10}",               "ESIC IP number must be 10 digits")],
+    "Bank":   [("account_no", r"\d{9,18}",             "Account number must be 9–18 digits"),
+               ("ifsc",       r"[A-Z]{4}0[A-Z0-9]{6}", "IFSC must look like ABCD0123456")],
+}
+ECR_SEP = "#~#"
+
+def statutory_frame(period, run_id=None):
+    # Register rows for the run joined to the identifiers held on the employee master
+    year, month = (int(x) for x in period.split("-"))
+    reg = load_payroll_register(year, month, run_id)
+    if reg is None:
+        return None
+    emp = load_employees()
+    df  = reg.drop(columns=[c for c in STATUTORY_EMPLOYEE_FIELDS if c in reg.columns]).merge(
+              emp[["ecode", *STATUTORY_EMPLOYEE_FIELDS]], on="ecode", how="left")
+    for c in ["uan","esic_no","account_no"]:
+        df[c] = df[c].fillna("").astype(str).str.replace(r"[\s-]", "", regex=True)
+    df["ifsc"] = df["ifsc"].fillna("").astype(str).str.strip().str.upper()
+    df["name"] = df["name"].fillna("").astype(str).str.strip()
+    return df
+
+def validate_statutory(df):
+    # One vectorised pass per rule; returns {file: rows that can be written} and the problem list
+    scope = {"PF ECR": df["pf_employee"] > 0,
+             "ESIC":   (df["esic_employee"] + df["esic_employer"]) > 0,
+             "Bank":   df["net_pay"] > 0}
+    ok, problems = {}, []
+    for file, checks in STATUTORY_CHECKS.items():
+        bad = pd.Series(False, index=df.index)
+        for field, pattern, problem in checks:
+            b = scope[file] & ~df[field].str.fullmatch(pattern)
+            problems.append(df.loc[b, ["ecode","name"]].assign(file=file, field=field, value=df.loc[b, field], problem=problem))
+            bad |= b
+        ok[file] = scope[file] & ~bad
+    dup = scope["Bank"] & df["account_no"].ne("") & df["account_no"].duplicated(keep=False)
+    problems.append(df.loc[dup, ["ecode","name"]].assign(file="Bank", field="account_no", value=df.loc[dup, "account_no"],
+                                                        problem="Account number shared with another employee"))
+    ok["Bank"] &= ~dup
+    return ok, pd.concat(problems, ignore_index=True)
+
+def _amount(s):
+    return s.fillna(0).round().astype("int64").astype(str)
+
+def _paid_days(part):
+    # Registers from before leave reconciliation have no paid_leave_days column
+    leave = part["paid_leave_days"].fillna(0) if "paid_leave_days" in part.columns else 0
+    return part["present_days"].fillna(0) + leave
+
+def ecr_chunks(df, rules):
+    # EPFO ECR 2.0: UAN, name, gross, EPF / EPS / EDLI wages, EE share, EPS share, ER diff, NCP days, refund
+    pct = rules.pf_employee_pct
+    for part in _export_chunks(df):
+        epf  = (part["pf_employee"] * 100 / pct) if pct else part["earned_basic"]
+        eps_w= epf.clip(upper=15000)
+        cols = [part["uan"], part["name"].str.upper().str.replace(ECR_SEP, " ", regex=False),
+                _amount(part["earned_gross"] + part["overtime_pay"]), _amount(epf), _amount(eps_w), _amount(eps_w),
+                _amount(part["pf_employee"]), _amount(part["eps"]), _amount((part["pf_employer"] - part["eps"]).clip(lower=0)),
+                _amount((part["working_days"] - _paid_days(part)).clip(lower=0)), ["0"] * len(part)]
+        if len(part):
+            yield "\n".join(ECR_SEP.join(r) for r in zip(*cols)) + "\n"
+
+def esic_chunks(df, period):
+    # ESIC monthly contribution upload; reason code 2 (left service) with last working day for exits in the month
+    start = pd.Period(period, freq="M")
+    for i, part in enumerate(_export_chunks(df)):
+        days  = _paid_days(part).round().astype("int64")
+        exits = pd.to_datetime(part["exit_date"], errors="coerce")
+        left  = exits.dt.to_period("M").eq(start)
+        yield pd.DataFrame({
+            "IP Number": part["esic_no"], "IP Name": part["name"],
+            "No of Days for which wages paid/payable during the month": days,
+            "Total Monthly Wages": (part["earned_gross"] + part["overtime_pay"]).round(2),
+            "Reason Code for Zero workings days": np.where(left, "2", np.where(days == 0, "0", "")),
+            "Last Working Day": exits.dt.strftime("%d/%m/%Y").where(left, ""),
+        }).to_csv(index=False, header=(i == 0))
+
+def bank_chunks(df, period, mode="NEFT"):
+    narration = f"SALARY {period_label(period).upper()}"
+    for i, part in enumerate(_export_chunks(df)):
+        yield pd.DataFrame({
+            "Payment Mode": mode, "Beneficiary Name": part["name"], "Beneficiary Account No": part["account_no"],
+            "IFSC": part["ifsc"], "Amount": part["net_pay"].round(2).map("{:.2f}".format), "Narration": narration,
+            "Employee Code": part["ecode"],
+        }).to_csv(index=False, header=(i == 0))
+
+def write_chunks(chunks, out):
+    for chunk in chunks:
+        out.write(chunk.encode("utf-8"))
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 #  SIDEBAR NAVIGATION
 # ══════════════════════════════════════════════════════════════════════════════
@@ -429,8 +2609,19 @@ with st.sidebar:
             st.session_state.current_page = key
             st.rerun()
     st.markdown("---")
+    st.selectbox("🏢 Company", list(COMPANIES), format_func=COMPANIES.get, key="company")
     _cfg = load_config()
-    st.markdown(f"**🏢 {_cfg['company']['name']}**")
+    tenant_cache().set_budget(COMPANY_ID, si(_cfg.get("cache_mb"), TENANT_BUDGET_MB) << 20)
+
+# Results held in session state belong to the company they were computed for
+if st.session_state.get("_active_company") != COMPANY_ID:
+    st.session_state.pop("_exports", None)
+    st.session_state["_active_company"] = COMPANY_ID
+
+# Scheduled close: once a day per session, periods older than the working set move to the cold archive
+if load_config().get("archive", {}).get("auto_close") and st.session_state.get("_auto_closed") != (COMPANY_ID, date.today()):
+    st.session_state["_auto_closed"] = (COMPANY_ID, date.today())
+    close_due_periods(load_config())
 
 PAGE = st.session_state.current_page
 MONTHS = ["January","February","March","April","May","June",
@@ -444,17 +2635,18 @@ MONTHS = ["January","February","March","April","May","June",
 if PAGE == "dashboard":
     config  = load_config()
     emp_df  = load_employees()
-    att_df  = load_attendance()
+    has_att = has_attendance()
 
     st.markdown('<div class="page-header"><h1>🏠 Dashboard</h1><p>Welcome to the HR & Payroll Management System</p></div>', unsafe_allow_html=True)
 
     today     = date.today()
-    today_str = str(today)
     total_emp = len(emp_df[emp_df["status"] == "Active"]) if "status" in emp_df.columns else len(emp_df)
-    today_att     = att_df[att_df["date"] == today_str] if not att_df.empty else pd.DataFrame()
+    today_att     = attendance_range(today, today)
     present_today = len(today_att[today_att["status"] == "Present"]) if not today_att.empty else 0
     absent_today  = total_emp - present_today
-    missing_punch = len(today_att[today_att["status"].str.contains("Missing", na=False)]) if not today_att.empty else 0
+    alerts        = attendance_exceptions(None, today - timedelta(days=7), today)
+    missing_alerts= alerts[alerts["kind"].isin(MISSING_KINDS)].drop_duplicates(["date","ecode"])
+    missing_punch = int((missing_alerts["date"] == pd.Timestamp(today)).sum())
 
     c1,c2,c3,c4 = st.columns(4)
     c1.markdown(f'<div class="metric-card"><h3>👥 Total Employees</h3><h1>{total_emp}</h1></div>', unsafe_allow_html=True)
@@ -466,15 +2658,13 @@ if PAGE == "dashboard":
     col_l, col_r = st.columns([3, 2])
     with col_l:
         st.markdown("### 📅 Monthly Attendance Overview")
-        if not att_df.empty:
-            att_df["date"] = pd.to_datetime(att_df["date"], errors="coerce")
-            month_att = att_df[att_df["date"].dt.month == today.month]
+        if has_att:
+            month_att = attendance_month(today.year, today.month)
             if not month_att.empty:
                 daily = month_att.groupby("date")["status"].apply(lambda x:(x=="Present").sum()).reset_index()
                 daily.columns = ["Date","Present Count"]
-                fig = px.bar(daily, x="Date", y="Present Count", color_discrete_sequence=["#3949ab"], title="Daily Present Count This Month")
-                fig.update_layout(showlegend=False, height=300, plot_bgcolor="white", paper_bgcolor="white")
-                st.plotly_chart(fig, use_container_width=True)
+                chart("bar", daily, (file_version(ATTENDANCE_PATH), today.year, today.month), x="Date", y="Present Count",
+                      color_discrete_sequence=["#3949ab"], title="Daily Present Count This Month", layout=dict(showlegend=False))
             else:
                 st.info("No attendance data for this month yet.")
         else:
@@ -483,11 +2673,11 @@ if PAGE == "dashboard":
     with col_r:
         st.markdown("### 🏢 Department Wise Employees")
         if not emp_df.empty and "department" in emp_df.columns:
-            dept = emp_df[emp_df["status"]=="Active"]["department"].value_counts().reset_index()
+            dept = emp_df[emp_df["status"]=="Active"]["department"].value_counts()
+            dept = dept[dept > 0].reset_index()
             dept.columns = ["Department","Count"]
-            fig2 = px.pie(dept, values="Count", names="Department", color_discrete_sequence=px.colors.sequential.Blues_r)
-            fig2.update_layout(height=300, paper_bgcolor="white")
-            st.plotly_chart(fig2, use_container_width=True)
+            chart("pie", dept, file_version(EMPLOYEES_PATH), values="Count", names="Department",
+                  color_discrete_sequence=px.colors.sequential.Blues_r)
         else:
             st.info("Add employees to see department breakdown.")
 
@@ -507,16 +2697,16 @@ if PAGE == "dashboard":
         if st.button("⚙️ Configure Rules", use_container_width=True):
             st.session_state.current_page = "settings"; st.rerun()
 
-    if not att_df.empty:
+    if has_att:
         st.markdown("---")
         st.markdown("### ⚠️ Missing Punch Alerts (Last 7 Days)")
-        att_df["date"] = pd.to_datetime(att_df["date"], errors="coerce")
-        recent  = att_df[att_df["date"] >= pd.Timestamp(today) - pd.Timedelta(days=7)]
-        missing = recent[recent["status"].str.contains("Missing", na=False)]
-        if not missing.empty:
-            st.dataframe(missing[["ecode","name","date","in_time","out_time","status"]].sort_values("date",ascending=False), use_container_width=True, hide_index=True)
+        if not missing_alerts.empty:
+            st.dataframe(missing_alerts[["ecode","name","date","in_time","out_time","status"]], use_container_width=True, hide_index=True)
         else:
             st.success("✅ No missing punch issues in the last 7 days!")
+        other = alerts[~alerts["kind"].isin(MISSING_KINDS)]["kind"].value_counts()
+        if not other.empty:
+            st.caption("Other exceptions (7 days): " + " · ".join(f"{EXCEPTION_KINDS[k]} {n}" for k, n in other.items()))
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -526,6 +2716,9 @@ if PAGE == "dashboard":
 elif PAGE == "employees":
     config = load_config()
     emp_df = load_employees()
+    rules  = compile_rules(config)
+    salary_formula = {c.column: c for c in rules.formula}
+    salary_names   = {c.key: c.name for c in rules.formula}
     st.markdown('<div class="page-header"><h1>👤 Employee Master</h1><p>Manage all employee records, personal details, and salary structure</p></div>', unsafe_allow_html=True)
 
     tab1, tab2, tab3 = st.tabs(["📋 Employee List", "➕ Add / Edit Employee", "📤 Bulk Import"])
@@ -537,19 +2730,26 @@ elif PAGE == "employees":
         dept_filter  = cf2.selectbox("Filter by Department", dept_opts)
         status_filter= cf3.selectbox("Status",["All","Active","Inactive"])
 
-        disp = emp_df.copy()
+        disp = emp_df
         if search:
-            disp = disp[disp["name"].str.contains(search,case=False,na=False)|disp["ecode"].str.contains(search,case=False,na=False)]
+            idx  = employee_search_index()
+            rows, cut = idx.search(search) if idx.size == len(emp_df) else (None, 0)
+            disp = emp_df.iloc[rows] if rows is not None else emp_df[emp_df["name"].str.contains(search,case=False,na=False,regex=False)|emp_df["ecode"].str.contains(search,case=False,na=False,regex=False)]
+        mask = pd.Series(True, index=disp.index)
         if dept_filter!="All":
-            disp = disp[disp["department"]==dept_filter]
+            mask &= disp["department"]==dept_filter
         if status_filter!="All":
-            disp = disp[disp["status"]==status_filter]
+            mask &= disp["status"]==status_filter
+        disp = disp[mask]
 
         st.markdown(f"**{len(disp)} employees found**")
+        if search and cut:
+            st.caption(f"Showing the {MAX_FUZZY_ROWS:,} closest of {MAX_FUZZY_ROWS + cut:,} approximate matches — refine the search to see the rest.")
         show = [c for c in ["ecode","name","department","designation","shift","gross_salary","status","doj"] if c in disp.columns]
-        st.dataframe(disp[show], use_container_width=True, hide_index=True)
+        paged_table(disp, show, "emp_list", default_sort="ecode", ranked=bool(search))
         if not disp.empty:
-            st.download_button("📥 Download Employee List", disp.to_csv(index=False), "employees.csv","text/csv")
+            export_buttons("Export Employee List", disp, "employees", "emp_export",
+                           version=(search, dept_filter, status_filter, file_version(EMPLOYEES_PATH)))
 
     with tab2:
         mode = st.radio("Mode",["Add New Employee","Edit Existing Employee"],horizontal=True)
@@ -559,7 +2759,8 @@ elif PAGE == "employees":
             existing = emp_df[emp_df["ecode"]==sel].iloc[0].to_dict()
 
         def val(k, d=""):
-            return existing.get(k,d) or d
+            v = existing.get(k,d)
+            return d if v is None or (not isinstance(v, str) and pd.isna(v)) else v or d
 
         shifts = [s["name"] for s in config["shifts"]["fixed"]] + ["Open Shift"]
 
@@ -577,7 +2778,9 @@ elif PAGE == "employees":
             mobile = c1.text_input("Mobile", val("mobile"))
             email  = c2.text_input("Email",  val("email"))
             dob    = c3.date_input("Date of Birth", value=pd.to_datetime(val("dob")) if val("dob") else None)
-            address= st.text_area("Address", val("address"), height=60)
+            c1,c2  = st.columns([1,2])
+            location = c1.text_input("Location", val("location"), help="Holidays set up for this location in Settings apply to the employee")
+            address= c2.text_area("Address", val("address"), height=60)
 
             st.markdown("#### 👨‍👩‍👧 Family Details")
             c1,c2,c3 = st.columns(3)
@@ -608,29 +2811,53 @@ elif PAGE == "employees":
             is_open   = c2.selectbox("Shift Type",["Fixed","Open"], index=1 if str(val("is_open_shift")).lower() in ["true","1","yes","open"] else 0)
 
             st.markdown("#### 💰 Salary Structure")
+            st.caption("Only fixed components are entered here; the others are derived from the salary components in Settings when saved.")
+            def sal_input(slot, label, col):
+                # Fixed components are typed in; percentage / calculated ones come from the formula on save
+                comp = salary_formula.get(col)
+                if comp is None:
+                    return slot.number_input(f"{label} (₹)", value=sf(val(col,0)), disabled=True, help="Not an enabled salary component")
+                if comp.kind == "fixed":
+                    return slot.number_input(f"{label} (₹)", value=sf(val(col,0)), min_value=0.0, step=100.0)
+                how = f"{comp.pct:g}% of {'Gross' if comp.of == GROSS_KEY else salary_names.get(comp.of, comp.of)}" \
+                      if comp.kind == "percentage" else "gross salary less the other components"
+                return slot.number_input(f"{label} (₹, derived)", value=sf(val(col,0)), disabled=True, help=f"Derived: {how}")
             c1,c2,c3 = st.columns(3)
             gross   = c1.number_input("Gross Salary (₹)",     value=sf(val("gross_salary",0)),    min_value=0.0, step=100.0)
-            basic_s = c2.number_input("Basic (₹)",            value=sf(val("basic",0)),           min_value=0.0, step=100.0)
-            hra_s   = c3.number_input("HRA (₹)",              value=sf(val("hra",0)),             min_value=0.0, step=100.0)
+            basic_s = sal_input(c2, "Basic",             "basic")
+            hra_s   = sal_input(c3, "HRA",               "hra")
             c1,c2,c3 = st.columns(3)
-            conv_s  = c1.number_input("Conveyance (₹)",       value=sf(val("conveyance",0)),      min_value=0.0, step=100.0)
-            spec_s  = c2.number_input("Special Allowance (₹)",value=sf(val("special_allowance",0)),min_value=0.0,step=100.0)
-            med_s   = c3.number_input("Medical Allowance (₹)",value=sf(val("medical_allowance",0)),min_value=0.0,step=100.0)
+            conv_s  = sal_input(c1, "Conveyance",        "conveyance")
+            spec_s  = sal_input(c2, "Special Allowance", "special_allowance")
+            med_s   = sal_input(c3, "Medical Allowance", "medical_allowance")
             c1,c2 = st.columns(2)
-            food_s  = c1.number_input("Food Allowance (₹)",   value=sf(val("food_allowance",0)),  min_value=0.0, step=100.0)
-            emp_status = c2.selectbox("Employee Status",["Active","Inactive"], index=0 if val("status","Active")=="Active" else 1)
+            food_s  = sal_input(c1, "Food Allowance",    "food_allowance")
+            sal_eff = c2.date_input("Salary Effective From", value=date.today(),
+                                    help="A revised salary applies from the start of this month; earlier months already run get arrears in the next payroll.")
+            c1,c2 = st.columns(2)
+            emp_status = c1.selectbox("Employee Status",["Active","Inactive"], index=0 if val("status","Active")=="Active" else 1)
             c1,c2 = st.columns(2)
             pf_app  = c1.selectbox("PF Applicable",  ["Yes","No"], index=0 if val("pf_applicable","Yes")=="Yes" else 1)
             esic_app= c2.selectbox("ESIC Applicable",["Yes","No"], index=0 if val("esic_applicable","No")=="Yes" else 1)
+            c1,c2 = st.columns(2)
+            regime  = c1.selectbox("Tax Regime",     ["New","Old"], index=1 if val("tax_regime", str(config["tds"].get("default_regime","new")).title())=="Old" else 0,
+                                   help="Used for TDS when it is enabled in Settings")
             submitted = st.form_submit_button("💾 Save Employee", use_container_width=True)
 
+        if existing:
+            hist = salary_history(existing["ecode"])
+            if not hist.empty:
+                with st.expander(f"💰 Salary History ({len(hist)})"):
+                    st.dataframe(hist.replace({"effective_from": {SALARY_BASELINE: "initial"}}).drop(columns=["ecode"]),
+                                 use_container_width=True, hide_index=True)
+
         if submitted:
             if not ecode or not name:
                 st.error("E-Code and Name are required!")
             else:
                 new_row = {
                     "ecode":ecode.upper().strip(),"name":name.strip(),
-                    "department":dept,"designation":desig,
+                    "department":dept,"designation":desig,"location":location.strip(),
                     "doj":str(doj) if doj else "","dob":str(dob) if dob else "",
                     "gender":gender,"mobile":mobile,"email":email,"address":address,
                     "father_name":father,"mother_name":mother,"spouse_name":spouse,
@@ -640,14 +2867,18 @@ elif PAGE == "employees":
                     "shift":shift,"is_open_shift":"Yes" if is_open=="Open" else "No",
                     "gross_salary":gross,"basic":basic_s,"hra":hra_s,"conveyance":conv_s,
                     "special_allowance":spec_s,"medical_allowance":med_s,"food_allowance":food_s,
-                    "pf_applicable":pf_app,"esic_applicable":esic_app,
+                    "pf_applicable":pf_app,"esic_applicable":esic_app,"tax_regime":regime,
                     "status":emp_status,"exit_date":""
                 }
+                derived = evaluate_formula(rules.formula, pd.DataFrame([new_row]))
+                for comp in rules.formula:
+                    if comp.kind != "fixed" and comp.column in new_row:
+                        new_row[comp.column] = round(float(derived[comp.key].iloc[0]), 2)
                 df = load_employees()
                 if mode == "Edit Existing Employee":
                     df = df[df["ecode"] != ecode.upper().strip()]
                 df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-                save_employees(df)
+                save_employees(df, sal_eff)
                 st.success(f"✅ Employee {name} ({ecode}) saved!")
                 st.rerun()
 
@@ -657,18 +2888,35 @@ elif PAGE == "employees":
         st.download_button("📥 Download Import Template", pd.DataFrame(columns=EMPLOYEE_COLUMNS).to_csv(index=False), "employee_template.csv","text/csv")
         uploaded = st.file_uploader("Upload CSV/Excel", type=["csv","xlsx"])
         if uploaded:
-            imp = pd.read_csv(uploaded,dtype=str) if uploaded.name.endswith(".csv") else pd.read_excel(uploaded,dtype=str)
-            st.dataframe(imp.head(10), use_container_width=True)
-            if st.button("✅ Confirm Import"):
-                df = load_employees()
-                for _, row in imp.iterrows():
-                    ec = str(row.get("ecode","")).upper().strip()
-                    if ec and ec in df["ecode"].values:
-                        df = df[df["ecode"]!=ec]
-                df = pd.concat([df, imp], ignore_index=True)
-                save_employees(df)
-                st.success(f"✅ {len(imp)} employees imported!")
-                st.rerun()
+            st.dataframe(preview_upload(uploaded, EMPLOYEE_COLUMNS), use_container_width=True)
+            imp_eff = st.date_input("Salary Effective From", value=date.today(), key="imp_eff",
+                                    help="Applies to employees whose salary fields change in this import.")
+            b1,b2 = st.columns(2)
+            dry_run = b1.button("🔍 Validate (dry run)", use_container_width=True)
+            apply   = b2.button("✅ Confirm Import", use_container_width=True)
+            if dry_run or apply:
+                t0     = perf_counter()
+                imp    = pd.concat(list(read_upload_batches(uploaded, EMPLOYEE_COLUMNS)), ignore_index=True)
+                master = load_employees()
+                ok, errors, diff, counts = plan_employee_import(imp, master)
+                m1,m2,m3,m4 = st.columns(4)
+                m1.metric("New", counts["new"]); m2.metric("Updated", counts["updated"])
+                m3.metric("Unchanged", counts["unchanged"]); m4.metric("Rejected", counts["rejected"])
+                if not errors.empty:
+                    st.warning(f"⚠️ {counts['rejected']} row(s) have errors and will be skipped")
+                    st.dataframe(errors.head(1000), use_container_width=True, hide_index=True)
+                    export_buttons("Export Errors", errors, "employee_import_errors", "imp_err_export",
+                                   version=(uploaded.name, uploaded.size, len(errors)))
+                if not diff.empty:
+                    with st.expander(f"Field changes ({len(diff)})"):
+                        st.dataframe(diff.head(5000), use_container_width=True, hide_index=True)
+                if apply and counts["new"] + counts["updated"]:
+                    save_employees(apply_employee_import(ok, master), imp_eff)
+                    st.success(f"✅ {counts['new']} added · {counts['updated']} updated in {perf_counter() - t0:.1f}s!")
+                elif apply:
+                    st.info("Nothing to import.")
+                else:
+                    st.caption(f"Dry run: validated {len(imp):,} rows in {perf_counter() - t0:.1f}s — nothing saved.")
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -677,8 +2925,9 @@ elif PAGE == "employees":
 
 elif PAGE == "attendance":
     config = load_config()
+    rules  = compile_rules(config)
     emp_df = load_employees()
-    att_df = load_attendance()
+    has_att = has_attendance()
 
     st.markdown('<div class="page-header"><h1>🕐 Attendance Management</h1><p>Track daily attendance, punch details, overtime, and apply attendance rules</p></div>', unsafe_allow_html=True)
     tab1,tab2,tab3,tab4 = st.tabs(["📤 Upload / Enter Attendance","📋 View & Edit","⚠️ Missing Punches","📊 Analytics"])
@@ -691,46 +2940,39 @@ elif PAGE == "attendance":
 
         uploaded = st.file_uploader("Upload Attendance File (CSV/Excel)", type=["csv","xlsx"])
         if uploaded:
-            raw = pd.read_csv(uploaded,dtype=str) if uploaded.name.endswith(".csv") else pd.read_excel(uploaded,dtype=str)
-            st.markdown(f"**Preview: {len(raw)} records**")
-            st.dataframe(raw.head(10), use_container_width=True)
+            st.markdown("**Preview (first 10 rows)**")
+            st.dataframe(preview_upload(uploaded, PUNCH_COLUMNS), use_container_width=True)
 
             if st.button("⚙️ Process & Calculate", use_container_width=True):
                 with st.spinner("Processing..."):
-                    processed = []
-                    for _, row in raw.iterrows():
-                        ec  = str(row.get("ecode","")).upper().strip()
-                        dt  = str(row.get("date","")).strip()
-                        in_t= str(row.get("in_time","")).strip()
-                        out_t=str(row.get("out_time","")).strip()
-                        er  = emp_df[emp_df["ecode"]==ec]
-                        if er.empty: continue
-                        emp     = er.iloc[0]
-                        shift   = emp.get("shift", config["shifts"]["fixed"][0]["name"])
-                        try:    day_name = datetime.strptime(dt,"%Y-%m-%d").strftime("%A")
-                        except: day_name = ""
-                        calc = calculate_working_hours(in_t, out_t, shift, config)
-                        processed.append({"ecode":ec,"name":emp.get("name",""),"date":dt,"day":day_name,
-                            "shift":shift,"in_time":in_t,"out_time":out_t,
-                            "working_hours":calc["working_hours"],"overtime_hours":calc["overtime_hours"],
-                            "early_going_minutes":calc["early_going_minutes"],
-                            "late_entry_minutes":calc["late_entry_minutes"],"status":calc["status"],"remarks":""})
-
-                    new_att = pd.DataFrame(processed)
-                    if config["attendance"]["sandwich_rule"] and not new_att.empty:
-                        results = []
-                        for _, grp in new_att.groupby("ecode"):
-                            results.append(apply_sandwich_rule(grp, config))
-                        new_att = pd.concat(results, ignore_index=True)
+                    t0, n_read, batches = perf_counter(), 0, []
+                    status = st.empty()
+                    for batch in read_upload_batches(uploaded, PUNCH_COLUMNS):
+                        n_read += len(batch)
+                        batches.append(batch)
+                        status.caption(f"⏳ {n_read:,} rows read · {n_read / (perf_counter() - t0):,.0f} rows/s")
+                    status.caption(f"⏳ Calculating {n_read:,} rows...")
+                    raw = pd.concat(batches, ignore_index=True) if batches else pd.DataFrame(columns=PUNCH_COLUMNS)
+                    new_att, used = process_punches(raw, emp_df, rules, attendance_workers(config))
+                    new_att, _ = reconcile_leaves(new_att)
+                    status.empty()
+                    last = closed_through()
+                    if last is not None:
+                        late = pd.to_datetime(new_att["date"]) <= pd.Timestamp(last)
+                        if late.any():
+                            st.warning(f"⚠️ {int(late.sum()):,} rows dated on or before {last:%d %b %Y} skipped — that period is closed")
+                            new_att = new_att[~late.to_numpy()]
 
                     existing = load_attendance()
                     if not existing.empty:
-                        keys = new_att[["ecode","date"]].apply(tuple,axis=1)
-                        ex_keys = existing[["ecode","date"]].apply(tuple,axis=1)
-                        existing = existing[~ex_keys.isin(keys)]
+                        keys = pd.MultiIndex.from_frame(new_att[["ecode","date"]])
+                        existing = existing[~pd.MultiIndex.from_frame(existing[["ecode","date"]]).isin(keys)]
                     final = pd.concat([existing, new_att], ignore_index=True)
-                    save_attendance(final)
+                    save_attendance(final, touched=new_att)
+                    secs = perf_counter() - t0
                     st.success(f"✅ {len(new_att)} records processed!")
+                    st.caption(f"Read {n_read:,} rows in {secs:.1f}s ({n_read / max(secs, 1e-6):,.0f} rows/s) on {used} process{'es' if used > 1 else ''} · "
+                               f"{n_read - len(new_att):,} skipped (unknown e-code)")
                     st.dataframe(new_att, use_container_width=True, hide_index=True)
 
         st.markdown("---")
@@ -750,7 +2992,7 @@ elif PAGE == "attendance":
                 if not er.empty:
                     emp   = er.iloc[0]
                     shift = emp.get("shift","")
-                    calc  = calculate_working_hours(m_in, m_out, shift, config)
+                    calc  = calculate_working_hours(m_in, m_out, shift, rules)
                     try:    dn = m_date.strftime("%A")
                     except: dn = ""
                     nr = {"ecode":m_ec,"name":emp.get("name",""),"date":str(m_date),"day":dn,"shift":shift,
@@ -761,10 +3003,13 @@ elif PAGE == "attendance":
                           "late_entry_minutes":calc["late_entry_minutes"],
                           "status":m_status,"remarks":m_rem}
                     df = load_attendance()
-                    df = df[~((df["ecode"]==m_ec)&(df["date"]==str(m_date)))]
+                    df = df[~((df["ecode"]==m_ec)&(df["date"]==pd.Timestamp(m_date)))]
                     df = pd.concat([df, pd.DataFrame([nr])], ignore_index=True)
-                    save_attendance(df)
-                    st.success("✅ Saved!")
+                    try:
+                        save_attendance(df, touched=pd.DataFrame([nr]))
+                        st.success("✅ Saved!")
+                    except ValueError as e:
+                        st.error(f"❌ {e}")
 
     with tab2:
         st.markdown("### View Attendance Records")
@@ -775,23 +3020,22 @@ elif PAGE == "attendance":
         sel_emp   = c3.selectbox("Employee", ec_opts2)
         sel_status= c4.selectbox("Status Filter",["All","Present","Absent","Missing Punch","Half Day"])
 
-        if not att_df.empty:
-            att_df["date"] = pd.to_datetime(att_df["date"], errors="coerce")
+        if has_att:
             mn = MONTHS.index(sel_month)+1
-            filt = att_df[(att_df["date"].dt.month==mn)&(att_df["date"].dt.year==int(sel_year))]
+            filt = attendance_month(sel_year, mn)
             if sel_emp!="All": filt = filt[filt["ecode"]==sel_emp]
             if sel_status!="All": filt = filt[filt["status"].str.contains(sel_status,na=False)]
-            filt = filt.sort_values(["ecode","date"])
-            filt["date"] = filt["date"].dt.strftime("%Y-%m-%d")
             st.markdown(f"**{len(filt)} records**")
             if not filt.empty:
+                counts = filt["status"].value_counts()
                 s1,s2,s3,s4 = st.columns(4)
-                s1.metric("Present", len(filt[filt["status"]=="Present"]))
-                s2.metric("Absent",  len(filt[filt["status"]=="Absent"]))
-                s3.metric("Total OT hrs", round(pd.to_numeric(filt["overtime_hours"],errors="coerce").sum(),2))
-                s4.metric("Late Entries", len(filt[pd.to_numeric(filt["late_entry_minutes"],errors="coerce")>0]))
-            st.dataframe(filt[["ecode","name","date","day","shift","in_time","out_time","working_hours","overtime_hours","late_entry_minutes","early_going_minutes","status","remarks"]], use_container_width=True, hide_index=True)
-            st.download_button("📥 Download", filt.to_csv(index=False), f"attendance_{sel_month}_{sel_year}.csv","text/csv")
+                s1.metric("Present", int(counts.get("Present", 0)))
+                s2.metric("Absent",  int(counts.get("Absent", 0)))
+                s3.metric("Total OT hrs", round(float(filt["overtime_hours"].sum()),2))
+                s4.metric("Late Entries", int((filt["late_entry_minutes"]>0).sum()))
+            paged_table(filt, ["ecode","name","date","day","shift","in_time","out_time","working_hours","overtime_hours","late_entry_minutes","early_going_minutes","status","remarks"], "att_view", default_sort="date")
+            export_buttons("Export", lambda: filt.sort_values(["ecode","date"]), f"attendance_{sel_month}_{sel_year}", "att_export",
+                           version=(sel_month, sel_year, sel_emp, sel_status, file_version(ATTENDANCE_PATH)))
         else:
             st.info("No records yet.")
 
@@ -799,19 +3043,17 @@ elif PAGE == "attendance":
         st.markdown("### ⚠️ Missing Punch Details")
         c1,c2 = st.columns(2)
         fdate = c1.date_input("Filter Date", value=date.today())
-        mtype = c2.selectbox("Type",["All Missing","Missing IN Punch","Missing OUT Punch"])
-
-        if not att_df.empty:
-            att_df["date"] = pd.to_datetime(att_df["date"], errors="coerce")
-            miss = att_df[att_df["status"].str.contains("Missing",na=False)]
-            if mtype=="Missing IN Punch":
-                miss = att_df[att_df["in_time"].isna()|(att_df["in_time"]=="")]
-            elif mtype=="Missing OUT Punch":
-                miss = att_df[att_df["out_time"].isna()|(att_df["out_time"]=="")]
-            miss = miss[miss["date"].dt.date==fdate]
-            st.markdown(f"**{len(miss)} missing on {fdate}**")
+        ex_types = {"All Missing": MISSING_KINDS, **{v: [k] for k, v in EXCEPTION_KINDS.items()}}
+        mtype = c2.selectbox("Type", list(ex_types))
+        is_missing = set(ex_types[mtype]) <= set(MISSING_KINDS)
+
+        if has_att:
+            miss = attendance_exceptions(ex_types[mtype], fdate, fdate).drop_duplicates(["date","ecode"])
+            st.markdown(f"**{len(miss)} {'missing' if is_missing else 'exceptions'} on {fdate}**")
             if not miss.empty:
-                st.dataframe(miss[["ecode","name","date","shift","in_time","out_time","status"]], use_container_width=True, hide_index=True)
+                cols = ["ecode","name","date","shift","in_time","out_time","status"] + ([] if is_missing else ["detail"])
+                st.dataframe(miss[cols], use_container_width=True, hide_index=True)
+            if not miss.empty and is_missing:
                 st.markdown("#### ✏️ Fix Punch")
                 with st.form("fix_punch"):
                     fx_ec  = st.selectbox("Employee", miss["ecode"].tolist())
@@ -821,11 +3063,10 @@ elif PAGE == "attendance":
                     fx_rem = st.text_input("Remarks","Manual entry by HR")
                     if st.form_submit_button("✅ Update", use_container_width=True):
                         df = load_attendance()
-                        df["date"] = pd.to_datetime(df["date"],errors="coerce")
-                        mask = (df["ecode"]==fx_ec)&(df["date"].dt.date==fdate)
+                        mask = (df["ecode"]==fx_ec)&(df["date"]==pd.Timestamp(fdate))
                         er2  = emp_df[emp_df["ecode"]==fx_ec]
                         if not er2.empty:
-                            calc = calculate_working_hours(fx_in, fx_out, er2.iloc[0].get("shift",""), config)
+                            calc = calculate_working_hours(fx_in, fx_out, er2.iloc[0].get("shift",""), rules)
                             df.loc[mask,"in_time"]             = fx_in
                             df.loc[mask,"out_time"]            = fx_out
                             df.loc[mask,"working_hours"]       = calc["working_hours"]
@@ -834,66 +3075,86 @@ elif PAGE == "attendance":
                             df.loc[mask,"early_going_minutes"] = calc["early_going_minutes"]
                             df.loc[mask,"status"]  = "Present"
                             df.loc[mask,"remarks"] = fx_rem
-                            df["date"] = df["date"].dt.strftime("%Y-%m-%d")
-                            save_attendance(df)
-                            st.success("✅ Updated!")
-                            st.rerun()
-            else:
-                st.success("✅ No missing punches on this date!")
+                            try:
+                                save_attendance(df, touched=df[mask])
+                            except ValueError as e:
+                                st.error(f"❌ {e}")
+                            else:
+                                st.success("✅ Updated!")
+                                st.rerun()
+            elif miss.empty:
+                st.success(f"✅ No {'missing punches' if is_missing else 'exceptions'} on this date!")
         else:
             st.info("No attendance data.")
 
     with tab4:
         st.markdown("### 📊 Attendance Analytics")
-        if att_df.empty:
+        if not has_att:
             st.info("No data to analyze.")
         else:
-            att_df["date"]                = pd.to_datetime(att_df["date"],errors="coerce")
-            att_df["late_entry_minutes"]  = pd.to_numeric(att_df["late_entry_minutes"],errors="coerce").fillna(0)
-            att_df["early_going_minutes"] = pd.to_numeric(att_df["early_going_minutes"],errors="coerce").fillna(0)
-            att_df["overtime_hours"]      = pd.to_numeric(att_df["overtime_hours"],errors="coerce").fillna(0)
-            att_df["working_hours"]       = pd.to_numeric(att_df["working_hours"],errors="coerce").fillna(0)
-
             c1,c2 = st.columns(2)
             an_month = c1.selectbox("Month", MONTHS, index=date.today().month-1, key="an_m")
             an_year  = c2.number_input("Year", value=date.today().year, min_value=2020, max_value=2030, key="an_y")
             mn2 = MONTHS.index(an_month)+1
-            mdata = att_df[(att_df["date"].dt.month==mn2)&(att_df["date"].dt.year==int(an_year))]
+            an_period = period_key(an_year, mn2)
+            mdata = attendance_cube(an_period, an_period)
 
             if mdata.empty:
                 st.warning("No data for selected period.")
             else:
+                by_emp = mdata.groupby(["ecode","name"], as_index=False)[CUBE_MEASURES].sum()
+                an_ver = (_cube_source_stamp(), an_period)
                 col1,col2 = st.columns(2)
                 with col1:
-                    late_df = mdata[mdata["late_entry_minutes"]>0].groupby("name")["late_entry_minutes"].sum().reset_index().sort_values("late_entry_minutes",ascending=False).head(10)
-                    if not late_df.empty:
-                        fig = px.bar(late_df,x="name",y="late_entry_minutes",title="🕐 Top 10 Late Entries (Min)",color_discrete_sequence=["#e53935"])
-                        fig.update_layout(height=300,paper_bgcolor="white",plot_bgcolor="white")
-                        st.plotly_chart(fig,use_container_width=True)
+                    if (by_emp["late_minutes"]>0).any():
+                        chart("bar", by_emp[by_emp["late_minutes"]>0], an_ver, x="name", y="late_minutes", top=10,
+                              title="🕐 Top 10 Late Entries (Min)", color_discrete_sequence=["#e53935"])
                 with col2:
-                    ot_df = mdata[mdata["overtime_hours"]>0].groupby("name")["overtime_hours"].sum().reset_index().sort_values("overtime_hours",ascending=False).head(10)
-                    if not ot_df.empty:
-                        fig2 = px.bar(ot_df,x="name",y="overtime_hours",title="⏰ Top 10 Overtime Hours",color_discrete_sequence=["#2e7d32"])
-                        fig2.update_layout(height=300,paper_bgcolor="white",plot_bgcolor="white")
-                        st.plotly_chart(fig2,use_container_width=True)
-
-                early_df = mdata[mdata["early_going_minutes"]>0].groupby("name")["early_going_minutes"].sum().reset_index().sort_values("early_going_minutes",ascending=False).head(10)
-                if not early_df.empty:
-                    fig3 = px.bar(early_df,x="name",y="early_going_minutes",title="🏃 Early Going (Min)",color_discrete_sequence=["#f57c00"])
-                    fig3.update_layout(height=300,paper_bgcolor="white",plot_bgcolor="white")
-                    st.plotly_chart(fig3,use_container_width=True)
-
-                summary = mdata.groupby(["ecode","name"]).agg(
-                    present_days=("status", lambda x:(x=="Present").sum()),
-                    absent_days =("status", lambda x:(x=="Absent").sum()),
-                    total_hours =("working_hours","sum"),
-                    total_ot    =("overtime_hours","sum"),
-                    total_late  =("late_entry_minutes","sum"),
-                    total_early =("early_going_minutes","sum")
-                ).reset_index()
+                    if (by_emp["ot_hours"]>0).any():
+                        chart("bar", by_emp[by_emp["ot_hours"]>0], an_ver, x="name", y="ot_hours", top=10,
+                              title="⏰ Top 10 Overtime Hours", color_discrete_sequence=["#2e7d32"])
+
+                if (by_emp["early_minutes"]>0).any():
+                    chart("bar", by_emp[by_emp["early_minutes"]>0], an_ver, x="name", y="early_minutes", top=10,
+                          title="🏃 Early Going (Min)", color_discrete_sequence=["#f57c00"])
+
+                summary = by_emp.rename(columns={"present":"present_days","absent":"absent_days","work_hours":"total_hours",
+                                                 "ot_hours":"total_ot","late_minutes":"total_late","early_minutes":"total_early"})
+                summary = summary[["ecode","name","present_days","absent_days","total_hours","total_ot","total_late","total_early"]].round(2)
+                locs = summary["ecode"].map(dict(zip(emp_df["ecode"], emp_df["location"].astype(str)))).fillna("")
+                summary["working_days"]   = locs.map({l: working_days_in_month(rules, an_year, mn2, l) for l in locs.unique()})
+                summary["attendance_pct"] = (100 * summary["present_days"] / summary["working_days"].where(summary["working_days"] > 0)).round(1)
                 st.markdown("#### 📋 Employee Summary")
                 st.dataframe(summary, use_container_width=True, hide_index=True)
-                st.download_button("📥 Download Summary", summary.to_csv(index=False), f"att_summary_{an_month}_{an_year}.csv","text/csv")
+                export_buttons("Export Summary", summary, f"att_summary_{an_month}_{an_year}", "att_sum_export", version=an_ver)
+
+            st.markdown("---")
+            st.markdown("#### 📈 Multi-Month Trends")
+            TREND_METRICS = {"Late minutes": "late_minutes", "Late days": "late_days", "Overtime hours": "ot_hours",
+                             "Early going minutes": "early_minutes", "Working hours": "work_hours",
+                             "Absent days": "absent", "Missing punches": "missing", "Attendance %": "attendance_pct"}
+            t1,t2,t3 = st.columns(3)
+            tr_dim    = t1.selectbox("Group by", ["department","shift"], format_func=str.title, key="tr_dim")
+            tr_metric = t2.selectbox("Metric", list(TREND_METRICS), key="tr_metric")
+            tr_months = t3.slider("Months", 3, 36, 12, key="tr_months")
+            end_p   = period_key(an_year, mn2)
+            start_p = (pd.Period(end_p, freq="M") - (tr_months - 1)).strftime("%Y-%m")
+            trend   = cube_trend(tr_dim, start_p, end_p)
+            if trend.empty:
+                st.info("No attendance in the selected range.")
+            else:
+                trend["attendance_pct"] = (100 * trend["present"] / trend["days"].where(trend["days"] > 0)).round(1)
+                trend[tr_dim] = trend[tr_dim].replace("", "Unassigned")
+                col = TREND_METRICS[tr_metric]
+                chart("line", trend, (_cube_source_stamp(), start_p, end_p), x="month", y=col, color=tr_dim, markers=True,
+                      title=f"{tr_metric} by {tr_dim.title()}", height=360, layout=dict(yaxis_title=tr_metric, xaxis_title="Month"))
+
+                drill = st.selectbox(f"Drill down into {tr_dim}", sorted(trend[tr_dim].unique()), key="tr_drill")
+                emp_tr = cube_trend("ecode", start_p, end_p, where=(tr_dim, "" if drill == "Unassigned" else drill))
+                if not emp_tr.empty:
+                    emp_tr["attendance_pct"] = (100 * emp_tr["present"] / emp_tr["days"].where(emp_tr["days"] > 0)).round(1)
+                    pivot = emp_tr.pivot_table(index=["ecode","name"], columns="month", values=col, aggfunc="sum").reset_index()
+                    st.dataframe(pivot, use_container_width=True, hide_index=True)
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -902,11 +3163,12 @@ elif PAGE == "attendance":
 
 elif PAGE == "payroll":
     config = load_config()
+    rules  = compile_rules(config)
     emp_df = load_employees()
-    att_df = load_attendance()
+    has_att = has_attendance()
 
     st.markdown('<div class="page-header"><h1>💰 Payroll Management</h1><p>Calculate monthly salary, PF, ESIC, overtime and generate payslips</p></div>', unsafe_allow_html=True)
-    tab1,tab2,tab3 = st.tabs(["🧮 Run Payroll","📄 Payslip Generator","📊 Payroll Reports"])
+    tab1,tab2,tab3,tab4 = st.tabs(["🧮 Run Payroll","📄 Payslip Generator","📊 Payroll Reports","🏦 Statutory & Bank Files"])
 
     with tab1:
         st.markdown("### Run Monthly Payroll")
@@ -915,40 +3177,57 @@ elif PAGE == "payroll":
         sel_year  = c2.number_input("Year", value=date.today().year, min_value=2020, max_value=2030)
         month_num = MONTHS.index(sel_month)+1
         _, total_days = calendar.monthrange(int(sel_year), month_num)
-        week_off  = config["attendance"]["week_off"]
-        working_days = sum(1 for d in range(1, total_days+1) if date(int(sel_year), month_num, d).strftime("%A") != week_off)
-        st.info(f"📅 **{sel_month} {sel_year}** | Total Days: {total_days} | Working Days: {working_days} (excl. {week_off}s)")
+        week_off  = rules.week_off
+        month_cal = month_calendar(rules, sel_year, month_num)
+        working_days = int(month_cal["working"].sum())
+        n_holidays   = int((month_cal["holiday"] & ~month_cal["week_off"]).sum())
+        st.info(f"📅 **{sel_month} {sel_year}** | Total Days: {total_days} | Working Days: {working_days} (excl. {week_off}s and {n_holidays} company holidays)")
 
+        full_run = st.checkbox("Force full recalculation", value=False, help="By default only employees whose attendance, salary or payroll rules changed since the last run are recalculated.")
         if st.button("⚙️ Calculate Payroll for All Employees", use_container_width=True):
             if emp_df.empty:
                 st.error("No employees found!")
-            elif att_df.empty:
+            elif not has_att:
                 st.error("No attendance data found!")
+            elif is_period_closed(sel_year, month_num):
+                st.error(f"{sel_month} {sel_year} is closed and archived — its payroll can no longer be rerun.")
             else:
                 with st.spinner("Calculating..."):
-                    att_copy = att_df.copy()
-                    att_copy["date"] = pd.to_datetime(att_copy["date"],errors="coerce")
-                    month_att = att_copy[(att_copy["date"].dt.month==month_num)&(att_copy["date"].dt.year==int(sel_year))]
+                    month_att = attendance_month(sel_year, month_num)
                     active = emp_df[emp_df["status"]=="Active"] if "status" in emp_df.columns else emp_df
-                    results = []
-                    for _, emp in active.iterrows():
-                        ec = emp["ecode"]
-                        ea = month_att[month_att["ecode"]==ec]
-                        present = len(ea[ea["status"]=="Present"])
-                        ot_hrs  = pd.to_numeric(ea["overtime_hours"],errors="coerce").sum()
-                        results.append(calculate_payroll(emp, present, working_days, ot_hrs, config))
-                    pr_df = pd.DataFrame(results)
-                    st.session_state[f"payroll_{sel_month}_{sel_year}"] = pr_df
-                    pr_path = os.path.join(DATA_DIR, f"payroll_{sel_month}_{sel_year}.csv")
-                    pr_df.to_csv(pr_path, index=False)
+                    previous = cached_register(sel_year, month_num)
+                    pr_df, changes, removed, arrears = run_payroll(active, month_att, rules, int(sel_year), month_num, previous, force=full_run)
+                    if previous is None or len(changes) or removed:
+                        run_id = save_payroll_run(sel_year, month_num, pr_df, arrears)
+                        remember_register(sel_year, month_num, run_id, pr_df)
+                        st.caption(f"🗂️ Saved as run #{run_id} · 🔁 {len(changes)} recalculated · {len(pr_df) - len(changes)} unchanged · {len(removed)} removed")
+                    else:
+                        st.caption("🗂️ No inputs changed since the last run — register unchanged")
+                    if not changes.empty and previous is not None:
+                        with st.expander(f"Changed rows ({len(changes)})", expanded=len(changes) <= 20):
+                            st.dataframe(changes, use_container_width=True, hide_index=True)
+                    if not arrears.empty:
+                        with st.expander(f"💸 Arrears posted: {arrears['ecode'].nunique()} employees · ₹{arrears['net_pay'].sum():,.0f} net"):
+                            if (arrears["period"] == period_key(sel_year, month_num)).any():
+                                st.caption("Negative lines for this period take back arrears already paid for it in a later payroll.")
+                            st.dataframe(arrears, use_container_width=True, hide_index=True)
                     st.success(f"✅ Payroll calculated for {len(pr_df)} employees!")
                     s1,s2,s3,s4 = st.columns(4)
                     s1.metric("Total Gross",       f"₹{pr_df['earned_gross'].sum():,.0f}")
                     s2.metric("Total PF Employer", f"₹{pr_df['pf_employer'].sum():,.0f}")
                     s3.metric("Total OT Pay",      f"₹{pr_df['overtime_pay'].sum():,.0f}")
                     s4.metric("Total Net Pay",     f"₹{pr_df['net_pay'].sum():,.0f}")
-                    st.dataframe(pr_df, use_container_width=True, hide_index=True)
-                    st.download_button("📥 Download Payroll", pr_df.to_csv(index=False), f"payroll_{sel_month}_{sel_year}.csv","text/csv")
+                    st.dataframe(pr_df.drop(columns=["input_hash"], errors="ignore"), use_container_width=True, hide_index=True)
+        pr_last = cached_register(sel_year, month_num)
+        if pr_last is not None:
+            export_buttons("Export Payroll", pr_last.drop(columns=["input_hash"], errors="ignore"), f"payroll_{sel_month}_{sel_year}",
+                           "pr_export", version=file_version(PAYROLL_DB_PATH))
+        rc = register_cache().usage()
+        rc = rc[rc["company"] == COMPANY_ID] if not rc.empty else rc
+        if not rc.empty:
+            r = rc.iloc[0]
+            st.caption(f"🧠 Register cache: {r['entries']} periods · {r['used_mb']} / {r['budget_mb']} MB · "
+                       f"{r['hits']} hits · {r['misses']} misses · {r['evictions']} evictions")
 
     with tab2:
         st.markdown("### 📄 Generate Payslip")
@@ -959,9 +3238,7 @@ elif PAGE == "payroll":
         ps_ec    = c3.selectbox("Employee E-Code", ec_opts) if ec_opts else c3.text_input("E-Code")
 
         if st.button("🖨️ Generate Payslip", use_container_width=True):
-            pk   = f"payroll_{ps_month}_{ps_year}"
-            prp  = os.path.join(DATA_DIR, f"payroll_{ps_month}_{ps_year}.csv")
-            pr_df= st.session_state.get(pk) or (pd.read_csv(prp) if os.path.exists(prp) else None)
+            pr_df= cached_register(ps_year, MONTHS.index(ps_month)+1)
             if pr_df is None:
                 st.error("Please run payroll first!")
             else:
@@ -973,6 +3250,12 @@ elif PAGE == "payroll":
                     ei = emp_df[emp_df["ecode"]==ps_ec]
                     e  = ei.iloc[0] if not ei.empty else {}
                     def eg(k): return e.get(k,"") if hasattr(e,"get") else ""
+                    # Earnings rows follow the salary formula; components since removed still show on the runs that paid them
+                    labels = {f"earned_{c.key}": c.name for c in rules.formula}
+                    labels.update({c: c[7:].replace("_"," ").title() for c in p.index
+                                   if c.startswith("earned_") and c != "earned_gross" and c not in labels and sf(p[c])})
+                    earning_rows = "".join(f'<tr><td>{lbl}</td><td align="right">₹{sf(p.get(c,0)):,.2f}</td></tr>' for c, lbl in labels.items())
+                    tds_row = f'<tr><td>TDS (Income Tax)</td><td align="right">₹{sf(p.get("tds",0)):,.2f}</td></tr>' if "tds" in p.index else ""
                     st.markdown(f"""
                     <div style="max-width:700px;margin:0 auto;font-family:'Segoe UI',sans-serif;border:1px solid #ddd;border-radius:12px;overflow:hidden;">
                         <div style="background:linear-gradient(135deg,#1a237e,#3949ab);color:white;padding:24px;">
@@ -985,19 +3268,16 @@ elif PAGE == "payroll":
                                 <tr><td><b>Department:</b> {eg('department')}</td><td><b>Designation:</b> {eg('designation')}</td></tr>
                                 <tr><td><b>Bank:</b> {eg('bank_name')}</td><td><b>Account:</b> {eg('account_no')}</td></tr>
                                 <tr><td><b>UAN:</b> {eg('uan')}</td><td><b>Days Worked:</b> {p.get('present_days',0)}</td></tr>
+                                <tr><td></td><td><b>Paid Leave:</b> {p.get('paid_leave_days',0) or 0}</td></tr>
                             </table>
                         </div>
                         <div style="display:flex;padding:0 20px 20px;">
                             <div style="flex:1;margin-right:12px;">
                                 <h4 style="color:#1a237e;border-bottom:2px solid #3949ab;padding-bottom:6px;">💚 EARNINGS</h4>
                                 <table style="width:100%;font-size:13px;">
-                                    <tr><td>Basic</td><td align="right">₹{p.get('earned_basic',0):,.2f}</td></tr>
-                                    <tr><td>HRA</td><td align="right">₹{p.get('earned_hra',0):,.2f}</td></tr>
-                                    <tr><td>Conveyance</td><td align="right">₹{p.get('earned_conveyance',0):,.2f}</td></tr>
-                                    <tr><td>Special Allowance</td><td align="right">₹{p.get('earned_special',0):,.2f}</td></tr>
-                                    <tr><td>Medical</td><td align="right">₹{p.get('earned_medical',0):,.2f}</td></tr>
-                                    <tr><td>Food</td><td align="right">₹{p.get('earned_food',0):,.2f}</td></tr>
+                                    {earning_rows}
                                     <tr><td>Overtime Pay</td><td align="right">₹{p.get('overtime_pay',0):,.2f}</td></tr>
+                                    <tr><td>Arrears (net)</td><td align="right">₹{sf(p.get('arrears_net_pay',0)):,.2f}</td></tr>
                                     <tr style="font-weight:bold;border-top:1px solid #ddd;">
                                         <td>Gross Earned</td><td align="right">₹{p.get('earned_gross',0):,.2f}</td>
                                     </tr>
@@ -1008,6 +3288,7 @@ elif PAGE == "payroll":
                                 <table style="width:100%;font-size:13px;">
                                     <tr><td>PF Employee ({config['pf']['employee_percentage']}%)</td><td align="right">₹{p.get('pf_employee',0):,.2f}</td></tr>
                                     <tr><td>ESIC Employee</td><td align="right">₹{p.get('esic_employee',0):,.2f}</td></tr>
+                                    {tds_row}
                                     <tr style="font-weight:bold;border-top:1px solid #ddd;">
                                         <td>Total Deductions</td><td align="right">₹{p.get('total_deductions',0):,.2f}</td>
                                     </tr>
@@ -1032,28 +3313,83 @@ elif PAGE == "payroll":
 
     with tab3:
         st.markdown("### 📊 Payroll Reports")
-        pr_files = [f for f in os.listdir(DATA_DIR) if f.startswith("payroll_") and f.endswith(".csv")]
-        if not pr_files:
+        runs = payroll_runs()
+        if runs.empty:
             st.info("No payroll data. Run payroll first.")
         else:
-            sel_file = st.selectbox("Select Period", pr_files)
-            rdf = pd.read_csv(os.path.join(DATA_DIR, sel_file))
-            r1,r2,r3,r4 = st.columns(4)
-            r1.metric("Employees", len(rdf))
-            r2.metric("Total Gross",    f"₹{pd.to_numeric(rdf['earned_gross'],errors='coerce').sum():,.0f}")
-            r3.metric("Total PF Both",  f"₹{(pd.to_numeric(rdf['pf_employee'],errors='coerce')+pd.to_numeric(rdf['pf_employer'],errors='coerce')).sum():,.0f}")
-            r4.metric("Total Net Pay",  f"₹{pd.to_numeric(rdf['net_pay'],errors='coerce').sum():,.0f}")
-            col1,col2 = st.columns(2)
-            with col1:
-                fig = px.bar(rdf.sort_values("net_pay",ascending=False).head(15),x="name",y="net_pay",title="Top 15 Earners",color_discrete_sequence=["#1a237e"])
-                fig.update_layout(height=350,paper_bgcolor="white",plot_bgcolor="white")
-                st.plotly_chart(fig,use_container_width=True)
-            with col2:
-                fig2 = px.scatter(rdf,x="present_days",y="net_pay",hover_data=["name"],title="Days vs Net Pay",color_discrete_sequence=["#3949ab"])
-                fig2.update_layout(height=350,paper_bgcolor="white",plot_bgcolor="white")
-                st.plotly_chart(fig2,use_container_width=True)
-            st.dataframe(rdf, use_container_width=True, hide_index=True)
-            st.download_button("📥 Download", rdf.to_csv(index=False), sel_file,"text/csv")
+            periods = runs["period"].drop_duplicates().tolist()
+            reg_ver = (len(runs), runs["created_at"].max())
+            c1,c2 = st.columns([2,1])
+            sel_period = c1.selectbox("Select Period", periods, format_func=period_label)
+            run_ids    = runs.loc[runs["period"]==sel_period, "run_id"].tolist()
+            sel_run    = c2.selectbox("Run", run_ids, format_func=lambda r: f"#{r}" + (" (latest)" if r == run_ids[0] else ""))
+            py, pm = (int(x) for x in sel_period.split("-"))
+            rdf = load_payroll_register(py, pm, sel_run)
+            if rdf is None:
+                st.warning(f"Run #{sel_run} of {period_label(sel_period)} is not available — its archived register is missing.")
+            else:
+                r1,r2,r3,r4 = st.columns(4)
+                r1.metric("Employees", len(rdf))
+                r2.metric("Total Gross",    f"₹{rdf['earned_gross'].sum():,.0f}")
+                r3.metric("Total PF Both",  f"₹{(rdf['pf_employee']+rdf['pf_employer']).sum():,.0f}")
+                r4.metric("Total Net Pay",  f"₹{rdf['net_pay'].sum():,.0f}")
+                run_ver = (sel_period, sel_run)
+                col1,col2 = st.columns(2)
+                with col1:
+                    chart("bar", rdf, run_ver, x="name", y="net_pay", top=15, title="Top 15 Earners",
+                          color_discrete_sequence=["#1a237e"], height=350)
+                with col2:
+                    chart("scatter", rdf, run_ver, x="present_days", y="net_pay", hover_data=["name"], title="Days vs Net Pay",
+                          color_discrete_sequence=["#3949ab"], height=350)
+                st.dataframe(rdf.drop(columns=["input_hash"], errors="ignore"), use_container_width=True, hide_index=True)
+                export_buttons("Export", lambda: rdf.drop(columns=["input_hash"], errors="ignore"), f"payroll_{sel_period}_run{sel_run}",
+                               "pr_report_export", version=run_ver)
+
+            st.markdown("---")
+            st.markdown("### 📈 Cost Trends Across Periods")
+            dcost = payroll_department_cost(periods[-1], periods[0])
+            if not dcost.empty:
+                dcost["Period"] = dcost["period"].map(period_label)
+                chart("bar", dcost, reg_ver, x="Period", y="total_cost", color="department",
+                      title="Department-wise Cost by Month", height=380,
+                      category_orders={"Period": [period_label(p) for p in sorted(dcost["period"].unique())]})
+            tr_ec = st.selectbox("Employee trend", emp_df["ecode"].tolist() if not emp_df.empty else [], key="pr_trend_ec")
+            if tr_ec:
+                hist = payroll_employee_history(tr_ec)
+                if hist.empty:
+                    st.info("No payroll history for this employee.")
+                else:
+                    hist["Period"] = hist["period"].map(period_label)
+                    chart("line", hist, reg_ver, x="Period", y=["earned_gross","net_pay"], markers=True,
+                          title=f"Pay Trend — {tr_ec}", height=320)
+
+    with tab4:
+        st.markdown("### 🏦 Statutory & Bank Files")
+        st_runs = payroll_runs()
+        if st_runs.empty:
+            st.info("No payroll data. Run payroll first.")
+        else:
+            c1,c2 = st.columns([2,1])
+            st_period = c1.selectbox("Period", st_runs["period"].drop_duplicates().tolist(), format_func=period_label, key="st_period")
+            st_ids    = st_runs.loc[st_runs["period"]==st_period, "run_id"].tolist()
+            st_run    = c2.selectbox("Run", st_ids, format_func=lambda r: f"#{r}" + (" (latest)" if r == st_ids[0] else ""), key="st_run")
+            sdf = statutory_frame(st_period, st_run)
+            if sdf is None:
+                st.warning(f"Run #{st_run} of {period_label(st_period)} is not available — its archived register is missing.")
+            else:
+                ok, problems = validate_statutory(sdf)
+                st_ver = (st_period, st_run, file_version(EMPLOYEES_PATH))
+                files = [("PF ECR",  f"ECR_{st_period}.txt",  "text/plain", lambda out: write_chunks(ecr_chunks(sdf[ok["PF ECR"]], rules), out)),
+                         ("ESIC",    f"ESIC_{st_period}.csv", "text/csv",   lambda out: write_chunks(esic_chunks(sdf[ok["ESIC"]], st_period), out)),
+                         ("Bank",    f"BANK_{st_period}.csv", "text/csv",   lambda out: write_chunks(bank_chunks(sdf[ok["Bank"]], st_period), out))]
+                for name, file_name, mime, write in files:
+                    n_ok = int(ok[name].sum()); n_bad = int((problems["file"] == name).sum())
+                    st.markdown(f"**{name}** — {n_ok} employees" + (f" · ⚠️ {n_bad} excluded" if n_bad else ""))
+                    prepared_download(f"Generate {name}", write, file_name, mime, f"st_{name.split()[0].lower()}", st_ver)
+                if not problems.empty:
+                    st.markdown("#### ⚠️ Validation Issues")
+                    st.caption("These employees are left out of the file until their master data is fixed.")
+                    st.dataframe(problems, use_container_width=True, hide_index=True)
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -1078,7 +3414,6 @@ elif PAGE == "leaves":
 
         filt = leaves_df.copy()
         if not filt.empty:
-            filt["from_date"] = pd.to_datetime(filt["from_date"],errors="coerce")
             if lr_month!="All":
                 filt = filt[filt["from_date"].dt.month == MONTHS.index(lr_month)+1]
             filt = filt[filt["from_date"].dt.year==int(lr_year)]
@@ -1087,7 +3422,8 @@ elif PAGE == "leaves":
             st.markdown(f"**{len(filt)} records**")
             st.dataframe(filt, use_container_width=True, hide_index=True)
             if not filt.empty:
-                st.download_button("📥 Download", filt.to_csv(index=False),"leave_register.csv","text/csv")
+                export_buttons("Export", filt, "leave_register", "lr_export",
+                               version=(lr_month, lr_year, lr_type, lr_status, file_version(LEAVES_PATH)))
         else:
             st.info("No leave records.")
 
@@ -1151,7 +3487,8 @@ elif PAGE == "leaves":
                     "SL Entitled":b["sl_entitled"],"SL Taken":b["sl_taken"],"SL Balance":b["sl_balance"]})
             bdf = pd.DataFrame(bals)
             st.dataframe(bdf, use_container_width=True, hide_index=True)
-            st.download_button("📥 Download", bdf.to_csv(index=False), f"leave_balance_{bal_year}.csv","text/csv")
+            export_buttons("Export", bdf, f"leave_balance_{bal_year}", "bal_export",
+                           version=(bal_year, file_version(EMPLOYEES_PATH, LEAVES_PATH)))
         else:
             st.info("No employee data found.")
 
@@ -1164,15 +3501,32 @@ elif PAGE == "settings":
     config = load_config()
     st.markdown('<div class="page-header"><h1>⚙️ Settings & Rules</h1><p>Customize all rules, shifts, salary components, PF, ESIC, leave policies — fully flexible</p></div>', unsafe_allow_html=True)
 
-    tab1,tab2,tab3,tab4,tab5,tab6 = st.tabs(["🏢 Company","⏰ Shifts & Attendance","💰 Salary Components","🏛️ PF & ESIC","🌴 Leave Policy","📋 Raw Config"])
+    tab1,tab2,tab3,tab4,tab5,tab7,tab8,tab9,tab6 = st.tabs(["🏢 Company","⏰ Shifts & Attendance","💰 Salary Components","🏛️ PF & ESIC","🌴 Leave Policy","📅 Holidays","🕓 Change History","🗄️ Archive","📋 Raw Config"])
 
     with tab1:
         with st.form("co_form"):
             cn = st.text_input("Company Name", config["company"]["name"])
             ca = st.text_area("Address",       config["company"].get("address",""))
+            cm = st.number_input("Cache budget (MB)", value=si(config.get("cache_mb"), TENANT_BUDGET_MB), min_value=8, max_value=TENANT_CACHE_MB,
+                                 help="Memory this company may hold in the shared in-process cache before its oldest entries are evicted.")
             if st.form_submit_button("💾 Save", use_container_width=True):
-                config["company"]["name"] = cn; config["company"]["address"] = ca
-                save_config(config); st.success("✅ Saved!")
+                config["company"]["name"] = cn; config["company"]["address"] = ca; config["cache_mb"] = int(cm)
+                save_config(config)
+                save_companies({**COMPANIES, COMPANY_ID: cn})
+                st.success("✅ Saved!")
+
+        st.markdown("#### 🏢 Companies")
+        st.caption("Each company keeps its own employees, attendance, leaves, payroll register and rules.")
+        with st.form("new_company", clear_on_submit=True):
+            new_co = st.text_input("New company name")
+            if st.form_submit_button("➕ Add Company") and new_co.strip():
+                st.session_state["_switch_company"] = add_company(new_co)
+                st.rerun()
+        usage = tenant_cache().usage()
+        if not usage.empty:
+            usage["company"] = usage["company"].map(lambda c: COMPANIES.get(c, c))
+            st.markdown("##### Shared cache")
+            st.dataframe(usage, use_container_width=True, hide_index=True)
 
     with tab2:
         with st.form("att_form"):
@@ -1181,12 +3535,15 @@ elif PAGE == "settings":
             week_off= st.selectbox("Week Off Day",["Sunday","Saturday","Monday"],index=["Sunday","Saturday","Monday"].index(config["attendance"]["week_off"]))
             sandwich= st.checkbox("Enable Sandwich Rule", value=config["attendance"]["sandwich_rule"])
             min_days= st.number_input("Min Working Days/Week", value=si(config["attendance"]["min_days_per_week"]), min_value=1, max_value=6)
+            workers = st.number_input("Upload worker processes", value=si(config["attendance"].get("workers", 0)), min_value=0, max_value=64,
+                                      help=f"0 = one per CPU core ({os.cpu_count()} here), 1 = process uploads in the app process only.")
             if st.form_submit_button("💾 Save Attendance Rules", use_container_width=True):
                 config["shifts"]["grace_period_minutes"]     = grace
                 config["shifts"]["overtime_threshold_minutes"]= ot_thr
                 config["attendance"]["week_off"]             = week_off
                 config["attendance"]["sandwich_rule"]        = sandwich
                 config["attendance"]["min_days_per_week"]    = min_days
+                config["attendance"]["workers"]              = int(workers)
                 save_config(config); st.success("✅ Saved!")
 
         st.markdown("---")
@@ -1198,7 +3555,7 @@ elif PAGE == "settings":
             sn = c1.text_input("Name",          s["name"],         key=f"sn{i}")
             ss = c2.text_input("Start (HH:MM)", s["start"],        key=f"ss{i}")
             se = c3.text_input("End (HH:MM)",   s["end"],          key=f"se{i}")
-            sh = c4.number_input("Hrs",         sf(s.get("total_hours"), 9.0), key=f"sh{i}", min_value=0.0)
+            sh = c4.number_input("Hrs", value=sf(s.get("total_hours"), 9.0), key=f"sh{i}", min_value=0.0)
             upd_shifts.append({"name":sn,"start":ss,"end":se,"total_hours":sh})
 
         st.markdown("#### ➕ Add New Shift")
@@ -1206,7 +3563,7 @@ elif PAGE == "settings":
         nsn = c1.text_input("Name","",      key="nsn")
         nss = c2.text_input("Start","09:00",key="nss")
         nse = c3.text_input("End","18:00",  key="nse")
-        nsh = c4.number_input("Hrs",9.0,   key="nsh")
+        nsh = c4.number_input("Hrs", value=9.0,   key="nsh")
         b1,b2 = st.columns(2)
         if b1.button("💾 Save Shifts", use_container_width=True):
             config["shifts"]["fixed"] = upd_shifts
@@ -1231,10 +3588,14 @@ elif PAGE == "settings":
                 ctype    = st.selectbox("Type",["fixed","percentage","calculated"],
                                         index=["fixed","percentage","calculated"].index(comp.get("type","fixed")), key=f"ctype{i}")
                 uc = {"name":cname,"type":ctype,"taxable":ctaxable,"enabled":cenabled}
+                if ctype=="fixed" and component_key(cname) not in COMPONENT_COLUMNS:
+                    uc["value"]          = st.number_input("Monthly amount (when not on the employee master)",
+                                                           value=sf(comp.get("value", 0)), min_value=0.0, key=f"camt{i}")
                 if ctype=="percentage":
                     cc1,cc2 = st.columns(2)
-                    uc["value"]          = cc1.number_input("%", sf(comp.get("value", 40), 40), key=f"cpct{i}")
-                    uc["percentage_of"]  = cc2.text_input("Of", comp.get("percentage_of","Basic"), key=f"cpof{i}")
+                    uc["value"]          = cc1.number_input("%", value=sf(comp.get("value", 40), 40), key=f"cpct{i}")
+                    uc["percentage_of"]  = cc2.text_input("Of", comp.get("percentage_of","Basic"), key=f"cpof{i}",
+                                                          help="Name of another component, or Gross for the employee's gross salary")
                 upd_comps.append(uc)
 
         st.markdown("#### ➕ Add Component")
@@ -1245,17 +3606,29 @@ elif PAGE == "settings":
             nctax  = nc3.checkbox("Taxable",True)
             if st.form_submit_button("Add"):
                 if ncname:
-                    upd_comps.append({"name":ncname,"type":nctype,"taxable":nctax,"enabled":True})
+                    added = upd_comps + [{"name":ncname,"type":nctype,"taxable":nctax,"enabled":True}]
+                    try:
+                        compile_formula(added)
+                    except ValueError as e:
+                        st.error(f"❌ {e}")
+                    else:
+                        config["salary_components"]["components"] = added
+                        save_config(config); st.rerun()
 
         if st.button("💾 Save Components", use_container_width=True):
-            config["salary_components"]["components"] = upd_comps
-            save_config(config); st.success("✅ Saved!")
+            try:
+                formula = compile_formula(upd_comps)
+            except ValueError as e:
+                st.error(f"❌ {e}")
+            else:
+                config["salary_components"]["components"] = upd_comps
+                save_config(config); st.success("✅ Saved! Evaluation order: " + " → ".join(c.name for c in formula))
 
         st.markdown("---")
         st.markdown("### ⏰ Overtime")
         with st.form("ot_form"):
             ot_en   = st.checkbox("OT Enabled",        config["overtime"]["enabled"])
-            ot_rate = st.number_input("OT Multiplier", sf(config["overtime"]["rate_multiplier"], 1.5), min_value=1.0, max_value=3.0, step=0.5)
+            ot_rate = st.number_input("OT Multiplier", value=sf(config["overtime"]["rate_multiplier"], 1.5), min_value=1.0, max_value=3.0, step=0.5)
             ot_base = st.selectbox("OT Base",["Basic","Gross"], index=["Basic","Gross"].index(config["overtime"]["calculation_base"]))
             if st.form_submit_button("💾 Save OT"):
                 config["overtime"]["enabled"]          = ot_en
@@ -1268,13 +3641,13 @@ elif PAGE == "settings":
         with st.form("pf_form"):
             pf_en  = st.checkbox("PF Enabled", config["pf"]["enabled"])
             c1,c2  = st.columns(2)
-            pf_emp = c1.number_input("Employee PF %", sf(config["pf"]["employee_percentage"], 12), min_value=0.0, max_value=100.0, step=0.5)
-            pf_er  = c2.number_input("Employer PF %", sf(config["pf"]["employer_percentage"], 12), min_value=0.0, max_value=100.0, step=0.5)
+            pf_emp = c1.number_input("Employee PF %", value=sf(config["pf"]["employee_percentage"], 12), min_value=0.0, max_value=100.0, step=0.5)
+            pf_er  = c2.number_input("Employer PF %", value=sf(config["pf"]["employer_percentage"], 12), min_value=0.0, max_value=100.0, step=0.5)
             pf_base_opts = ["Basic","Basic + DA","Gross"]
             pf_base = st.selectbox("PF Base", pf_base_opts, index=pf_base_opts.index(config["pf"]["pf_base"]) if config["pf"]["pf_base"] in pf_base_opts else 0)
             pf_cap = st.checkbox("Cap at ₹15,000 Basic", value=config["pf"]["cap_at_15000"])
             st.info("💡 Uncheck = PF on actual Basic (above ₹15,000 too)")
-            eps_pct= st.number_input("EPS %", sf(config["pf"]["eps_percentage"], 8.33), min_value=0.0, max_value=20.0, step=0.5)
+            eps_pct= st.number_input("EPS %", value=sf(config["pf"]["eps_percentage"], 8.33), min_value=0.0, max_value=20.0, step=0.5)
             if st.form_submit_button("💾 Save PF", use_container_width=True):
                 config["pf"]["enabled"]             = pf_en
                 config["pf"]["employee_percentage"] = pf_emp
@@ -1289,9 +3662,9 @@ elif PAGE == "settings":
         with st.form("esic_form"):
             esic_en  = st.checkbox("ESIC Enabled", config["esic"]["enabled"])
             c1,c2    = st.columns(2)
-            esic_emp = c1.number_input("Employee %", sf(config["esic"]["employee_percentage"], 0.75), min_value=0.0, max_value=10.0, step=0.25)
-            esic_er  = c2.number_input("Employer %", sf(config["esic"]["employer_percentage"], 3.25), min_value=0.0, max_value=10.0, step=0.25)
-            esic_ceil= st.number_input("Wage Ceiling (₹)", si(config["esic"]["wage_ceiling"], 21000), min_value=0, step=1000)
+            esic_emp = c1.number_input("Employee %", value=sf(config["esic"]["employee_percentage"], 0.75), min_value=0.0, max_value=10.0, step=0.25)
+            esic_er  = c2.number_input("Employer %", value=sf(config["esic"]["employer_percentage"], 3.25), min_value=0.0, max_value=10.0, step=0.25)
+            esic_ceil= st.number_input("Wage Ceiling (₹)", value=si(config["esic"]["wage_ceiling"], 21000), min_value=0, step=1000)
             if st.form_submit_button("💾 Save ESIC", use_container_width=True):
                 config["esic"]["enabled"]             = esic_en
                 config["esic"]["employee_percentage"] = esic_emp
@@ -1301,30 +3674,52 @@ elif PAGE == "settings":
 
         st.markdown("---")
         st.markdown("### TDS & Professional Tax")
-        st.info("Both are currently **disabled** as per your requirement.")
+        st.caption("TDS projects each employee's taxable salary for the financial year (April–March) from the payroll "
+                   "already run plus the remaining months, and deducts the balance of the annual tax evenly.")
+        tds_cfg = {**DEFAULT_CONFIG["tds"], **config["tds"]}
         with st.form("tds_pt"):
-            tds_on = st.checkbox("Enable TDS",               config["tds"]["enabled"])
-            pt_on  = st.checkbox("Enable Professional Tax",  config["professional_tax"]["enabled"])
+            c1,c2,c3 = st.columns(3)
+            tds_on  = c1.checkbox("Enable TDS",              tds_cfg["enabled"])
+            pt_on   = c1.checkbox("Enable Professional Tax", config["professional_tax"]["enabled"])
+            tds_reg = c2.selectbox("Default Regime", list(tds_cfg["regimes"]),
+                                   index=list(tds_cfg["regimes"]).index(tds_cfg["default_regime"]) if tds_cfg["default_regime"] in tds_cfg["regimes"] else 0)
+            tds_ces = c3.number_input("Cess %", value=sf(tds_cfg["cess_percentage"], 4), min_value=0.0)
+            upd_regimes = {}
+            for rname, r in tds_cfg["regimes"].items():
+                st.markdown(f"**{rname.title()} regime**")
+                c1,c2,c3,c4 = st.columns(4)
+                ur = {"standard_deduction": c1.number_input("Standard Deduction", value=sf(r.get("standard_deduction")), min_value=0.0, key=f"tsd_{rname}"),
+                      "rebate_limit":       c2.number_input("87A Rebate up to",   value=sf(r.get("rebate_limit")),       min_value=0.0, key=f"trl_{rname}"),
+                      "rebate_max":         c3.number_input("Max Rebate",         value=sf(r.get("rebate_max")),         min_value=0.0, key=f"trm_{rname}"),
+                      "deduction_80c":      c4.number_input("80C (PF) Cap",       value=sf(r.get("deduction_80c")),      min_value=0.0, key=f"t80_{rname}")}
+                slabs = st.data_editor(pd.DataFrame(r.get("slabs", []), columns=["Up to (blank = no limit)","Rate %"]),
+                                       num_rows="dynamic", use_container_width=True, key=f"tsl_{rname}")
+                ur["slabs"] = [[None if pd.isna(up) else float(up), sf(rate)] for up, rate in slabs.itertuples(index=False)
+                               if not (pd.isna(up) and pd.isna(rate))]
+                upd_regimes[rname] = ur
             if st.form_submit_button("Save"):
-                config["tds"]["enabled"]             = tds_on
+                config["tds"] = {"enabled": tds_on, "default_regime": tds_reg, "cess_percentage": tds_ces, "regimes": upd_regimes}
                 config["professional_tax"]["enabled"]= pt_on
                 save_config(config); st.success("✅ Saved!")
 
     with tab5:
         with st.form("leave_form"):
             st.markdown("#### Privilege Leave (PL)")
-            c1,c2,c3 = st.columns(3)
-            pl_a  = c1.number_input("Annual Days", si(config["leave"]["pl"]["annual"], 12), min_value=0)
+            c1,c2,c3,c4 = st.columns(4)
+            pl_a  = c1.number_input("Annual Days", value=si(config["leave"]["pl"]["annual"], 12), min_value=0)
             pl_cf = c2.checkbox("Carry Forward",   config["leave"]["pl"]["carry_forward"])
-            pl_mc = c3.number_input("Max CF Days", si(config["leave"]["pl"]["max_carry_forward"], 30), min_value=0)
+            pl_mc = c3.number_input("Max CF Days", value=si(config["leave"]["pl"]["max_carry_forward"], 30), min_value=0)
+            pl_pd = c4.checkbox("Paid Leave",      config["leave"]["pl"].get("paid", True), key="pl_pd")
             st.markdown("#### Casual Leave (CL)")
-            c1,c2 = st.columns(2)
-            cl_a  = c1.number_input("Annual Days", si(config["leave"]["cl"]["annual"], 6), min_value=0, key="cl_a")
+            c1,c2,c3 = st.columns(3)
+            cl_a  = c1.number_input("Annual Days", value=si(config["leave"]["cl"]["annual"], 6), min_value=0, key="cl_a")
             cl_cf = c2.checkbox("Carry Forward",   config["leave"]["cl"]["carry_forward"], key="cl_cf")
+            cl_pd = c3.checkbox("Paid Leave",      config["leave"]["cl"].get("paid", True), key="cl_pd")
             st.markdown("#### Sick Leave (SL)")
-            c1,c2 = st.columns(2)
-            sl_a  = c1.number_input("Annual Days", si(config["leave"]["sl"]["annual"], 6), min_value=0, key="sl_a")
+            c1,c2,c3 = st.columns(3)
+            sl_a  = c1.number_input("Annual Days", value=si(config["leave"]["sl"]["annual"], 6), min_value=0, key="sl_a")
             sl_cf = c2.checkbox("Carry Forward",   config["leave"]["sl"]["carry_forward"], key="sl_cf")
+            sl_pd = c3.checkbox("Paid Leave",      config["leave"]["sl"].get("paid", True), key="sl_pd")
             if st.form_submit_button("💾 Save Leave Policy", use_container_width=True):
                 config["leave"]["pl"]["annual"]        = pl_a
                 config["leave"]["pl"]["carry_forward"] = pl_cf
@@ -1333,14 +3728,123 @@ elif PAGE == "settings":
                 config["leave"]["cl"]["carry_forward"] = cl_cf
                 config["leave"]["sl"]["annual"]        = sl_a
                 config["leave"]["sl"]["carry_forward"] = sl_cf
+                for lt, paid in (("pl", pl_pd), ("cl", cl_pd), ("sl", sl_pd)):
+                    config["leave"][lt]["paid"] = paid
                 save_config(config); st.success("✅ Leave policy saved!")
 
+    with tab7:
+        st.markdown("### 📅 Holiday Calendar")
+        st.caption("Location **All** applies company-wide; any other value applies only to employees with that location.")
+        hol_df = pd.DataFrame(config.get("holidays", []), columns=["date","name","location"])
+        hol_df["date"] = pd.to_datetime(hol_df["date"], errors="coerce").dt.date
+        hol_edit = st.data_editor(hol_df, num_rows="dynamic", use_container_width=True, hide_index=True, key="hol_editor",
+            column_config={"date":     st.column_config.DateColumn("Date", format="YYYY-MM-DD", required=True),
+                           "name":     st.column_config.TextColumn("Holiday", required=True),
+                           "location": st.column_config.TextColumn("Location", default="All")})
+        if st.button("💾 Save Holidays", use_container_width=True):
+            config["holidays"] = [{"date": str(h["date"]), "name": h["name"] or "", "location": h["location"] or "All"}
+                                  for h in hol_edit.dropna(subset=["date"]).to_dict("records")]
+            save_config(config); st.success("✅ Holidays saved!"); st.rerun()
+
+        st.markdown("---")
+        st.markdown("#### Working Days by Month")
+        c1,c2 = st.columns(2)
+        cal_year = c1.number_input("Year", value=date.today().year, min_value=2020, max_value=2030, key="cal_y")
+        cal_locs = ["All"] + sorted({str(h.get("location") or "All") for h in config.get("holidays", [])} - {"All"})
+        cal_loc  = c2.selectbox("Location", cal_locs, key="cal_loc")
+        cal = calendar_table(compile_rules(config), cal_year, "" if cal_loc == "All" else cal_loc)
+        by_month = cal.groupby(cal.index.month).agg(days=("working","size"), working=("working","sum"),
+                                                    week_offs=("week_off","sum"), holidays=("holiday","sum"))
+        by_month.index = [MONTHS[m-1] for m in by_month.index]
+        st.dataframe(by_month, use_container_width=True)
+
+    with tab8:
+        st.markdown("#### 🕓 Change History")
+        st.caption("Every save of employees, attendance and leaves is journaled row by row with user and time.")
+        c1,c2,c3,c4 = st.columns([1,2,1,1])
+        h_tbl  = c1.selectbox("Table", list(JOURNAL_TABLES), format_func=str.title, key="h_tbl")
+        h_key  = c2.text_input("Record key", placeholder=" | ".join(JOURNAL_TABLES[h_tbl][2]), key="h_key",
+                               help="Key columns joined by | — e.g. EMP001 for employees, EMP001|2024-01-15 for attendance.")
+        h_date = c3.date_input("As of date", value=date.today(), key="h_date")
+        h_time = c4.time_input("Time", value=time(23, 59), key="h_time")
+        as_of  = datetime.combine(h_date, h_time).isoformat(timespec="seconds")
+        if h_key.strip():
+            key = h_key.strip().upper() if h_tbl == "employees" else h_key.strip()
+            rec = record_as_of(h_tbl, key, as_of)
+            if rec is None:
+                st.info(f"No version of **{key}** as of {as_of.replace('T',' ')}.")
+            else:
+                st.markdown(f"**{key}** as of {as_of.replace('T',' ')}")
+                st.dataframe(pd.DataFrame([rec]), use_container_width=True, hide_index=True)
+            hist = record_history(h_tbl, key)
+            if not hist.empty:
+                st.markdown("##### Changes to this record")
+                st.dataframe(hist, use_container_width=True, hide_index=True)
+        else:
+            recent = recent_changes(h_tbl)
+            st.markdown(f"##### Latest changes ({h_tbl})")
+            if recent.empty:
+                st.info("No changes journaled yet.")
+            else:
+                st.dataframe(recent, use_container_width=True, hide_index=True)
+
+    with tab9:
+        st.markdown("#### 🗄️ Close Periods")
+        st.caption("Closing a month moves its attendance and superseded payroll runs into compressed, read-only archive files. "
+                   "Closed months stay available to reports, payslips and change history but can no longer be edited or rerun.")
+        arc = {**DEFAULT_CONFIG["archive"], **config.get("archive", {})}
+        with st.form("archive_form"):
+            c1,c2 = st.columns(2)
+            a_auto = c1.checkbox("Close periods automatically", arc["auto_close"],
+                                 help="Once a day, every month older than the working set is closed.")
+            a_hot  = c2.number_input("Working set (months)", value=max(si(arc["hot_months"], HOT_MONTHS), HOT_MONTHS), min_value=HOT_MONTHS, max_value=36)
+            if st.form_submit_button("💾 Save"):
+                config["archive"] = {"auto_close": a_auto, "hot_months": int(a_hot)}
+                save_config(config); st.success("✅ Saved!")
+        last   = closed_through()
+        latest = pd.Period(closable_through(arc["hot_months"]), freq="M")
+        st.info(f"Closed through: **{last:%B %Y}**" if last else "No period closed yet.")
+        c1,c2,c3 = st.columns([2,1,1])
+        cp_month = c1.selectbox("Close through month", MONTHS, index=latest.month - 1, key="cp_m")
+        cp_year  = c2.number_input("Year", value=latest.year, min_value=2020, max_value=2030, key="cp_y")
+        if c3.button("🔒 Close Period", use_container_width=True):
+            try:
+                with st.spinner("Archiving..."):
+                    done = close_period(cp_year, MONTHS.index(cp_month) + 1, arc["hot_months"])
+            except ValueError as e:
+                st.error(f"❌ {e}")
+            else:
+                st.success(f"✅ Closed {', '.join(period_label(p) for p in done)}" if done else "Nothing left to close up to that month.")
+        cp = closed_periods()
+        if not cp.empty:
+            sizes = {k: sum(os.path.getsize(os.path.join(ARCHIVE_DIR, k, f)) for f in os.listdir(os.path.join(ARCHIVE_DIR, k)))
+                     for k in ("attendance","payroll") if os.path.isdir(os.path.join(ARCHIVE_DIR, k))}
+            st.caption(f"Archive on disk: {sum(sizes.values()) / 2**20:,.1f} MB · hot attendance file: "
+                       f"{os.path.getsize(ATTENDANCE_PATH) / 2**20:,.1f} MB")
+            st.dataframe(cp.assign(period=cp["period"].map(period_label)), use_container_width=True, hide_index=True)
+
     with tab6:
         st.warning("⚠️ Advanced users only. Edit JSON carefully!")
         edited = st.text_area("Config JSON", json.dumps(config, indent=2), height=500)
         if st.button("💾 Save Raw Config", use_container_width=True):
             try:
-                save_config(json.loads(edited))
-                st.success("✅ Saved!"); st.rerun()
+                raw_cfg = json.loads(edited)
+                compile_formula(raw_cfg.get("salary_components", {}).get("components", []))
+                _build_rules(raw_cfg, "check")          # a config every page can compile, or nothing is written
             except json.JSONDecodeError as e:
                 st.error(f"❌ Invalid JSON: {e}")
+            except ValueError as e:
+                st.error(f"❌ {e}")
+            except (KeyError, TypeError, AttributeError) as e:
+                st.error(f"❌ Config is missing or has a malformed setting: {e!r}")
+            else:
+                save_config(raw_cfg)
+                st.success("✅ Saved!"); st.rerun()
+
+
+# ── Load-time validation notes ────────────────────────────────────────────────
+if SCHEMA_ISSUES:
+    with st.sidebar:
+        st.markdown("---")
+        for _tbl, _iss in SCHEMA_ISSUES.items():
+            st.warning(f"⚠️ {_tbl}: unreadable values blanked — " + ", ".join(f"{c} ({n})" for c, n in _iss.items()))
@@ -0,0 +1,80 @@
+import logging
+import os
+import runpy
+import shutil
+from datetime import date
+
+import pandas as pd
+import pytest
+import streamlit as st
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+
+class App:
+    # Attribute access to the live module globals of one app.py run; runpy hands back only a copy,
+    # so assigning through this object is what reaches the app's own functions
+    def __init__(self, namespace):
+        self.__dict__["_ns"] = namespace
+
+    def __getattr__(self, name):
+        return self._ns[name]
+
+    def __setattr__(self, name, value):
+        self._ns[name] = value
+
+
+@pytest.fixture
+def app(tmp_path):
+    # A fresh copy of the app with its own empty data folder
+    shutil.copy(APP_PATH, tmp_path / "app.py")
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    return App(runpy.run_path(str(tmp_path / "app.py"))["load_config"].__globals__)
+
+
+@pytest.fixture
+def months():
+    # (year, month) for the four months before this one, oldest first; the oldest two can be closed
+    this = pd.Period(date.today(), freq="M")
+    return [((this - n).year, (this - n).month) for n in (4, 3, 2, 1)]
+
+
+@pytest.fixture
+def staffed(app, months):
+    # Three active employees, present on every working day of `months`
+    emp = pd.DataFrame({
+        "ecode": ["E1", "E2", "E3"], "name": ["Asha Rao", "Ravi Kumar", "Meena Iyer"],
+        "department": ["Ops", "Ops", "HR"], "designation": "Staff", "location": ["Pune", "Pune", "Delhi"],
+        "doj": "2022-01-10", "shift": "Morning 9-6", "is_open_shift": "No",
+        "gross_salary": [30000, 40000, 60000], "basic": [15000, 20000, 30000], "hra": [6000, 8000, 12000],
+        "conveyance": 1600, "special_allowance": [7400, 10400, 16400], "medical_allowance": 0, "food_allowance": 0,
+        "pf_applicable": "Yes", "esic_applicable": "No", "tax_regime": "New", "status": "Active",
+        "account_no": ["5001", "5002", "5003"], "ifsc": "HDFC0001234", "uan": ["1001", "1002", "1003"]})
+    app.save_employees(emp)
+    days = pd.date_range(date(*months[0], 1), pd.Period(date(*months[-1], 1), freq="M").end_time.normalize())
+    att = pd.DataFrame([(e, n, d) for d in days for e, n in zip(emp["ecode"], emp["name"])], columns=["ecode", "name", "date"])
+    att["day"] = att["date"].dt.day_name()
+    work = att["day"] != "Sunday"
+    att = att.assign(date=att["date"].dt.strftime("%Y-%m-%d"), shift="Morning 9-6",
+                     in_time=work.map({True: "09:00", False: ""}), out_time=work.map({True: "18:00", False: ""}),
+                     working_hours=work * 9.0, overtime_hours=0.0, early_going_minutes=0, late_entry_minutes=0,
+                     status=work.map({True: "Present", False: "Week Off"}), remarks="")
+    app.save_attendance(att)
+    return emp
+
+
+@pytest.fixture
+def payroll(app):
+    # Runs and saves payroll for a period the way the Run Payroll tab does; returns (register, changes, arrears)
+    def run(year, month, force=False):
+        emp      = app.load_employees()
+        previous = app.load_payroll_register(year, month)
+        register, changes, _, arrears = app.run_payroll(emp[emp["status"] == "Active"], app.attendance_month(year, month),
+                                                        app.load_rules(), year, month, previous, force=force,
+                                                        leaves_df=app.load_leaves())
+        app.save_payroll_run(year, month, register, arrears)
+        return register, changes, arrears
+    return run
@@ -0,0 +1,47 @@
+import pandas as pd
+import pytest
+
+
+def test_closing_a_period_moves_it_to_the_archive_unchanged(app, staffed, months, payroll):
+    (y1, m1), (y2, m2) = months[:2]
+    before = app.attendance_month(y1, m1)
+    first, _, _ = payroll(y1, m1)
+    emp = app.load_employees()
+    emp.loc[emp["ecode"] == "E2", "name"] = "Ravi K"
+    app.save_employees(emp)
+    latest, _, _ = payroll(y1, m1)
+
+    assert app.close_period(y1, m1) == [app.period_key(y1, m1)]
+    closed = app.closed_periods()
+    assert closed["period"].tolist() == [app.period_key(y1, m1)]
+    assert closed["attendance_rows"].tolist() == [len(before)]
+    assert closed["archived_runs"].tolist() == [1]
+
+    # Reads come back from the archive exactly as they were
+    pd.testing.assert_frame_equal(app.attendance_month(y1, m1), before.reset_index(drop=True))
+    assert app.load_payroll_register(y1, m1)["name"].tolist() == latest["name"].tolist()
+    assert app.archived_register(y1, m1, 1)["name"].tolist() == first["name"].tolist()
+    assert app.load_payroll_register(y1, m1, 1)["name"].tolist() == first["name"].tolist()
+    both = app.attendance_range(app.month_bounds(y1, m1)[0], app.month_bounds(y2, m2)[1])
+    assert len(both) == len(before) + len(app.attendance_month(y2, m2))
+
+    # ... while the working set no longer holds them
+    hot = app.load_attendance()
+    assert (hot["date"] > pd.Timestamp(app.month_bounds(y1, m1)[1])).all()
+    assert app.close_period(y1, m1) == []
+
+
+def test_a_closed_period_rejects_edits(app, staffed, months, payroll):
+    (y1, m1), (y2, m2) = months[:2]
+    payroll(y1, m1)
+    app.close_period(y1, m1)
+    assert app.is_period_closed(y1, m1) and not app.is_period_closed(y2, m2)
+
+    with pytest.raises(ValueError):
+        payroll(y1, m1, force=True)
+    att = pd.concat([app.attendance_month(y1, m1).head(1), app.load_attendance()], ignore_index=True)
+    with pytest.raises(ValueError):
+        app.save_attendance(att)
+    with pytest.raises(ValueError):
+        app.close_period(*months[-1])          # last month is still in the working set
+    payroll(y2, m2)
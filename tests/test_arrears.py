@@ -0,0 +1,54 @@
+import sqlite3
+import time
+
+
+def _net(register, ecode):
+    return float(register.loc[register["ecode"] == ecode, "net_pay"].iloc[0])
+
+
+def _revise_basic(app, ecode, by, effective):
+    time.sleep(1.1)                    # revisions and runs are ordered by their second-resolution timestamps
+    emp = app.load_employees()
+    emp.loc[emp["ecode"] == ecode, ["basic", "gross_salary"]] += by
+    app.save_employees(emp, effective)
+
+
+def test_revision_after_a_run_posts_arrears_next_period(app, staffed, months, payroll):
+    (y1, m1), (y2, m2), (y3, m3) = months[:3]
+    paid, _, _ = payroll(y1, m1)
+    _revise_basic(app, "E1", 5000, f"{y1}-{m1:02d}-10")
+    register, _, arrears = payroll(y2, m2)
+    assert arrears["ecode"].tolist() == ["E1"]
+    assert arrears["period"].tolist() == [f"{y1}-{m1:02d}"]
+    assert arrears["net_pay"].iloc[0] > 0
+    assert register.loc[register["ecode"] == "E1", "arrears_net_pay"].iloc[0] == arrears["net_pay"].iloc[0]
+    # Rerunning the posting period, or running the next one, does not pay the revision again
+    assert payroll(y2, m2, force=True)[2]["net_pay"].tolist() == arrears["net_pay"].tolist()
+    assert payroll(y3, m3)[2].empty
+
+
+def test_rerun_of_a_period_with_paid_arrears_does_not_pay_twice(app, staffed, months, payroll):
+    (y1, m1), (y2, m2), (y3, m3) = months[:3]
+    original, _, _ = payroll(y1, m1)
+    _revise_basic(app, "E1", 5000, f"{y1}-{m1:02d}-10")
+    _, _, arrears = payroll(y2, m2)
+    due = float(arrears["net_pay"].sum())
+
+    rerun, _, recovered = payroll(y1, m1, force=True)
+    assert _net(rerun, "E1") == _net(original, "E1")
+    assert recovered["net_pay"].tolist() == [-due]
+    assert _net(rerun, "E2") == _net(original, "E2")
+
+    # The later period keeps its arrears line, and every run after that agrees nothing more is due
+    assert payroll(y2, m2, force=True)[2]["net_pay"].sum() == due
+    assert payroll(y3, m3)[2].empty
+    assert _net(payroll(y1, m1, force=True)[0], "E1") == _net(original, "E1")
+
+
+def test_arrears_leave_no_tables_behind(app, staffed, months, payroll):
+    (y1, m1), (y2, m2) = months[:2]
+    payroll(y1, m1)
+    _revise_basic(app, "E2", 2000, f"{y1}-{m1:02d}-01")
+    assert not payroll(y2, m2)[2].empty
+    with sqlite3.connect(app.PAYROLL_DB_PATH) as con:
+        assert con.execute("SELECT name FROM sqlite_master WHERE name = 'arrears_due'").fetchall() == []
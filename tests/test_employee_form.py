@@ -0,0 +1,18 @@
+from streamlit.testing.v1 import AppTest
+
+
+def test_edit_keeps_location(app, staffed, tmp_path):
+    at = AppTest.from_file(str(tmp_path / "app.py"), default_timeout=60)
+    at.session_state["current_page"] = "employees"
+    at.run()
+    next(r for r in at.radio if r.label == "Mode").set_value("Edit Existing Employee")
+    at.run()
+    next(s for s in at.selectbox if s.label == "Select Employee E-Code").set_value("E2")
+    at.run()
+    assert next(t for t in at.text_input if t.label == "Location").value == "Pune"
+    next(b for b in at.button if "Save Employee" in b.label).click()
+    at.run()
+    assert not at.exception
+    emp = app.load_employees().set_index("ecode")
+    assert emp.loc["E2", "location"] == "Pune"
+    assert emp.loc["E3", "location"] == "Delhi"
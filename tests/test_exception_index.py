@@ -0,0 +1,40 @@
+def _keys(df):
+    return sorted(zip(df["date"].dt.strftime("%Y-%m-%d"), df["ecode"], df["kind"]))
+
+
+def _edit(app, att, rows, **values):
+    for col, value in values.items():
+        att.loc[rows, col] = value
+    app.save_attendance(att, touched=att.loc[rows])
+    return app.load_attendance()
+
+
+def test_index_follows_each_edit(app, staffed, months):
+    att = app.load_attendance()
+    y, m = months[2]
+    month = att[(att["date"].dt.year == y) & (att["date"].dt.month == m) & (att["status"] == "Present")]
+    miss = month.index[month["ecode"] == "E1"][3]
+    late = month.index[month["ecode"] == "E2"][5]
+    assert app.attendance_exceptions().empty
+
+    att = _edit(app, att, [miss], status="Missing OUT Punch", out_time="", working_hours=0.0)
+    att = _edit(app, att, [late], late_entry_minutes=12)
+    day_miss, day_late = (att.loc[i, "date"].strftime("%Y-%m-%d") for i in (miss, late))
+    found = app.attendance_exceptions()
+    assert _keys(found) == sorted([(day_miss, "E1", "missing_out"), (day_late, "E2", "late")])
+    assert found.loc[found["kind"] == "late", "detail"].tolist() == [12.0]
+    assert _keys(app.attendance_exceptions(app.MISSING_KINDS, day_miss, day_miss)) == [(day_miss, "E1", "missing_out")]
+
+    # Fixing the punch drops just that key
+    att = _edit(app, att, [miss], status="Present", out_time="18:00", working_hours=9.0)
+    assert _keys(app.attendance_exceptions()) == [(day_late, "E2", "late")]
+
+
+def test_index_matches_a_full_rebuild(app, staffed, months):
+    att = app.load_attendance()
+    rows = att.index[att["ecode"] == "E3"][:20:4]
+    att = _edit(app, att, rows, status="Missing IN Punch", in_time="", working_hours=0.0)
+    incremental = _keys(app.attendance_exceptions())
+    app.refresh_exception_index(app.load_attendance())
+    assert _keys(app.attendance_exceptions()) == incremental
+    assert len(incremental) == len(rows)
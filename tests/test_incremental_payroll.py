@@ -0,0 +1,44 @@
+def _by_code(register):
+    return register.set_index("ecode")
+
+
+def test_unchanged_inputs_are_not_recalculated(app, staffed, months, payroll):
+    y, m = months[2]
+    first, changes, _ = payroll(y, m)
+    assert sorted(changes["ecode"]) == ["E1", "E2", "E3"]
+    again, changes, _ = payroll(y, m)
+    assert changes.empty
+    assert again["input_hash"].tolist() == first["input_hash"].tolist()
+    assert again["net_pay"].tolist() == first["net_pay"].tolist()
+
+
+def test_only_the_employee_whose_attendance_changed_is_recalculated(app, staffed, months, payroll):
+    y, m = months[2]
+    first = _by_code(payroll(y, m)[0])
+    att = app.load_attendance()
+    day = att.index[(att["ecode"] == "E2") & (att["status"] == "Present") &
+                    (att["date"].dt.year == y) & (att["date"].dt.month == m)][0]
+    att.loc[day, ["status", "in_time", "out_time", "working_hours"]] = ["Absent", "", "", 0.0]
+    app.save_attendance(att, touched=att.loc[[day]])
+
+    register, changes, _ = payroll(y, m)
+    assert changes["ecode"].tolist() == ["E2"]
+    assert changes["change"].tolist() == ["Recalculated"]
+    after = _by_code(register)
+    assert after.loc["E2", "net_pay"] < first.loc["E2", "net_pay"]
+    assert after.loc["E2", "input_hash"] != first.loc["E2", "input_hash"]
+    for ecode in ("E1", "E3"):
+        assert after.loc[ecode, "input_hash"] == first.loc[ecode, "input_hash"]
+        assert after.loc[ecode, "net_pay"] == first.loc[ecode, "net_pay"]
+
+
+def test_config_change_and_force_recalculate_everyone(app, staffed, months, payroll):
+    y, m = months[2]
+    payroll(y, m)
+    assert sorted(payroll(y, m, force=True)[1]["ecode"]) == ["E1", "E2", "E3"]
+    config = app.load_config()
+    config["pf"]["employee_percentage"] = 10
+    app.save_config(config)
+    register, changes, _ = payroll(y, m)
+    assert sorted(changes["ecode"]) == ["E1", "E2", "E3"]
+    assert (register["pf_employee"] < register["pf_employer"]).all()
@@ -0,0 +1,73 @@
+import pandas as pd
+
+
+def _absent(app, ecode, days):
+    att = app.load_attendance()
+    rows = att.index[(att["ecode"] == ecode) & att["date"].isin(pd.to_datetime(days))]
+    att.loc[rows, "status"] = "Absent"
+    att.loc[rows, "working_hours"] = 0.0
+    app.save_attendance(att, touched=att.loc[rows])
+
+
+def _leave(app, ecode, start, end, status="Approved", leave_type="PL"):
+    leaves = app.load_leaves()
+    leaves = leaves[~((leaves["ecode"] == ecode) & (leaves["from_date"] == pd.Timestamp(start)))]
+    row = {"ecode": ecode, "name": ecode, "leave_type": leave_type, "from_date": start, "to_date": end,
+           "days": (pd.Timestamp(end) - pd.Timestamp(start)).days + 1, "reason": "", "status": status, "applied_on": start}
+    app.save_leaves(pd.concat([leaves, pd.DataFrame([row])], ignore_index=True))
+
+
+def _statuses(app, ecode, days):
+    att = app.load_attendance()
+    return att[(att["ecode"] == ecode) & att["date"].isin(pd.to_datetime(days))].sort_values("date")["status"].astype(str).tolist()
+
+
+def _week(months):
+    # Monday to Wednesday of the second full week of the oldest month, with that Thursday
+    first = pd.Timestamp(*months[2], 1)
+    monday = first + pd.Timedelta(days=(7 - first.weekday()) % 7 + 7)
+    return [(monday + pd.Timedelta(days=i)).strftime("%Y-%m-%d") for i in range(4)]
+
+
+def test_approved_leave_marks_absences_and_rejection_restores_them(app, staffed, months):
+    days = _week(months)
+    _absent(app, "E1", days[:3])
+    _leave(app, "E1", days[0], days[3])
+    assert _statuses(app, "E1", days) == ["On Leave", "On Leave", "On Leave", "Present"]
+    remarks = app.load_attendance().set_index(["ecode", "date"]).loc[("E1", pd.Timestamp(days[0])), "remarks"]
+    assert remarks == "PL leave (was Absent)"
+    assert _statuses(app, "E2", days) == ["Present"] * 4
+
+    _leave(app, "E1", days[0], days[3], status="Rejected")
+    assert _statuses(app, "E1", days) == ["Absent", "Absent", "Absent", "Present"]
+
+
+def test_paid_leave_counts_only_working_days_not_worked(app, staffed, months, payroll):
+    days = _week(months)
+    _absent(app, "E1", days[:3])
+    _leave(app, "E1", days[0], days[3])
+    y, m = months[2]
+    rules = app.load_rules()
+    paid = app.paid_leave_days(app.load_employees(), app.attendance_month(y, m), rules, y, m)
+    assert paid.to_dict() == {"E1": 3}
+
+    register = payroll(y, m)[0].set_index("ecode")
+    assert register.loc["E1", "paid_leave_days"] == 3
+    assert register.loc["E1", "earned_gross"] == register.loc["E1", "gross_salary"]
+
+    _leave(app, "E1", days[0], days[3], status="Rejected")
+    register, changes, _ = payroll(y, m)
+    assert changes["ecode"].tolist() == ["E1"]
+    assert register.set_index("ecode").loc["E1", "earned_gross"] < register.set_index("ecode").loc["E1", "gross_salary"]
+
+
+def test_overlapping_ranges_are_one_interval(app):
+    leaves = pd.DataFrame({"ecode": ["E1", "E1", "E1"], "leave_type": ["PL", "CL", "SL"],
+                           "from_date": pd.to_datetime(["2026-01-05", "2026-01-06", "2026-01-20"]),
+                           "to_date": pd.to_datetime(["2026-01-10", "2026-01-07", "2026-01-20"]),
+                           "status": "Approved"})
+    iv = app.leave_intervals(leaves)
+    keys = pd.DataFrame({"ecode": "E1", "date": pd.to_datetime(["2026-01-04", "2026-01-08", "2026-01-11", "2026-01-20"])})
+    covered = app.leave_on(keys, iv)
+    assert (covered != "").tolist() == [False, True, False, True]
+    assert covered.iloc[3] == "SL"
@@ -0,0 +1,9 @@
+import pandas as pd
+
+
+def test_categorical_columns_sort_by_label(app):
+    status = pd.Categorical(["Present", "Absent", None, "Week Off", "Half Day"], categories=app.ATTENDANCE_STATUSES)
+    df = pd.DataFrame({"status": status, "n": range(5)})
+    assert app.page_slice(df, "status", False, 1, 10)["n"].tolist() == [1, 4, 0, 3, 2]
+    assert app.page_slice(df, "status", True, 1, 10)["n"].tolist() == [3, 0, 4, 1, 2]
+    assert app.page_slice(df, "status", False, 2, 2)["n"].tolist() == [0, 3]
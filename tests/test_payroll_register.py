@@ -0,0 +1,35 @@
+import sqlite3
+
+
+def test_every_run_is_kept_and_the_latest_is_current(app, staffed, months, payroll):
+    y, m = months[2]
+    first, _, _ = payroll(y, m)
+    emp = app.load_employees()
+    emp.loc[emp["ecode"] == "E1", "name"] = "Asha R"
+    app.save_employees(emp)
+    second, _, _ = payroll(y, m)
+
+    period = app.period_key(y, m)
+    runs = app.payroll_runs()
+    assert runs.loc[runs["period"] == period, "run_id"].tolist() == [2, 1]
+    assert app.latest_run_id(y, m) == 2
+    assert app.load_payroll_register(y, m)["name"].tolist() == ["Asha R", "Ravi Kumar", "Meena Iyer"]
+    assert app.load_payroll_register(y, m, 1)["name"].tolist() == ["Asha Rao", "Ravi Kumar", "Meena Iyer"]
+    assert app.load_payroll_register(*months[1]) is None
+
+    with sqlite3.connect(app.PAYROLL_DB_PATH) as con:
+        assert con.execute("SELECT run_id, COUNT(*) FROM current_register WHERE period = ? GROUP BY run_id",
+                           (period,)).fetchall() == [(2, 3)]
+    history = app.payroll_employee_history("E1")
+    assert history["run_id"].tolist() == [2]
+    assert history["name"].tolist() == ["Asha R"]
+
+
+def test_department_cost_reads_the_current_run_only(app, staffed, months, payroll):
+    y, m = months[2]
+    payroll(y, m)
+    payroll(y, m, force=True)
+    cost = app.payroll_department_cost(app.period_key(y, m), app.period_key(y, m)).set_index("department")
+    assert cost.loc["Ops", "employees"] == 2 and cost.loc["HR", "employees"] == 1
+    register = app.load_payroll_register(y, m)
+    assert round(cost["net_pay"].sum(), 2) == round(register["net_pay"].sum(), 2)
@@ -0,0 +1,37 @@
+import pandas as pd
+
+
+def _index(app, names, mobiles=None):
+    df = pd.DataFrame({"ecode": [f"EMP{i:06d}" for i in range(len(names))], "name": names, "department": "Ops",
+                       "mobile": mobiles or [f"98{i:08d}" for i in range(len(names))]})
+    return df, app.EmployeeSearchIndex(df)
+
+
+def test_ranks_exact_then_prefix_then_typos(app):
+    df, idx = _index(app, ["Rahul Sharma", "Rahul Verma", "Rahula Sharman", "Ritu Sharma"])
+    rows, cut = idx.search("rahul sharma")
+    assert df["name"].iloc[rows].tolist() == ["Rahul Sharma", "Rahula Sharman"]
+    assert cut == 0
+    assert df["name"].iloc[idx.search("rahl sharma")[0]].tolist()[:2] == ["Rahul Sharma", "Rahula Sharman"]
+    assert idx.search("EMP000002")[0].tolist() == [2]
+
+
+def test_every_word_must_match(app):
+    df, idx = _index(app, ["Rahul Sharma"] * 3 + ["Ritu Sharma"] * 50 + ["Sanjay Sharma"] * 50)
+    rows, _ = idx.search("rahl sharma")
+    assert set(df["name"].iloc[rows]) == {"Rahul Sharma"}
+    assert len(rows) == 3
+
+
+def test_code_grams_must_come_from_one_field(app):
+    # EMP006565's mobile holds 000, 001, 012 and 123, which a pooled index would combine with its code
+    df, idx = _index(app, ["A B"] * 7000, mobiles=[f"900012{i:04d}" for i in range(7000)])
+    assert df["ecode"].iloc[idx.search("EMP000123")[0]].tolist() == ["EMP000123"]
+
+
+def test_cap_keeps_prefix_hits_and_reports_the_rest(app):
+    df, idx = _index(app, ["Kumar Das"] * 30 + ["Kumari Das"] * 30 + ["Kumr Das"] * 2)
+    rows, cut = idx.search("kumr", limit=10)
+    assert df["name"].iloc[rows[:2]].tolist() == ["Kumr Das", "Kumr Das"]
+    assert len(rows) == 12 and cut == 50
+    assert idx.search("kumar", limit=0)[0].tolist() == list(range(30)) + list(range(30, 60))
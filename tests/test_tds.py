@@ -0,0 +1,47 @@
+import pytest
+
+
+@pytest.fixture
+def regimes(app):
+    return app.compile_tax_regimes(app.DEFAULT_CONFIG["tds"]["regimes"])
+
+
+def test_income_tax_follows_the_slabs_and_rebate(app, regimes):
+    new, old = regimes["new"], regimes["old"]
+    # 1,500,000 - 75,000 standard deduction: 5% of 4-8L, 10% of 8-12L, 15% of 12-14.25L, then 4% cess
+    assert app.income_tax([1500000], new, 4).tolist() == pytest.approx([97500])
+    # Taxable income up to the rebate limit pays nothing
+    assert app.income_tax([1275000, 0], new, 4).tolist() == [0, 0]
+    assert app.income_tax([800000], old, 4).tolist() == pytest.approx([65000])
+    assert app.income_tax([550000], old).tolist() == [0]
+
+
+def test_monthly_tds_spreads_the_projected_annual_tax(app, staffed, months, payroll, regimes):
+    config = app.load_config()
+    config["tds"]["enabled"] = True
+    app.save_config(config)
+    emp = app.load_employees()
+    emp.loc[emp["ecode"] == "E3", ["gross_salary", "basic", "hra", "special_allowance"]] = [200000, 100000, 40000, 58400]
+    app.save_employees(emp, "%d-%02d-01" % months[0])
+    rules = app.load_rules()
+
+    def taxable(register):
+        return register.set_index("ecode").reindex(columns=app.taxable_columns(rules), fill_value=0).sum(axis=1)
+
+    (y1, m1), (y2, m2) = months[:2]
+    first, _, _ = payroll(y1, m1)
+    left = app.financial_year_periods(y1, m1)[1]       # nothing was paid earlier in the year
+    monthly = taxable(first)["E3"]
+    expected = app.income_tax([monthly * (left + 1)], regimes["new"], 4)[0] / (left + 1)
+    tds = first.set_index("ecode")["tds"]
+    assert tds["E3"] > 0 and tds["E3"] == round(expected)
+    assert tds["E1"] == 0                    # under the rebate limit
+    # A rerun replaces the deduction rather than adding to it
+    rerun, _, _ = payroll(y1, m1, force=True)
+    assert rerun["tds"].tolist() == first["tds"].tolist()
+    assert rerun["net_pay"].tolist() == first["net_pay"].tolist()
+
+    second, _, _ = payroll(y2, m2)
+    if app.financial_year_periods(y2, m2)[0]:
+        # Same financial year: what is still owed is spread over the months left, so the deduction stays level
+        assert abs(second.set_index("ecode")["tds"]["E3"] - tds["E3"]) <= 1